@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+
+Measures Handler.receive_message dispatch and remove_store costs with a
+growing number of joined channels.
+'''
+
+from common import best_of, usec, make_handler
+
+CHANNELS = [10, 100, 500]
+
+MESSAGES = [
+    ('PING', "PING :irc.example.com"),
+    ('numeric', ":irc.example.com 372 bench :- message of the day"),
+    ('unknown numeric', ":irc.example.com 020 * :Please wait"),
+    ('channel PRIVMSG', ":someone!user@host PRIVMSG #chan5 :hello there"),
+    ('query PRIVMSG', ":friend!user@host PRIVMSG bench :hi"),
+    ('MODE', ":someone!user@host MODE #chan5 +v other"),
+]
+
+
+def join(h, channel):
+    h.receive_message(":bench!bench@localhost JOIN :%s" % channel)
+
+
+def main():
+    print "%-18s" % "channels" + ''.join(["%14d" % x for x in CHANNELS])
+    results = {}
+    for count in CHANNELS:
+        h = make_handler()
+        for i in range(count):
+            join(h, "#chan%d" % i)
+        h.receive_message(":friend!user@host PRIVMSG bench :hi")
+        for name, line in MESSAGES:
+            results[(name, count)] = \
+                best_of(lambda: h.receive_message(line), repeat=3,
+                        number=500)
+
+        def part_and_rejoin():
+            store = h.list_privmsg_stores()['#chan7']
+            h.remove_store(h.get_store_id(store))
+            join(h, '#chan7')
+        results[('remove + rejoin', count)] = \
+            best_of(part_and_rejoin, repeat=3, number=50)
+
+    for name in [x[0] for x in MESSAGES] + ['remove + rejoin']:
+        print "%-18s" % name + \
+              ''.join(["%14s" % usec(results[(name, x)]) for x in CHANNELS])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+
+Measures how much memory a received event takes, the way the handler
+creates them, compared to the old-style Event class with an instance
+dictionary, and how much an event takes in a store with its line rendered,
+with the list and the columnar backends. Each kind is measured in a
+process of its own from the growth of the resident set size.
+
+Usage: python bench/bench_event_memory.py [count]
+'''
+
+import os, sys, time, subprocess
+
+from common import rss # puts the top level directory to sys.path
+from lib.events import parse_message, EventStore, ColumnarEventList
+
+COUNT = 200000
+
+SAMPLE = [
+    "PING :irc.example.net",
+    ":irc.example.net 372 bench :- Be nice and have fun",
+    ":irc.example.net 353 bench = #python :@op +voiced someone other friend",
+    ":someone!~user@host-1.example.com PRIVMSG #python :has anyone tried it?",
+    ":other!~other@10.0.0.5 PRIVMSG #python :yes, works fine here :)",
+    ":quitter!~q@host-3.example.com QUIT :Ping timeout: 240 seconds",
+]
+
+
+class LegacyEvent:
+    """lib.events.Event before it had __slots__"""
+
+    def __init__(self, prefix, command, params="", params_endpart="",
+                 generated=False, informational=False):
+        self.timestamp = time.time()
+        self.command = command
+        self.params = params
+        self.generated = generated
+        self.informational = informational
+        self.prefix = prefix
+        if params and not params_endpart:
+            try:
+                self.params_endpart = params[params.index(':')+1:]
+            except ValueError:
+                self.params_endpart = ""
+        else:
+            self.params = params
+            self.params_endpart = params_endpart
+
+
+def legacy_parse(message):
+    tmp = message.split(' ')
+    if message[0] == ":":
+        prefix = tmp[0]
+        cmd = tmp[1]
+        params = ' '.join(tmp[2:])
+    else:
+        prefix = ""
+        cmd = tmp[0]
+        params = ' '.join(tmp[1:])
+    return LegacyEvent(prefix=prefix, command=cmd, params=params)
+
+
+def child(kind, count):
+    # the lines are made unique, as they would be when read from a socket
+    lines = ["%s%d" % (SAMPLE[i % len(SAMPLE)], i) for i in xrange(count)]
+    before = rss()
+    if kind in ('old', 'new'):
+        parse = {'old': legacy_parse, 'new': parse_message}[kind]
+        events = [parse(line) for line in lines]
+    else:
+        store = EventStore(1, None, backend={'list': list,
+                                             'columnar': ColumnarEventList}[kind])
+        for line in lines:
+            store._add(parse_message(line))
+        store.get_size()
+    after = rss()
+    print (after - before) / float(count)
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        child(sys.argv[2], int(sys.argv[3]))
+        return
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or COUNT
+    print "%d events, bytes per event including its strings:" % count
+    for kind, name in (('old', 'old-style Event'), ('new', 'slotted Event'),
+                       ('list', 'list store'), ('columnar', 'columnar store')):
+        out = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                '--child', kind, str(count)],
+                               stdout=subprocess.PIPE).communicate()[0]
+        print "%-18s %8.0f" % (name, float(out))
+
+if __name__ == '__main__':
+    main()
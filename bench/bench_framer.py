@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+
+Measures how fast a burst of lines coming from the server is split to lines,
+the old recv(2048) + replace + split framing against LineFramer. The burst
+is sent over a socket pair so the number of recv calls counts too.
+
+Usage: python bench/bench_framer.py [file]
+
+where file has one raw IRC line per line, e.g. a recording of a NAMES/WHO
+burst from a large channel. By default a 100k line WHO/NAMES burst is made
+up.
+'''
+
+import sys, socket, threading, time
+
+from common import best_of
+from lib.connection import LineFramer
+
+LINES = 100000
+
+
+def make_burst(count=LINES):
+    lines = []
+    for i in range(count):
+        if i % 10:
+            lines.append(":irc.example.net 352 bench #big user%d "
+                         "host-%d.example.com irc.example.net Nick%d H "
+                         ":0 Real Name %d" % (i, i, i, i))
+        else:
+            lines.append(":irc.example.net 353 bench = #big :" +
+                         ' '.join(["@Nick%d" % x for x in range(i, i + 40)]))
+    return '\r\n'.join(lines) + '\r\n'
+
+
+class LegacyFramer:
+    """the framing Connection._receive used to do"""
+
+    def __init__(self):
+        self.old_data = ""
+
+    def receive(self, sock):
+        new_data = sock.recv(2048).replace('\r', '')
+        if not new_data:
+            return None
+        if not new_data.endswith('\n'):
+            t = new_data.split('\n')
+            new_lines = t[:-1]
+            if new_lines:
+                if self.old_data:
+                    new_lines[0] = self.old_data + new_lines[0]
+                    self.old_data = t[-1]
+                else:
+                    self.old_data = t[-1]
+            else:
+                self.old_data += t[0]
+        else:
+            new_lines = new_data.split('\n')[:-1]
+            new_lines[0] = self.old_data + new_lines[0]
+            self.old_data = ""
+        return new_lines
+
+
+class NewFramer:
+    def __init__(self):
+        self.framer = LineFramer()
+
+    def receive(self, sock):
+        if not self.framer.fill(sock):
+            return None
+        return self.framer.lines()
+
+
+def run(framer_class, data, result):
+    reader, writer = socket.socketpair()
+    sender = threading.Thread(target=lambda: (writer.sendall(data),
+                                              writer.close()))
+    sender.start()
+    framer = framer_class()
+    lines = calls = 0
+    while True:
+        calls += 1
+        new_lines = framer.receive(reader)
+        if new_lines is None:
+            break
+        lines += len(new_lines)
+    sender.join()
+    reader.close()
+    result[:] = [lines, calls]
+
+
+def main():
+    if len(sys.argv) > 1:
+        data = open(sys.argv[1]).read()
+    else:
+        data = make_burst()
+    print "%d lines, %d bytes" % (data.count('\n'), len(data))
+    print "%-10s %12s %12s %12s" % ("framer", "time", "lines/s", "recv calls")
+    for name, framer_class in (('legacy', LegacyFramer),
+                               ('LineFramer', NewFramer)):
+        result = []
+        took = best_of(lambda: run(framer_class, data, result), repeat=3)
+        print "%-10s %10.1f ms %12d %12d" % (name, took * 1000,
+                                             result[0] / took, result[1])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+
+Measures pyircfs end to end against a fake IRC server on the loopback
+interface: lines go from the server through Connection, Handler and the
+event stores, and are read back with PyIrcFS.read the way a mounted
+filesystem would, without a kernel mount. The server runs in a process of
+its own, completes the registration, joins the client to #bench and then
+floods it with one kind of traffic at a time when asked:
+
+  privmsg   channel messages from a few hundred nicks
+  joinquit  nicks joining the channel and quitting
+  names     NAMES replies for the channel
+  who       WHO replies for the channel
+
+Every 100 lines the server adds a message from the nick "probe" stamped
+with the time it was sent, which gives the latency until the line could be
+read from the channel file; the last one tells the scenario is over. The
+results are written to a JSON file, which --compare compares a run to.
+
+Usage: python bench/bench_loopback.py [options] [scenario ...]
+'''
+
+import os, sys, time, socket, subprocess, threading, json, optparse
+
+import common # puts the top level directory to sys.path
+import pyircfs
+
+SCENARIOS = ['privmsg', 'joinquit', 'names', 'who']
+LINES = 20000
+PROBE_EVERY = 100
+CHANNEL = '#bench'
+NICK = 'bench'
+CONTROL = 'benchserv' # the nick the server takes orders from
+SERVER = 'irc.example.net'
+
+
+# the server side, run with --server
+
+def scenario_lines(scenario, count):
+    if scenario == 'privmsg':
+        return [":user%d!~user@host-%d.example.com PRIVMSG %s :line %d of "
+                "the benchmark, long enough to look like chat" %
+                (i % 300, i % 300, CHANNEL, i) for i in xrange(count)]
+    if scenario == 'joinquit':
+        lines = []
+        for i in xrange(count / 2):
+            lines.append(":joiner%d!~j@host-%d.example.com JOIN :%s" %
+                         (i, i, CHANNEL))
+            lines.append(":joiner%d!~j@host-%d.example.com QUIT :Quit: bye" %
+                         (i, i))
+        return lines
+    if scenario == 'names':
+        return [":%s 353 %s = %s :%s" % (SERVER, NICK, CHANNEL,
+                ' '.join(["%sn%d_%d" % ('@+ '[j % 3].strip(), i, j)
+                          for j in xrange(40)])) for i in xrange(count - 1)] + \
+               [":%s 366 %s %s :End of /NAMES list." % (SERVER, NICK, CHANNEL)]
+    if scenario == 'who':
+        return [":%s 352 %s %s ~w host-%d.example.com %s w%d H :0 Who %d" %
+                (SERVER, NICK, CHANNEL, i, SERVER, i, i)
+                for i in xrange(count - 1)] + \
+               [":%s 315 %s %s :End of /WHO list." % (SERVER, NICK, CHANNEL)]
+    raise ValueError("unknown scenario %s" % scenario)
+
+
+def probe(scenario, seq):
+    return ":probe!~p@localhost PRIVMSG %s :%s %s %.6f" % (CHANNEL, scenario,
+                                                           seq, time.time())
+
+
+def flood(sock, scenario, count):
+    lines = scenario_lines(scenario, count)
+    for i in xrange(0, len(lines), PROBE_EVERY):
+        chunk = [probe(scenario, i)] + lines[i:i+PROBE_EVERY]
+        sock.sendall('\r\n'.join(chunk) + '\r\n')
+    sock.sendall(probe(scenario, 'done') + '\r\n')
+
+
+def serve():
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    print listener.getsockname()[1]
+    sys.stdout.flush()
+    sock = listener.accept()[0]
+    nick = NICK
+    for line in sock.makefile('rb'):
+        args = line.rstrip('\r\n').split(' ')
+        if args[0] == 'NICK':
+            nick = args[1]
+        elif args[0] == 'USER':
+            sock.sendall('\r\n'.join([
+                ":%s 001 %s :Welcome to the benchmark %s" % (SERVER, nick, nick),
+                ":%s 002 %s :Your host is %s" % (SERVER, nick, SERVER),
+                ":%s 004 %s %s bench iow biklmnopstv" % (SERVER, nick, SERVER),
+                ":%s 005 %s PREFIX=(ov)@+ CASEMAPPING=rfc1459 CHANTYPES=# "
+                ":are supported by this server" % (SERVER, nick),
+                ":%s 376 %s :End of /MOTD command." % (SERVER, nick),
+                ":%s!~%s@localhost JOIN :%s" % (nick, nick, CHANNEL),
+                ":%s 353 %s = %s :@%s" % (SERVER, nick, CHANNEL, nick),
+                ":%s 366 %s %s :End of /NAMES list." % (SERVER, nick, CHANNEL),
+                '']))
+        elif args[0] == 'PING':
+            sock.sendall("PONG %s\r\n" % ' '.join(args[1:]))
+        elif args[0] == 'PRIVMSG' and args[1] == CONTROL:
+            # PRIVMSG benchserv :run <scenario> <lines>
+            flood(sock, args[3], int(args[4]))
+        elif args[0] == 'QUIT':
+            sock.sendall("ERROR :Closing Link: %s (Quit)\r\n" % nick)
+            break
+    sock.close()
+
+
+# the client side
+
+def make_fs(options, port):
+    """returns a PyIrcFS set up the way main() does, connected to port"""
+    fs = pyircfs.PyIrcFS()
+    fs.server = '127.0.0.1'
+    fs.port = port
+    fs.nickname = NICK
+    fs.altnick = ''
+    fs.username = NICK
+    fs.realname = NICK
+    fs.maxevents = options.maxevents
+    fs.spooldir = None
+    fs.backend = options.backend
+    fs.eofwait = 1
+    fs.sendbuffer = 100
+    fs.engine = options.engine
+    fs.trace = options.trace
+    # the orders to the server mustn't wait for flood control
+    fs.floodrate = 100
+    fs.floodburst = 100
+    fs.floodbyterate = 100000
+    fs.floodbyteburst = 100000
+    fs.fsinit()
+    return fs
+
+
+class Reader(threading.Thread):
+    """reads the channel file as it grows, the way cat does with eofwait,
+    and notes the probes in it"""
+
+    def __init__(self, fs, path):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fs = fs
+        self.path = path
+        self.probes = {} # scenario -> [(sent, read)]
+        self.done = {} # scenario -> time its last probe was read
+        self.finished = threading.Condition()
+        self.stopped = False
+
+    def run(self):
+        offset = 0
+        partial = ''
+        while not self.stopped:
+            buf = self.fs.read(self.path, 65536, offset)
+            if not buf:
+                continue
+            now = time.time()
+            offset += len(buf)
+            lines = (partial + buf).split('\n')
+            partial = lines.pop()
+            for line in lines:
+                i = line.find('<probe> ')
+                if i != -1:
+                    self._probe(line[i+8:].split(' '), now)
+
+    def _probe(self, (scenario, seq, sent), now):
+        self.probes.setdefault(scenario, []).append((float(sent), now))
+        if seq == 'done':
+            with self.finished:
+                self.done[scenario] = now
+                self.finished.notify_all()
+
+    def wait(self, scenario, timeout):
+        deadline = time.time() + timeout
+        with self.finished:
+            while scenario not in self.done and time.time() < deadline:
+                self.finished.wait(deadline - time.time())
+        return scenario in self.done
+
+
+def percentile(values, q):
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def run_scenario(fs, reader, scenario, count, timeout):
+    fs.handler.send_message(CONTROL, 'run %s %d' % (scenario, count))
+    if not reader.wait(scenario, timeout):
+        raise RuntimeError("%s didn't finish in %d seconds" % (scenario,
+                                                               timeout))
+    probes = reader.probes[scenario]
+    lines = count + len(probes)
+    took = reader.done[scenario] - probes[0][0]
+    latencies = sorted([read - sent for sent, read in probes])
+    return {'lines': lines,
+            'seconds': took,
+            'lines_per_sec': lines / took,
+            'latency_ms': {'count': len(latencies),
+                           'p50': percentile(latencies, 0.5) * 1000,
+                           'p90': percentile(latencies, 0.9) * 1000,
+                           'p99': percentile(latencies, 0.99) * 1000,
+                           'max': latencies[-1] * 1000}}
+
+
+def start_server():
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                               '--server'], stdout=subprocess.PIPE)
+    return server, int(server.stdout.readline())
+
+
+def wait_for(condition, timeout, what):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise RuntimeError("timed out waiting for %s" % what)
+        time.sleep(0.01)
+
+
+def compare(results, old):
+    print "\ncompared to %s:" % old['started']
+    for scenario, result in sorted(results['scenarios'].items()):
+        before = old['scenarios'].get(scenario)
+        if not before:
+            continue
+        print "%-10s lines/s %+6.1f%%, p50 latency %+6.1f%%" % (scenario,
+            (result['lines_per_sec'] / before['lines_per_sec'] - 1) * 100,
+            (result['latency_ms']['p50'] /
+             max(before['latency_ms']['p50'], 0.001) - 1) * 100)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [scenario ...]")
+    parser.add_option('--server', action='store_true',
+                      help="run the fake server (used by the benchmark)")
+    parser.add_option('-n', '--lines', type='int', default=LINES,
+                      help="lines per scenario (default: %default)")
+    parser.add_option('--engine', default='thread',
+                      help="connection engine (default: %default)")
+    parser.add_option('--backend', default='list',
+                      help="store backend (default: %default)")
+    parser.add_option('--maxevents', type='int', default=0,
+                      help="events kept in memory per store (default: "
+                           "no limit)")
+    parser.add_option('-o', '--output', default='bench_loopback.json',
+                      help="where to write the results (default: %default)")
+    parser.add_option('--trace', metavar='FILE', default='',
+                      help="record the lines received to FILE, for "
+                           "bench/replay.py")
+    parser.add_option('--compare', metavar='FILE',
+                      help="results of an earlier run to compare to")
+    parser.add_option('--timeout', type='int', default=300,
+                      help="seconds a scenario may take (default: %default)")
+    options, scenarios = parser.parse_args()
+    if options.server:
+        serve()
+        return
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("unknown scenario %s, use some of: %s" %
+                         (scenario, ' '.join(SCENARIOS)))
+    scenarios = scenarios or SCENARIOS
+
+    server, port = start_server()
+    try:
+        fs = make_fs(options, port)
+        wait_for(lambda: fs.handler.connection_status[0] == 10, 10,
+                 "registration")
+        path = '/' + CHANNEL
+        wait_for(lambda: fs._search(path), 10, "joining %s" % CHANNEL)
+        reader = Reader(fs, path)
+        reader.start()
+
+        results = {'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': sys.version.split()[0],
+                   'engine': options.engine, 'backend': options.backend,
+                   'maxevents': options.maxevents, 'scenarios': {}}
+        print "%d lines per scenario, %s engine, %s backend" % \
+              (options.lines, options.engine, options.backend)
+        print "%-10s %10s %10s %10s %10s" % ('', 'lines/s', 'p50 ms',
+                                             'p99 ms', 'max ms')
+        for scenario in scenarios:
+            result = run_scenario(fs, reader, scenario, options.lines,
+                                  options.timeout)
+            results['scenarios'][scenario] = result
+            print "%-10s %10.0f %10.2f %10.2f %10.2f" % (scenario,
+                result['lines_per_sec'], result['latency_ms']['p50'],
+                result['latency_ms']['p99'], result['latency_ms']['max'])
+        reader.stopped = True
+        reader.join() # its read returns within eofwait
+        fs.handler.send_command('QUIT', 'done')
+        server.wait()
+        if fs.handler.trace is not None:
+            fs.handler.trace.close()
+    except:
+        server.kill()
+        raise
+
+    f = open(options.output, 'w')
+    json.dump(results, f, indent=2, sort_keys=True)
+    f.close()
+    print "results written to %s" % options.output
+    if options.compare:
+        compare(results, json.load(open(options.compare)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+
+Simulates joining a channel with 50k members: the NAMES replies and the
+WHO replies ChannelStore asks for after the JOIN. Compares the time it
+takes and the size of the member records to the old way of keeping a dict
+per nick, and shows the time with the rest of ChannelStore.add_event. The
+Member runs keep Handler.member_channels up to date too, its size per
+member is shown apart from the records.
+
+Usage: python bench/bench_names.py [members]
+'''
+
+import sys
+
+from common import best_of, make_handler
+from lib.events import parse_message, ChannelStore
+
+MEMBERS = 50000
+PREFIXES = ['@', '+', '', '', '', '', '', '', '', '']
+
+
+def make_replies(count):
+    names = ["%sNick%d" % (PREFIXES[i % len(PREFIXES)], i) for i in xrange(count)]
+    lines = []
+    for i in xrange(0, count, 40):
+        lines.append(":irc.example.net 353 bench = #big :" +
+                     ' '.join(names[i:i+40]))
+    for i in xrange(count):
+        lines.append(":irc.example.net 352 bench #big user%d "
+                     "host-%d.example.com irc%d.example.net Nick%d H%s "
+                     ":%d Real Name %d" % (i, i, i % 5, i,
+                                           PREFIXES[i % len(PREFIXES)],
+                                           i % 3, i))
+    return [parse_message(x) for x in lines]
+
+
+class LegacyChannel:
+    """what ChannelStore.add_event did with NAMES and WHO replies"""
+
+    def __init__(self):
+        self.nicknames = {}
+
+    def _add_names(self, event):
+        for nick in event.params_endpart.split():
+            if not nick.strip('+@') in self.nicknames:
+                self.nicknames[nick.strip('+@')] = {}
+
+            self.nicknames[nick.strip('+@')]['op'] = '@' in nick
+            self.nicknames[nick.strip('+@')]['voice'] = '+' in nick
+
+    def _add_who(self, event):
+        args = event.args
+        nick = args[5]
+        if not nick in self.nicknames:
+            self.nicknames[nick] = {}
+        hopcount, sep, realname = args[7].partition(' ')
+        self.nicknames[nick]['username'] = args[2]
+        self.nicknames[nick]['hostname'] = args[3]
+        self.nicknames[nick]['server'] = args[4]
+        self.nicknames[nick]['op'] = '@' in args[6]
+        self.nicknames[nick]['voice'] = '+' in args[6]
+        self.nicknames[nick]['away'] = 'G' in args[6]
+        self.nicknames[nick]['hopcount'] = hopcount
+        self.nicknames[nick]['realname'] = realname
+
+
+def join(make_channel, replies):
+    """gives the replies straight to the NAMES and WHO handling"""
+    channel = make_channel()
+    for event in replies:
+        if event.command == '353':
+            channel._add_names(event)
+        else:
+            channel._add_who(event)
+    return channel
+
+
+def join_store(make_channel, replies):
+    """gives the replies to ChannelStore.add_event"""
+    channel = make_channel()
+    for event in replies:
+        channel.add_event(event)
+    return channel
+
+
+def record_size(nicknames):
+    """bytes taken by the member records themselves, not their strings"""
+    return sum([sys.getsizeof(x) for x in nicknames.itervalues()]) / \
+           float(len(nicknames))
+
+
+def index_size(channel):
+    """bytes per member taken by the handler's index of the channels of
+    each nick, not counting the strings"""
+    handler = getattr(channel, 'handler', None)
+    if handler is None:
+        return 0.0
+    index = handler.member_channels
+    return (sys.getsizeof(index) + sum([sys.getsizeof(x) for x in
+                                        index.itervalues()
+                                        if not isinstance(x, ChannelStore)])) / \
+           float(len(channel.nicknames))
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or MEMBERS
+    replies = make_replies(count)
+    for event in replies: # parse the events before timing
+        event.args
+    # a handler of its own for every join, it keeps track of the members
+    new = lambda: ChannelStore(1, make_handler(), '#big', joined=True)
+
+    print "%d members, %d replies" % (count, len(replies))
+    print "%-22s %12s %16s %16s" % ("", "time", "bytes per record",
+                                    "index per member")
+    for name, make_channel, run in (
+            ('dicts', LegacyChannel, join),
+            ('Member', new, join),
+            ('Member, add_event', new, join_store)):
+        took = best_of(lambda: run(make_channel, replies), repeat=3)
+        channel = run(make_channel, replies)
+        assert len(channel.nicknames) == count
+        print "%-22s %9.1f ms %16.0f %16.0f" % (name, took * 1000,
+            record_size(channel.nicknames), index_size(channel))
+
+if __name__ == '__main__':
+    main()
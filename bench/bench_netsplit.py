@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+
+Simulates a netsplit while on 300 channels: 5000 nicks, each on a few of
+the channels, quit at once, and as many change their nick. Compares
+sending NICK and QUIT only to the channels the nick is on, with
+Handler.member_channels, to the old way of sending them to every channel.
+
+Usage: python bench/bench_netsplit.py [channels] [nicks]
+'''
+
+import sys
+
+from common import best_of, make_handler
+
+CHANNELS = 300
+NICKS = 5000
+CHANNELS_PER_NICK = 3
+
+
+def setup(channels, nicks, fan_out):
+    h = make_handler()
+    for i in xrange(channels):
+        h.receive_message(":bench!bench@localhost JOIN :#chan%d" % i)
+    members = [[] for i in xrange(channels)]
+    for i in xrange(nicks):
+        for j in xrange(CHANNELS_PER_NICK):
+            members[(i * 7 + j * 101) % channels].append("user%d" % i)
+    for i in xrange(channels):
+        for j in xrange(0, len(members[i]), 40):
+            h.receive_message(":irc.example.net 353 bench = #chan%d :%s" %
+                              (i, ' '.join(members[i][j:j+40])))
+    if fan_out:
+        # the way it was: every channel gets every NICK and QUIT
+        h.member_handler_classes = {}
+        for store in h.list_privmsg_stores().values():
+            for command in ('NICK', 'QUIT'):
+                h.reply_stores.add(command, store)
+    return h
+
+
+def split(h, nicks):
+    for i in xrange(nicks):
+        h.receive_message(":user%d!u@host-%d NICK :renamed%d" % (i, i, i))
+    for i in xrange(nicks):
+        h.receive_message(":renamed%d!u@host-%d QUIT :irc.example.net "
+                          "split.example.net" % (i, i))
+
+
+def main():
+    channels = len(sys.argv) > 1 and int(sys.argv[1]) or CHANNELS
+    nicks = len(sys.argv) > 2 and int(sys.argv[2]) or NICKS
+    print "%d channels, %d nicks on %d channels each renamed and quit" % \
+          (channels, nicks, CHANNELS_PER_NICK)
+    for name, fan_out in (('every channel', True), ('member_channels', False)):
+        took = []
+        for i in range(3):
+            h = setup(channels, nicks, fan_out)
+            took.append(best_of(lambda: split(h, nicks), repeat=1))
+        members = sum([len(x.nicknames) for x in
+                       h.list_privmsg_stores().values()])
+        assert members == channels # just us left
+        print "%-16s %10.1f ms" % (name, min(took) * 1000)
+
+if __name__ == '__main__':
+    main()
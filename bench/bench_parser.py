@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+
+Compares events.parse_message against the old way of parsing received
+lines: splitting on spaces in Handler.receive_message, joining the
+parameters back, scanning them for ':' in Event.__init__ and splitting
+them again in the stores.
+
+Usage: python bench/bench_parser.py [file]
+
+where file has one raw IRC line per line. By default a sample of typical
+traffic is used.
+'''
+
+import sys, time
+
+from common import best_of, usec
+from lib.events import parse_message
+
+SAMPLE = [
+    "PING :irc.example.net",
+    ":irc.example.net 001 bench :Welcome to the Internet Relay Network bench!bench@localhost",
+    ":irc.example.net 005 bench CHANTYPES=# PREFIX=(ov)@+ CASEMAPPING=rfc1459 NICKLEN=30 :are supported by this server",
+    ":irc.example.net 372 bench :- Be nice and have fun",
+    ":someone!~user@host-1.example.com PRIVMSG #python :has anyone tried the new release?",
+    ":other!~other@10.0.0.5 PRIVMSG #python :yes, works fine here :)",
+    ":friend!friend@example.org PRIVMSG bench :\001ACTION waves\001",
+    ":someone!~user@host-1.example.com JOIN :#python",
+    ":leaver!~l@host-2.example.com PART #python :see you",
+    ":quitter!~q@host-3.example.com QUIT :Ping timeout: 240 seconds",
+    ":op!~op@staff.example.net MODE #python +o someone",
+    ":op!~op@staff.example.net KICK #python troll :no trolling",
+    ":irc.example.net 353 bench = #python :@op +voiced someone other friend leaver",
+    ":irc.example.net 352 bench #python ~user host-1.example.com irc.example.net someone H :0 Some One",
+    ":irc.example.net 366 bench #python :End of /NAMES list.",
+    ":someone!~user@host-1.example.com NICK :someone_",
+    "@time=2026-10-17T10:00:00.000Z;msgid=abc :someone!~user@host-1.example.com PRIVMSG #python :tagged",
+]
+
+
+class LegacyEvent:
+    def __init__(self, prefix, command, params="", params_endpart="",
+                 generated=False, informational=False):
+        self.timestamp = time.time()
+        self.command = command
+        self.params = params
+        self.generated = generated
+        self.informational = informational
+        self.prefix = prefix
+        if params and not params_endpart:
+            try:
+                self.params_endpart = params[params.index(':')+1:]
+            except ValueError:
+                self.params_endpart = ""
+        else:
+            self.params = params
+            self.params_endpart = params_endpart
+
+
+def legacy_parse(message):
+    tmp = message.split(' ')
+    if message[0] == ":":
+        prefix = tmp[0]
+        cmd = tmp[1]
+        params = ' '.join(tmp[2:])
+    else:
+        prefix = ""
+        cmd = tmp[0]
+        params = ' '.join(tmp[1:])
+    return LegacyEvent(prefix=prefix, command=cmd, params=params)
+
+
+def legacy_use(event):
+    """what ChannelStore.add_event and the formatters did with an event"""
+    if event.command in ['JOIN', 'NICK', 'QUIT']:
+        target = event.params.split()[0][1:]
+    elif event.command in ['PRIVMSG', 'NOTICE', 'PART', 'MODE', 'KICK']:
+        target = event.params.split()[0]
+    elif event.command == '353':
+        target = event.params.split()[2]
+    elif event.command in ['366', '352']:
+        target = event.params.split()[1]
+    else:
+        target = ""
+    try:
+        nick = event.prefix[1:event.prefix.index('!')]
+    except ValueError:
+        nick = ""
+    return target, nick
+
+
+def new_use(event):
+    args = event.args
+    if event.command in ['JOIN', 'PRIVMSG', 'NOTICE', 'PART', 'MODE', 'KICK']:
+        target = args[0]
+    elif event.command == '353':
+        target = args[2]
+    elif event.command in ['366', '352']:
+        target = args[1]
+    else:
+        target = ""
+    return target, event.nick
+
+
+def main():
+    if len(sys.argv) > 1:
+        lines = [x.rstrip('\r\n') for x in open(sys.argv[1]) if x.strip()]
+    else:
+        lines = SAMPLE * 100
+    print "%d lines, per line:" % len(lines)
+
+    def run(parse, use=None):
+        if use:
+            for line in lines:
+                use(parse(line))
+        else:
+            for line in lines:
+                parse(line)
+
+    n = float(len(lines))
+    print "%-24s %14s %14s" % ("", "old", "parse_message")
+    print "%-24s %14s %14s" % ("parse",
+        usec(best_of(lambda: run(legacy_parse), number=10) / n),
+        usec(best_of(lambda: run(parse_message), number=10) / n))
+    print "%-24s %14s %14s" % ("parse + target and nick",
+        usec(best_of(lambda: run(legacy_parse, legacy_use), number=10) / n),
+        usec(best_of(lambda: run(parse_message, new_use), number=10) / n))
+
+if __name__ == '__main__':
+    main()
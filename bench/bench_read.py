@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+
+Measures the cost of reading a single 4 KB chunk from the middle of a
+store as the store history grows, comparing the offset indexed
+EventStore.read_contents to joining the whole contents and slicing, and
+the same with the columnar backend, which renders the lines when read.
+'''
+
+from common import best_of, usec
+import lib.events as events
+
+CHUNK = 4096
+SIZES = [1000, 10000, 100000, 500000]
+
+
+class ColumnarSettings:
+    """stands in for the handler, for the store to pick its backend"""
+    store_backend = events.ColumnarEventList
+
+
+def fill(stores, count):
+    for i in xrange(count):
+        e = events.Event(prefix=":nick%d!user@example.com" % (i % 50),
+                         command="PRIVMSG",
+                         params="#bench :message number %d with some "
+                                "text to make it look real" % i)
+        for store in stores:
+            store._add(e)
+
+
+def joined_read(store, offset, size):
+    contents = '\n'.join(store.get_contents()) + '\n'
+    return contents[offset:offset+size]
+
+
+def main():
+    print "%10s %12s %14s %14s %14s" % ("events", "bytes", "read_contents",
+                                         "join + slice", "columnar")
+    for count in SIZES:
+        store = events.PrivmsgStore(1, None, "#bench")
+        columnar = events.PrivmsgStore(2, ColumnarSettings(), "#bench")
+        fill([store, columnar], count)
+        size = store.get_size()
+        offset = size / 2
+        assert store.read_contents(offset, CHUNK) == \
+               joined_read(store, offset, CHUNK)
+        indexed = best_of(lambda: store.read_contents(offset, CHUNK),
+                          number=1000)
+        joined = best_of(lambda: joined_read(store, offset, CHUNK),
+                         repeat=3, number=max(1, 10000 / count))
+        assert columnar.read_contents(offset, CHUNK) == \
+               store.read_contents(offset, CHUNK)
+        rendered = best_of(lambda: columnar.read_contents(offset, CHUNK),
+                           number=100)
+        print "%10d %12d %14s %14s %14s" % (count, size, usec(indexed),
+                                             usec(joined), usec(rendered))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+
+Measures target lookups (Handler._get_privmsg_handlers) and query message
+dispatch with a growing number of open private message stores.
+'''
+
+from common import best_of, usec, make_handler
+
+QUERIES = [10, 1000, 5000]
+
+
+def main():
+    print "%-22s" % "open queries" + ''.join(["%14d" % x for x in QUERIES])
+    rows = ['lookup', 'lookup, other case', 'query PRIVMSG', 'new query']
+    results = {}
+    for count in QUERIES:
+        h = make_handler()
+        for i in range(count):
+            h.receive_message(":Nick%d!user@host PRIVMSG bench :hi" % i)
+        target = "Nick%d" % (count / 2)
+        line = ":%s!user@host PRIVMSG bench :hello" % target
+        results[('lookup', count)] = \
+            best_of(lambda: h._get_privmsg_handlers(target), number=1000)
+        results[('lookup, other case', count)] = \
+            best_of(lambda: h._get_privmsg_handlers(target.upper()),
+                    number=1000)
+        results[('query PRIVMSG', count)] = \
+            best_of(lambda: h.receive_message(line), number=1000)
+        new = iter(xrange(1000000))
+        results[('new query', count)] = \
+            best_of(lambda: h.receive_message(":New%d!u@h PRIVMSG bench :x" %
+                                              new.next()), number=100)
+
+    for name in rows:
+        print "%-22s" % name + \
+              ''.join(["%14s" % usec(results[(name, x)]) for x in QUERIES])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+
+Measures how long PyIrcFS.write takes to find out what part of a write to a
+channel file is new, as the channel history grows: an append at the end of
+the file, an editor saving the whole file with a line added to the end,
+"echo new > file" and a paste of 100 lines written over the file, comparing
+the offset based EventStore.match_contents to the old way of rendering the
+whole store and searching for it in the buffer.
+'''
+
+from common import best_of, usec
+from bench_read import fill
+import lib.events as events
+
+SIZES = [1000, 10000, 50000]
+
+
+def legacy_new_part(store, buf, offset):
+    """what PyIrcFS.write used to do, returns the part of buf sent"""
+    storecontents = '\n'.join(store.get_contents()) + '\n'
+    send_buf = buf
+    buf_index = buf.find(storecontents)
+    if len(storecontents) > 1 and buf_index == 0:
+        send_buf = buf[len(storecontents):]
+    elif len(storecontents) > 0 and buf_index == -1:
+        i = 0
+        while i != -1:
+            i = buf.find('\n', i) + 1
+            if buf[i:] in storecontents:
+                send_buf = buf[:i]
+                break
+    return send_buf
+
+
+def new_part(store, buf, offset):
+    """what PyIrcFS.write does now"""
+    unchanged = store.match_contents(buf, offset)
+    if unchanged:
+        return buf[unchanged:]
+    elif offset == 0:
+        return buf[:store.find_contents(buf)]
+    return buf
+
+
+def main():
+    print "%10s %-8s %14s %14s" % ("events", "write", "old", "by offset")
+    for count in SIZES:
+        store = events.EventStore(1, None)
+        fill([store], count)
+        size = store.get_size()
+        contents = store.read_contents(0, size)
+        paste = ''.join(["pasted line %d\n" % i for i in range(100)])
+        for name, buf, offset, sent in (
+                ("append", "hello\n", size, "hello\n"),
+                ("editor", contents + "hello\n", 0, "hello\n"),
+                ("echo >", "hello\n", 0, "hello\n"),
+                ("paste", paste, 0, paste)):
+            assert legacy_new_part(store, buf, offset) == \
+                   new_part(store, buf, offset) == sent
+            number = count < 10000 and 10 or 1
+            print "%10d %-8s %14s %14s" % (count, name,
+                usec(best_of(lambda: legacy_new_part(store, buf, offset),
+                             repeat=3, number=number)),
+                usec(best_of(lambda: new_part(store, buf, offset),
+                             repeat=3, number=number)))
+
+if __name__ == '__main__':
+    main()
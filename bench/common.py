@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+
+Helpers shared by the benchmark scripts. The scripts are meant to be run
+from the top level directory, e.g. python bench/bench_read.py
+'''
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def best_of(func, repeat=5, number=1):
+    """calls func number times in a row, repeat times, and returns the best
+    time per call in seconds"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for j in xrange(number):
+            func()
+        took = (time.time() - start) / number
+        if best is None or took < best:
+            best = took
+    return best
+
+
+def rss():
+    """resident set size in bytes, on Linux"""
+    return int(open('/proc/self/statm').read().split()[1]) * \
+           os.sysconf('SC_PAGE_SIZE')
+
+
+def usec(seconds):
+    return "%10.1f us" % (seconds * 1000000)
+
+
+class FakeConnection:
+    """stands in for lib.connection.Connection without a socket, just counts
+    the lines that would have been sent"""
+
+    def __init__(self):
+        import lib.connection as connection
+        self.out_queue = connection.SendQueue() # stays empty
+        self.sent = 0
+
+    def send(self, line, *args, **kwargs):
+        self.sent += 1
+
+    def close(self):
+        pass
+
+
+def make_handler(nickname='bench'):
+    """returns a Handler that believes it is connected and registered"""
+    import lib.handler as handler
+    h = handler.Handler()
+    h.connection = FakeConnection()
+    h.nickname = nickname
+    h.nicknames = [nickname]
+    h.username = nickname
+    h.realname = nickname
+    h.server = 'localhost'
+    h.port = 6667
+    h.connection_status = (10, 'benchmark')
+    return h
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+
+Times the hot functions one by one with synthetic inputs at several
+scales. The scale is the number of stores the handler and the filesystem
+have (receive_message, _get_privmsg_handlers, _search), the number of
+events in the store (get_contents), or the number of different inputs
+the function is called with in turn (the rest). Each function is timed as
+the best time per call out of a few rounds.
+
+With --save the results are written to a baseline file. Later runs
+compare to it and exit with status 1 if a function got slower by more
+than the threshold. Baselines depend on the machine, so make one on the
+machine you compare on, before the change to be measured.
+
+Usage: python bench/micro.py [options] [function ...]
+'''
+
+import sys, time, json, optparse, os
+from itertools import cycle
+
+from common import best_of, make_handler
+from lib.events import Event, PrivmsgStore, extract_modes, parse_message
+import pyircfs
+
+SCALES = [10, 1000, 100000]
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'micro_baseline.json')
+THRESHOLD = 0.25 # slower by more than this fails
+ROUND = 0.05 # seconds each of the rounds takes at least
+
+
+def mode_strings(n):
+    return cycle(["#chan%d +o%sv-b nick%d %sother%d *!*@host-%d" %
+                  (i, i % 2 and 'k' or '', i, i % 2 and 'key ' or '', i, i)
+                  for i in xrange(n)])
+
+
+def channel_events(n):
+    return [parse_message(":nick%d!~user@host-%d.example.com PRIVMSG #chan "
+                          ":message number %d, about this long" % (i % 500,
+                          i % 500, i)) for i in xrange(n)]
+
+
+def handler_with_channels(n, fs=False):
+    """returns a handler with n channel stores, and a PyIrcFS on it if
+    fs"""
+    h = make_handler()
+    if fs:
+        filesystem = pyircfs.PyIrcFS()
+        filesystem.handler = h
+        h.new_store_callbacks.append(filesystem._new_store)
+        h.rename_callbacks.append(filesystem._store_renamed)
+    for i in xrange(n):
+        # the way a message or a JOIN makes the store, without the JOIN
+        # going to every channel
+        h._get_privmsg_handlers("#chan%d" % i)
+    if fs:
+        return h, filesystem
+    return h
+
+
+def bench_extract_modes(n):
+    modes = mode_strings(n)
+    return lambda: extract_modes(modes.next())
+
+
+def bench_msg_formatter(n):
+    events = cycle(channel_events(n))
+    formatter = PrivmsgStore.msg_formatter
+    return lambda: formatter(events.next())
+
+
+def bench_event_init(n):
+    args = cycle([(":nick%d!~user@host-%d.example.com" % (i, i), 'PRIVMSG',
+                   "#chan%d :message %d" % (i, i)) for i in xrange(n)])
+    return lambda: Event(*args.next())
+
+
+def bench_receive_message(n):
+    h = handler_with_channels(n)
+    # messages to the channels in turn, about as many per channel
+    lines = cycle([":nick%d!~user@host.example.com PRIVMSG #chan%d :hello "
+                   "there, message %d" % (i % 500, i % n, i)
+                   for i in xrange(max(n, 1000))])
+    return lambda: h.receive_message(lines.next())
+
+
+def bench_get_privmsg_handlers(n):
+    h = handler_with_channels(n)
+    targets = cycle(["#CHAN%d" % i for i in xrange(n)])
+    return lambda: h._get_privmsg_handlers(targets.next())
+
+
+def bench_search(n):
+    h, fs = handler_with_channels(n, fs=True)
+    paths = cycle([["/#chan%d", "/info/#chan%d", "/names/#chan%d"][i % 3] %
+                   (i % n) for i in xrange(max(n, 1000))])
+    fs._search('/')
+    return lambda: fs._search(paths.next())
+
+
+def bench_search_new_table(n):
+    h, fs = handler_with_channels(n, fs=True)
+    def search():
+        fs._invalidate_paths()
+        fs._search('/#chan0')
+    return search
+
+
+def bench_get_contents(n):
+    store = PrivmsgStore(1, make_handler(), target='#chan', name='_#chan')
+    for event in channel_events(n):
+        store._add(event)
+    store.get_contents() # renders the lines
+    return store.get_contents
+
+
+BENCHMARKS = [
+    ('extract_modes', bench_extract_modes),
+    ('PrivmsgStore.msg_formatter', bench_msg_formatter),
+    ('Event.__init__', bench_event_init),
+    ('Handler.receive_message', bench_receive_message),
+    ('Handler._get_privmsg_handlers', bench_get_privmsg_handlers),
+    ('PyIrcFS._search', bench_search),
+    ('PyIrcFS._search, new table', bench_search_new_table),
+    ('EventStore.get_contents', bench_get_contents),
+]
+
+
+def measure(setup, scale, repeat):
+    func = setup(scale)
+    took = best_of(func, repeat=1)
+    number = max(1, int(ROUND / max(took, 0.000001)))
+    return best_of(func, repeat=repeat, number=number)
+
+
+def duration(seconds):
+    if seconds >= 0.001:
+        return "%9.2f ms" % (seconds * 1000)
+    return "%9.2f us" % (seconds * 1000000)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [function ...]")
+    parser.add_option('--scales', default=','.join(map(str, SCALES)),
+                      help="comma separated scales (default: %default)")
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help="rounds, the best one counts (default: %default)")
+    parser.add_option('-b', '--baseline', default=BASELINE,
+                      help="baseline file (default: bench/%s)" %
+                           os.path.basename(BASELINE))
+    parser.add_option('--save', action='store_true',
+                      help="save the results as the baseline")
+    parser.add_option('-t', '--threshold', type='float', default=THRESHOLD,
+                      help="how much slower than the baseline fails, 0.25 "
+                           "is 25% (default: %default)")
+    parser.add_option('-l', '--list', action='store_true',
+                      help="list the functions")
+    options, names = parser.parse_args()
+    if options.list:
+        print '\n'.join([x[0] for x in BENCHMARKS])
+        return
+    benchmarks = [x for x in BENCHMARKS if not names or x[0] in names]
+    for name in names:
+        if name not in [x[0] for x in BENCHMARKS]:
+            parser.error("unknown function %s, see --list" % name)
+    scales = [int(x) for x in options.scales.split(',')]
+
+    baseline = {}
+    if not options.save and os.path.exists(options.baseline):
+        baseline = json.load(open(options.baseline))['results']
+
+    results = {}
+    regressed = []
+    print "%-30s %7s %12s %12s %8s" % ('function', 'scale', 'per call',
+                                        'baseline', 'change')
+    for name, setup in benchmarks:
+        for scale in scales:
+            took = measure(setup, scale, options.repeat)
+            results.setdefault(name, {})[str(scale)] = took
+            before = baseline.get(name, {}).get(str(scale))
+            line = "%-30s %7d %12s" % (name, scale, duration(took))
+            if before:
+                change = took / before - 1
+                line += " %12s %+7.0f%%" % (duration(before), change * 100)
+                if change > options.threshold:
+                    line += " REGRESSED"
+                    regressed.append((name, scale, change))
+            print line
+            sys.stdout.flush()
+
+    if options.save:
+        # a partial run updates the baseline of the functions run only
+        saved = {}
+        if os.path.exists(options.baseline):
+            saved = json.load(open(options.baseline))['results']
+        for name, times in results.items():
+            saved.setdefault(name, {}).update(times)
+        f = open(options.baseline, 'w')
+        json.dump({'saved': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': sys.version.split()[0], 'results': saved}, f,
+                  indent=2, sort_keys=True)
+        f.close()
+        print "baseline saved to %s" % options.baseline
+    elif not baseline:
+        print "no baseline at %s to compare to, make one with --save" % \
+              options.baseline
+    if regressed:
+        print "\n%d regressed by more than %.0f%%:" % (len(regressed),
+                                                        options.threshold * 100)
+        for name, scale, change in regressed:
+            print "  %s at scale %d: %+.0f%%" % (name, scale, change * 100)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+
+Replays a trace of received lines (recorded with -o trace=FILE, see
+lib/trace.py) to a Handler without a socket, as fast as it can or at the
+speed the lines were received, and tells how long the dispatch and the
+stores took and how much memory they grew by. The lines are given to
+Handler.receive_messages in the batches they were received in, so a replay
+does the same work as the live mount did, only the sending is left out.
+With --profile the replay is run under cProfile.
+
+Usage: python bench/replay.py [options] trace
+'''
+
+import sys, time, optparse
+
+from common import make_handler, rss # puts the top level directory to sys.path
+import lib.events as events
+import lib.trace as trace
+
+
+def read_batches(path):
+    """returns the lines of a trace grouped to the batches they were
+    received in, as (seconds since the trace started, lines)"""
+    batches = []
+    last = None
+    for elapsed, line in trace.read_trace(path):
+        if elapsed != last:
+            batches.append((elapsed, []))
+            last = elapsed
+        batches[-1][1].append(line)
+    return batches
+
+
+def replay(h, batches, speed=0):
+    """gives batches to h, at speed times the recorded speed or as fast as
+    possible if speed is 0. Returns the seconds it took and how many
+    seconds at most a batch was late."""
+    receive = h.receive_messages
+    start = time.time()
+    late = 0.0
+    if not speed:
+        for elapsed, lines in batches:
+            receive(lines)
+    else:
+        for elapsed, lines in batches:
+            delay = start + elapsed / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                late = max(late, -delay)
+            receive(lines)
+    return time.time() - start, late
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] trace")
+    parser.add_option('-s', '--speed', type='float', default=0,
+                      help="times the recorded speed, 0 is as fast as "
+                           "possible (default: %default)")
+    parser.add_option('-r', '--repeat', type='int', default=1,
+                      help="replays, each to a new handler, the best one "
+                           "is told (default: %default)")
+    parser.add_option('--backend', default='list',
+                      help="store backend (default: %default)")
+    parser.add_option('--maxevents', type='int', default=0,
+                      help="events kept in memory per store (default: "
+                           "no limit)")
+    parser.add_option('--dispatch', action='store_true',
+                      help="time the dispatch of each command too")
+    parser.add_option('--profile', metavar='FILE',
+                      help="run under cProfile, save the stats to FILE and "
+                           "print the functions that took the most time")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("give the trace to replay")
+    if options.backend not in events.BACKENDS:
+        parser.error("unknown backend %s" % options.backend)
+
+    started, nickname = trace.read_header(args[0])
+    batches = read_batches(args[0])
+    if not batches:
+        parser.error("%s has no lines" % args[0])
+    count = sum([len(x[1]) for x in batches])
+    print "%s: %d lines in %d batches over %.1f s, recorded %s as %s" % \
+          (args[0], count, len(batches), batches[-1][0],
+           time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started)),
+           nickname or '?')
+
+    best = None
+    for i in range(options.repeat):
+        h = make_handler(nickname or 'replay')
+        h.store_backend = events.BACKENDS[options.backend]
+        h.store_maxsize = options.maxevents
+        h.metrics.enabled = options.dispatch
+        h._create_new_store(events.EventStore, replies=['*'],
+                            name="all_recv")
+        before = rss()
+        if options.profile:
+            import cProfile
+            profile = cProfile.Profile()
+            took, late = profile.runcall(replay, h, batches, options.speed)
+        else:
+            took, late = replay(h, batches, options.speed)
+        grew = rss() - before
+        if best is None or took < best[0]:
+            best = (took, late, grew, h)
+
+    took, late, grew, h = best
+    stores = h.all_stores.values()
+    print "replayed in %.2f s, %.0f lines/s, at most %.3f s late" % \
+          (took, count / took, late)
+    print "%d stores, %d events, memory grew by %.1f MB" % \
+          (len(stores), sum([x.get_event_count() for x in stores]),
+           grew / 1048576.0)
+    if options.dispatch:
+        print "\ndispatch latency per command:"
+        for command, histogram in sorted(h.metrics.dispatch.items()):
+            print "  %-10s %s" % (command, histogram.summary())
+    if options.profile:
+        import pstats
+        profile.dump_stats(options.profile)
+        print
+        pstats.Stats(options.profile).sort_stats('cumulative').print_stats(25)
+
+if __name__ == '__main__':
+    main()
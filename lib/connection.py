@@ -4,13 +4,269 @@ Created on 24.2.2009
 @author: Jaakko Lintula <jaakko.lintula@iki.fi>
 '''
 
-from threading import Thread
+from threading import Thread, Lock, Condition
 from select import select
-import random, time, socket
+from errno import EAGAIN, EWOULDBLOCK
+from collections import deque
+import random, time, socket, asyncore, os, fcntl
+from metrics import Metrics
+
+# send queue lanes, in the order of priority
+KEEPALIVE, INTERACTIVE, BULK = range(3)
+LANE_NAMES = ['keepalive', 'interactive', 'bulk']
+
+KEEPALIVE_COMMANDS = ['PING', 'PONG', 'QUIT']
+
+
+class SendQueue:
+    """Outgoing lines in priority lanes. Within a lane, lines are sent
+    per target in turns, so that a long paste to one channel doesn't hold
+    up everything else in the same lane.
+
+    push() always accepts a line, but writers that can wait ask for room
+    first: each target should have at most limit lines queued."""
+
+    limit = 100
+
+    def __init__(self):
+        self._lock = Condition(Lock()) # notified when lines are sent
+        self._lanes = [{} for x in LANE_NAMES]      # target -> deque of lines
+        self._turns = [deque() for x in LANE_NAMES] # targets with lines
+        self._counts = {} # target -> lines in all lanes
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def push(self, line, lane=None, target=None):
+        """adds a line to the queue. The lane and the target are found
+        out from the line if not given."""
+        words = line.split(' ', 2)
+        if lane is None:
+            if words[0].upper() in KEEPALIVE_COMMANDS:
+                lane = KEEPALIVE
+            else:
+                lane = INTERACTIVE
+        if target is None:
+            target = self.target(line)
+        with self._lock:
+            try:
+                self._lanes[lane][target].append(line)
+            except KeyError:
+                self._lanes[lane][target] = deque([line])
+                self._turns[lane].append(target)
+            self._counts[target] = self._counts.get(target, 0) + 1
+            self._len += 1
+
+    def target(line):
+        """returns the target push() queues line to by default, its first
+        parameter"""
+        words = line.split(' ', 2)
+        if len(words) > 1:
+            return words[1].strip().lstrip(':')
+        return ''
+    target = staticmethod(target)
+
+    def pop(self):
+        """removes and returns the next line to send"""
+        with self._lock:
+            for lane, turns in zip(self._lanes, self._turns):
+                if turns:
+                    target = turns.popleft()
+                    lines = lane[target]
+                    line = lines.popleft()
+                    if lines:
+                        turns.append(target)
+                    else:
+                        del lane[target]
+                    self._len -= 1
+                    self._counts[target] -= 1
+                    if not self._counts[target]:
+                        del self._counts[target]
+                    self._lock.notify_all()
+                    return line
+        raise IndexError("pop from an empty queue")
+
+    def room(self, target):
+        """returns how many lines may still be queued for target"""
+        return max(0, self.limit - self._counts.get(target, 0))
+
+    def wait_for_room(self, target, timeout=None):
+        """blocks until a line may be queued for target, or for timeout
+        seconds. Returns True if there is room."""
+        with self._lock:
+            if self._counts.get(target, 0) >= self.limit:
+                self._lock.wait(timeout)
+            return self._counts.get(target, 0) < self.limit
+
+    def peek(self):
+        """returns the line pop() would return, without removing it"""
+        with self._lock:
+            for lane, turns in zip(self._lanes, self._turns):
+                if turns:
+                    return lane[turns[0]][0]
+        raise IndexError("peek from an empty queue")
+
+    def pending(self):
+        """returns a list of (lane name, target, number of lines) tuples"""
+        with self._lock:
+            return [(LANE_NAMES[i], target, len(self._lanes[i][target]))
+                    for i in range(len(LANE_NAMES))
+                    for target in self._turns[i]]
+
+
+class TokenBucket:
+    """Flood control. A line may be sent when there are tokens left both
+    for one more line and for its bytes; the tokens are refilled at rate
+    lines and byterate bytes per second, up to burst lines and byteburst
+    bytes. A rate of 0 or less means no limit. After backoff() the rates
+    are halved (down to 1/8) and recovered by doubling them again every
+    recovery seconds. The connection thread sends while status() is read
+    from other threads, so the tokens are changed under a lock.
+
+    Anything with delay(length), consume(length), backoff() and status()
+    methods can be given to a Connection instead."""
+
+    def __init__(self, rate=0.5, burst=4, byterate=120, byteburst=1024,
+                 recovery=60):
+        self.rate = rate
+        self.burst = burst
+        self.byterate = byterate
+        self.byteburst = byteburst
+        self.recovery = recovery
+        self.factor = 1.0   # fraction of the rates currently in use
+        self._lines = burst
+        self._bytes = byteburst
+        self._stamp = time.time()
+        self._backoff_stamp = 0
+        self._lock = Lock()
+
+    def _refill(self):
+        """called with the lock held"""
+        now = time.time()
+        if self.factor < 1 and now - self._backoff_stamp > self.recovery:
+            self.factor = min(1.0, self.factor * 2)
+            self._backoff_stamp = now
+        elapsed = now - self._stamp
+        self._stamp = now
+        self._lines = min(self.burst,
+                          self._lines + elapsed * self.rate * self.factor)
+        self._bytes = min(self.byteburst,
+                          self._bytes + elapsed * self.byterate * self.factor)
+
+    def delay(self, length):
+        """returns how many seconds to wait before a line of length bytes
+        may be sent"""
+        with self._lock:
+            self._refill()
+            wait_lines = wait_bytes = 0
+            if self.rate > 0:
+                wait_lines = max(0, 1 - self._lines) / \
+                             (self.rate * self.factor)
+            if self.byterate > 0:
+                wait_bytes = max(0, min(length, self.byteburst) -
+                                 self._bytes) / (self.byterate * self.factor)
+        return max(wait_lines, wait_bytes)
+
+    def consume(self, length):
+        with self._lock:
+            self._refill()
+            self._lines -= 1
+            self._bytes -= length
+
+    def backoff(self):
+        """called when the server complains about flooding"""
+        with self._lock:
+            self._refill()
+            self.factor = max(0.125, self.factor / 2)
+            self._backoff_stamp = time.time()
+            self._lines = min(self._lines, 0)
+            self._bytes = min(self._bytes, 0)
+
+    def status(self):
+        with self._lock:
+            self._refill()
+            return "%.1f/%d lines, %d/%d bytes, refill %.2f lines/s and " \
+                   "%d bytes/s (%d%% of configured)" % \
+                   (self._lines, self.burst, self._bytes, self.byteburst,
+                    self.rate * self.factor, self.byterate * self.factor,
+                    self.factor * 100)
+
+
+class LineFramer:
+    """splits a byte stream to lines. Data is read with recv_into straight
+    to a reusable buffer, as much as there is room for, and the end of the
+    last complete line is searched for in place. Only the complete lines
+    are copied out, instead of every packet being copied for \r removal,
+    splitting and joining the incomplete line."""
+
+    min_read = 4096
+
+    def __init__(self, size=65536):
+        self.buffer = bytearray(size)
+        self._view = memoryview(self.buffer)
+        self.start = 0 # first byte not yet returned as a line
+        self.end = 0 # end of the received data
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _make_room(self, needed=1):
+        """moves the incomplete line to the beginning of the buffer, and if
+        that doesn't help, makes the buffer bigger"""
+        size = len(self.buffer)
+        del self._view # a buffer with exports can't be resized
+        if self.start:
+            # the incomplete line may overlap where it is moved to, del
+            # moves it with memmove
+            del self.buffer[:self.start]
+            self.start, self.end = 0, self.end - self.start
+        if size - self.end < needed:
+            size += max(size, needed)
+        self.buffer.extend(bytearray(size - len(self.buffer)))
+        self._view = memoryview(self.buffer)
+
+    def fill(self, sock):
+        """reads what fits to the buffer from sock, returns the number of
+        bytes read (0 at end of file)"""
+        if len(self.buffer) - self.end < self.min_read:
+            self._make_room(self.min_read)
+        count = sock.recv_into(self._view[self.end:])
+        self.end += count
+        return count
+
+    def feed(self, data):
+        """adds data to the buffer, for when it doesn't come from a socket"""
+        if len(self.buffer) - self.end < len(data):
+            self._make_room(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def lines(self):
+        """returns a list of the complete lines in the buffer without the
+        line endings and forgets them, empty lines are skipped"""
+        last = self.buffer.rfind('\n', self.start, self.end)
+        if last < 0:
+            return []
+        # all complete lines are copied out at once and split in C, a loop
+        # with a find per line would be slower than the copy it saves
+        lines = self._view[self.start:last].tobytes().splitlines()
+        if last + 1 == self.end:
+            self.start = self.end = 0
+        else:
+            self.start = last + 1
+        if '' in lines:
+            lines = filter(None, lines)
+        return lines
+
 
 class Connection(Thread):
     def __init__(self, server, port, message_callback=None,
-                 status_callback=None):
+                 status_callback=None, flood=None, batch_callback=None,
+                 metrics=None):
+        """@param batch_callback if given, called with a list of all the
+               lines received at once instead of message_callback for each
+           @param metrics a metrics.Metrics to count the lines in"""
         Thread.__init__(self)
         self.port = port
         self.server = server
@@ -18,9 +274,19 @@ class Connection(Thread):
         self.running = False
         self.message_callback = message_callback
         self.status_callback = status_callback
-        self.out_queue = []
-        self._since = time.time()
-        self.__old_data = ""
+        self.batch_callback = batch_callback
+        self.out_queue = SendQueue()
+        self.flood = flood or TokenBucket()
+        self.framer = LineFramer()
+        self.metrics = metrics or Metrics()
+        self._throttled_since = None # when flood control held a line back
+        self._closing = False
+        # the loop sleeps in select() until the server says something or
+        # a line may be sent, and a pipe wakes it up when there is
+        # something new to send. The pipe exists only while read_loop runs,
+        # so that a failed connect doesn't leave it open.
+        self._wakeup_lock = Lock()
+        self._wakeup_r = self._wakeup_w = None
 
     def __str__(self):
         return "%s!%s at %s:%s" % \
@@ -29,34 +295,70 @@ class Connection(Thread):
     def run(self):
         self.connect()
 
-    def send(self, line):
-        """adds lines to the send queue"""
+    def send(self, line, lane=None, target=None):
+        """adds lines to the send queue
+
+        @param lane one of KEEPALIVE, INTERACTIVE or BULK, by default PINGs,
+               PONGs and QUITs are keepalive and the rest interactive
+        @param target the queue to take turns with others, by default
+               the first parameter of the line"""
 
         if len(line) > 510:
             line = line[:510]
         if not line.endswith('\r\n'):
             line += '\r\n'
 
-        if not self.out_queue:
-            if self._since < time.time():
-                self._since = time.time()
-
-        if line.startswith('PONG') or line.startswith('PING') or line.startswith('QUIT'):
-            # PING replies get to the front
-            self.out_queue.insert(0, line)
-        else:
-            self.out_queue.append(line)
+        self.out_queue.push(line, lane, target)
+        self._wakeup()
 
     def close(self):
+        with self._wakeup_lock:
+            if self._wakeup_w is not None:
+                # the socket is closed by the loop thread, it may be in
+                # select()
+                self._closing = True
+                self._write_wakeup()
+                return
         self.running = False
         self.status_callback(100, "disconnected")
         self.socket.close()
 
+    def _open_wakeup(self):
+        r, w = os.pipe()
+        for fd in (r, w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) |
+                        os.O_NONBLOCK)
+        with self._wakeup_lock:
+            self._wakeup_r, self._wakeup_w = r, w
+
+    def _close_wakeup(self):
+        with self._wakeup_lock:
+            r, w = self._wakeup_r, self._wakeup_w
+            self._wakeup_r = self._wakeup_w = None
+        # AsyncConnection's dispatcher reads from a dup of r, closed with
+        # its map
+        os.close(r)
+        os.close(w)
+
+    def _write_wakeup(self):
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError: # the pipe is full, so a wakeup is pending anyway
+            pass
+
+    def _wakeup(self):
+        with self._wakeup_lock:
+            if self._wakeup_w is None:
+                # not looping, the queue is looked at when the loop starts
+                return
+            self._write_wakeup()
+
     def connect(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             self.socket.connect((self.server, self.port))
         except (IOError, socket.gaierror), (errno, msg):
+            self.socket.close()
             self.status_callback(103, msg)
         else:
             #self.socket.setblocking(False)
@@ -65,57 +367,78 @@ class Connection(Thread):
             self.read_loop()
 
 
-    def read_and_send(self, timeout):
-        s = select([self.socket], [], [], timeout)[0]
-        if s:
-            s = s[0]
-            try:
-                new_data = s.recv(2048).replace('\r', '') # we care only about
-                                                    # the \n, strip \r if any
-                if not new_data:
-                    self.status_callback(101, "Connection reset by peer")
-                    self.running = False
-                    self.socket.close()
+    def _flood_delay(self):
+        """returns how many seconds to wait before the next line in the
+        queue may be sent"""
+        try:
+            delay = self.flood.delay(len(self.out_queue.peek()))
+        except IndexError:
+            return 0
+        if delay and self._throttled_since is None:
+            self._throttled_since = time.time()
+        return delay
 
-                if not new_data.endswith('\n'): # last message wasn't complete
-                    t = new_data.split('\n')
-                    new_lines = t[:-1]
-                    #print "incomplete: %s " %( t[-1])
-                    if new_lines:
-                        if self.__old_data: # append  the old incomplete message to first in new data
-                            new_lines[0] = self.__old_data + new_lines[0]
-                            self.__old_data = t[-1] # the last line in new data must be saved
-                        else:
-                            self.__old_data = t[-1]
-                    else:
-                        self.__old_data += t[0] # still received nothing complete; append to the old old_data
-                else: # received completed messages
-                    new_lines = new_data.split('\n')[:-1] # last one is always empty after .split()
-                    new_lines[0] = self.__old_data + new_lines[0]
-                    self.__old_data = ""
+    def _flood_account(self, line):
+        self.flood.consume(len(line))
+        self.metrics.sent.add()
+        if self._throttled_since is not None:
+            self.metrics.add_flood_wait(time.time() - self._throttled_since)
+            self._throttled_since = None
+
+    def _receive(self):
+        """reads what is available from the socket and hands complete lines
+        to batch_callback or message_callback"""
+        try:
+            if not self.framer.fill(self.socket):
+                self.status_callback(101, "Connection reset by peer")
+                self.running = False
+                self.socket.close()
+                return
 
+            new_lines = self.framer.lines()
+            if not new_lines:
+                return
+            self.metrics.received.add(len(new_lines))
+            if self.batch_callback:
+                self.batch_callback(new_lines)
+            else:
                 for line in new_lines:
-                    #print "outgoing:", line
                     self.message_callback(line)
 
-            except socket.error, errno:
-                # error with transmission for some reason
+        except socket.error, errno:
+            if errno[0] in (EAGAIN, EWOULDBLOCK):
+                return
+            # error with transmission for some reason
 
-                self.status_callback(101, "Connection failure, errno %s" % errno)
-                self.running = False
-                self.socket.close()
+            self.status_callback(101, "Connection failure, errno %s" % errno)
+            self.running = False
+            self.socket.close()
 
+    def _timeout(self):
+        """how long select() may sleep: until flood prevention lets the
+        next line through, or forever"""
         if self.out_queue:
-            # try to send anything that's in out_queue unless magic
-            # flood prevention numbers tell not to (TODO make this better)
+            return self._flood_delay()
+        return None
+
+    def read_and_send(self, timeout):
+        s = select([self.socket, self._wakeup_r], [], [], timeout)[0]
+        if self._wakeup_r in s:
             try:
-                if (self._since < time.time() + 8):
-                    line = self.out_queue.pop(0)
-                    self.socket.sendall(line)
-                    self._since += 2.1 + len(line) / 120
-                #else:
-                    #print 'flood prevention triggered', self._since-time.time(), len(self.out_queue)
+                os.read(self._wakeup_r, 512)
+            except OSError:
+                pass
+        if self.socket in s:
+            self._receive()
 
+        if self.out_queue and self.running:
+            # try to send anything that's in out_queue unless flood
+            # prevention tells not to
+            try:
+                if not self._flood_delay():
+                    line = self.out_queue.pop()
+                    self.socket.sendall(line)
+                    self._flood_account(line)
 
             except socket.error, errno:
                 if not errno[0] == 11:
@@ -125,5 +448,111 @@ class Connection(Thread):
 
 
     def read_loop(self):
-        while self.running:
-            self.read_and_send(0.2)
+        self._open_wakeup()
+        try:
+            while self.running and not self._closing:
+                self.read_and_send(self._timeout())
+        finally:
+            self._close_wakeup()
+            if self._closing:
+                self.running = False
+                self.status_callback(100, "disconnected")
+                self.socket.close()
+
+
+class _SocketDispatcher(asyncore.dispatcher):
+    """asyncore side of AsyncConnection's server socket"""
+
+    def __init__(self, connection, map):
+        asyncore.dispatcher.__init__(self, connection.socket, map)
+        self.connection = connection
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return self.connection._wants_write()
+
+    def handle_read(self):
+        self.connection._receive()
+
+    def handle_write(self):
+        self.connection._write()
+
+    def handle_close(self):
+        self.connection._failed("Connection reset by peer")
+
+    def handle_error(self):
+        self.connection._failed("Connection failure")
+
+
+class _WakeupDispatcher(asyncore.file_dispatcher):
+    """the reading end of the pipe AsyncConnection uses to interrupt its
+    select() when there is something new to send"""
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(512)
+        except (OSError, IOError):
+            pass
+
+
+class AsyncConnection(Connection):
+    """Event driven alternative to Connection. The socket is waited on with
+    asyncore and write readiness is asked for only when there is something
+    that may be sent, so a slow server or a full socket buffer doesn't
+    block the loop while it sends, the way sendall() does in Connection.
+    Callbacks are the same as with Connection."""
+
+    def __init__(self, server, port, message_callback=None,
+                 status_callback=None, flood=None, batch_callback=None,
+                 metrics=None):
+        Connection.__init__(self, server, port, message_callback,
+                            status_callback, flood, batch_callback, metrics)
+        self._map = {}
+        self._outbuf = ""
+
+    def _failed(self, msg):
+        self.status_callback(101, msg)
+        self.running = False
+
+    def _wants_write(self):
+        return bool(self._outbuf) or \
+               bool(self.out_queue and not self._flood_delay())
+
+    def _write(self):
+        while self.out_queue and not self._flood_delay():
+            line = self.out_queue.pop()
+            self._outbuf += line
+            self._flood_account(line)
+        try:
+            sent = self.socket.send(self._outbuf)
+        except socket.error, errno:
+            if errno[0] in (EAGAIN, EWOULDBLOCK):
+                return
+            self._failed("Connection failure when sending")
+            return
+        self._outbuf = self._outbuf[sent:]
+
+    def _timeout(self):
+        if self._outbuf:
+            return None # waits for the socket to be writable
+        return Connection._timeout(self)
+
+    def read_loop(self):
+        self._open_wakeup()
+        _SocketDispatcher(self, self._map)
+        _WakeupDispatcher(self._wakeup_r, self._map)
+        try:
+            while self.running and not self._closing:
+                asyncore.loop(timeout=self._timeout(), use_poll=False,
+                              map=self._map, count=1)
+        finally:
+            asyncore.close_all(self._map)
+            self._close_wakeup()
+            if self._closing:
+                self.running = False
+                self.status_callback(100, "disconnected")
@@ -11,12 +11,22 @@ Stores both keep and store everything sent and received by them, as well as
 act on IRC commands / server responses they know of.
 '''
 
-import time
+import time, threading, tempfile, mmap, string, zlib
+from bisect import bisect_left, bisect_right
+from array import array
 
 # helper functions
 
+_last_timeformat = (None, "") # (second, formatted), events come in bursts
+
 def timeformat(mtime):
-    return time.strftime("[%H:%M:%S]", time.localtime(mtime))
+    global _last_timeformat
+    second = int(mtime)
+    last = _last_timeformat
+    if last[0] != second:
+        last = _last_timeformat = \
+               (second, time.strftime("[%H:%M:%S]", time.localtime(mtime)))
+    return last[1]
 
 def prefix2nick(prefix):
     try:
@@ -30,9 +40,52 @@ def prefix2hostmask(prefix):
     except ValueError:
         return ""
 
-def extract_modes(modestr):
+# translation tables for the CASEMAPPING values servers announce in
+# RPL_ISUPPORT, rfc1459 being the default
+CASEMAPS = {
+    'ascii': string.maketrans(string.ascii_uppercase,
+                              string.ascii_lowercase),
+    'rfc1459': string.maketrans(string.ascii_uppercase + '[]\\~',
+                                string.ascii_lowercase + '{}|^'),
+    'strict-rfc1459': string.maketrans(string.ascii_uppercase + '[]\\',
+                                       string.ascii_lowercase + '{}|'),
+}
+
+def irc_lower(name, casemapping='rfc1459'):
+    """lowercases a nick or channel name the way the server does it"""
+    return name.translate(CASEMAPS.get(casemapping, CASEMAPS['rfc1459']))
+
+# the modes of a channel member, kept as bits in Member.flags
+OP, VOICE, AWAY, HALFOP, ADMIN, OWNER = 1, 2, 4, 8, 16, 32
+MODE_FLAGS = {'o': OP, 'v': VOICE, 'h': HALFOP, 'a': ADMIN, 'q': OWNER}
+PREFIX_FLAGS = OP | VOICE | HALFOP | ADMIN | OWNER
+DEFAULT_PREFIX = '(ov)@+'
+
+_prefixes = {} # PREFIX value: parse_prefix result, servers send just one
+
+def parse_prefix(value):
+    """returns two dicts for a PREFIX value from RPL_ISUPPORT, e.g.
+    "(ov)@+": the channel modes and the nick prefixes to the member flags
+    they stand for"""
+    try:
+        return _prefixes[value]
+    except KeyError:
+        pass
+    modes = {}
+    prefixes = {}
+    if value.startswith('('):
+        letters, sep, chars = value[1:].partition(')')
+        for letter, char in zip(letters, chars):
+            modes[letter] = prefixes[char] = MODE_FLAGS.get(letter, 0)
+    _prefixes[value] = modes, prefixes
+    return modes, prefixes
 
-    modestr = modestr.split()
+def extract_modes(modestr):
+    """returns the modes in a MODE parameter string, e.g. "#chan +o-v nick
+    other" or the same split already, e.g. Event.args, as a list of
+    ('+o', 'nick') and ('-v', 'other') tuples"""
+    if isinstance(modestr, basestring):
+        modestr = modestr.split()
 
     paramflags = {'+': 'abehIkLloqv', # MODE + flags that need a parameter
                   '-': 'abehIoqv',    # MODE - flags that need a parameter
@@ -71,40 +124,164 @@ def splitparams(param):
 
 
 
-class Event:
+TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+def unescape_tag(value):
+    """unescapes an IRCv3 message tag value"""
+    if '\\' not in value:
+        return value
+    ret = []
+    i = 0
+    while i < len(value):
+        if value[i] == '\\':
+            i += 1
+            if i < len(value): # a lone backslash at the end is dropped
+                ret.append(TAG_ESCAPES.get(value[i], value[i]))
+        else:
+            ret.append(value[i])
+        i += 1
+    return ''.join(ret)
+
+def split_params(params):
+    """splits a parameter string to a tuple of the middle parameters and
+    the trailing parameter (None if there is none)"""
+    if params[:1] == ':':
+        return (), params[1:]
+    i = params.find(' :')
+    if i < 0:
+        return tuple(params.split()), None
+    return tuple(params[:i].split()), params[i+2:]
+
+def matching_lines(buf, old):
+    """returns the length of the part of buf, up to the end of a line, that
+    is the same as the beginning of old"""
+    matched = 0
+    while True:
+        end = buf.find('\n', matched) + 1
+        if not end or end > len(old) or buf[matched:end] != old[matched:end]:
+            return matched
+        matched = end
+
+def parse_message(line):
+    """parses a line received from the server to an Event in one go, e.g.
+    "@time=x :nick!user@host PRIVMSG #chan :hi there" has the tags
+    {'time': 'x'}, prefix ":nick!user@host", command "PRIVMSG", middle
+    parameters ('#chan',) and trailing parameter "hi there"."""
+    tags = None
+    if line[:1] == '@':
+        tagstr, sep, line = line[1:].partition(' ')
+        line = line.lstrip(' ')
+        tags = {}
+        for tag in tagstr.split(';'):
+            key, sep, value = tag.partition('=')
+            tags[key] = unescape_tag(value)
+    if line[:1] == ':':
+        prefix, sep, line = line.partition(' ')
+        line = line.lstrip(' ')
+    else:
+        prefix = ""
+    command, sep, params = line.partition(' ')
+    return Event(prefix, command, params, tags=tags)
+
+
+class Event(object):
     """Event contains all the information that a single message can
        contain.
 
        @param command the IRC command, e.g. in part message 'PART'
        @param params list of parameters, e.g. '#channel :I'm leaving'
-       @param params_endpart if specified, will contain everything
-              after the first colon (':') in params
+       @param params_endpart if specified, will contain the trailing
+              parameter, the one after ' :' in params
               will be automatically created if not specified
        @param generated True if the event didn't come from a server
        @param informational True if the event doesn't represent any
               exchange between the client and server (e.g. for
               "disconnected!" messages from the Handler)
+       @param tags dict of IRCv3 message tags, if any
+       @param timestamp when the event happened, by default now
+
+       The parameters are also split to middle (a tuple of the parameters
+       before the trailing one), trailing (None if there is none) and args
+       (all of them), and the prefix to nick, user, host and hostmask.
+       These are worked out only when first asked for, as most events
+       (PINGs, numerics in all_recv...) are only ever formatted as a whole.
     """
 
+    # there can be millions of these, so no __dict__
+    __slots__ = ('timestamp', 'command', 'params', 'prefix', 'generated',
+                 'informational', '_tags', '_endpart', '_split', '_source')
+
     def __init__(self, prefix, command, params="", params_endpart="",
-                 generated=False, informational=False):
-        #         raw_format=""):
-        self.timestamp = time.time()
-        self.command = command
+                 generated=False, informational=False, tags=None,
+                 timestamp=None):
+        self.timestamp = timestamp or time.time()
+        self.command = intern(command)
         self.params = params
         self.generated = generated
         self.informational = informational
-        self.prefix=prefix
-       # self.raw_format=""
-        if params and not params_endpart:
-            try:
-                self.params_endpart = params[params.index(':')+1:]
-            except ValueError:
-                self.params_endpart = ""
+        self.prefix = prefix
+        self._tags = tags
+        self._endpart = params_endpart
+        self._split = None  # (middle, trailing, args)
+        self._source = None # (nick, user, host)
+
+    def _split_params(self):
+        middle, trailing = split_params(self.params)
+        if trailing is None:
+            self._split = (middle, None, middle)
+        else:
+            self._split = (middle, trailing, middle + (trailing,))
+        return self._split
+
+    def _split_prefix(self):
+        # the nick is empty if the prefix is a server name, like with
+        # prefix2nick
+        prefix = self.prefix
+        bang = prefix.find('!')
+        if bang < 0:
+            self._source = ("", "", "")
         else:
-            self.params = params
-            self.params_endpart = params_endpart
+            at = prefix.find('@', bang)
+            if at < 0:
+                at = len(prefix)
+            self._source = (prefix[1:bang], prefix[bang+1:at], prefix[at+1:])
+        return self._source
+
+    def _get_tags(self):
+        return self._tags or {}
+    tags = property(_get_tags)
+
+    def _get_middle(self):
+        return (self._split or self._split_params())[0]
+    middle = property(_get_middle)
+
+    def _get_trailing(self):
+        return (self._split or self._split_params())[1]
+    trailing = property(_get_trailing)
+
+    def _get_args(self):
+        return (self._split or self._split_params())[2]
+    args = property(_get_args)
+
+    def _get_params_endpart(self):
+        return self._endpart or (self._split or self._split_params())[1] or ""
+    params_endpart = property(_get_params_endpart)
+
+    def _get_nick(self):
+        return (self._source or self._split_prefix())[0]
+    nick = property(_get_nick)
+
+    def _get_user(self):
+        return (self._source or self._split_prefix())[1]
+    user = property(_get_user)
 
+    def _get_host(self):
+        return (self._source or self._split_prefix())[2]
+    host = property(_get_host)
+
+    def _get_hostmask(self):
+        return prefix2hostmask(self.prefix)
+    hostmask = property(_get_hostmask)
 
     def __str__(self):
         """a crude way of transforming an Event to str if the EventStore doesn't implement anything else"""
@@ -131,44 +308,239 @@ class Event:
 
 
 
+class ColumnarEventList(object):
+    """A list of events kept in parallel arrays instead of Event objects:
+    timestamps, command codes, indexes to a table of prefixes, flags, and
+    the params packed to one byte string. Supports what EventStore does
+    with its event list: append, len, indexing (a new Event is made from
+    the columns each time) and removing the oldest events with
+    del events[:count]."""
+
+    def __init__(self):
+        self.timestamps = array('d')
+        self.commands = array('B')
+        self.prefixes = array('L')
+        self.flags = array('B') # 1 = generated, 2 = informational
+        self.param_ends = array('L')
+        self.params = bytearray()
+        self.tags = {}  # absolute index -> tags, for the events that have them
+        self._base = 0  # bytes removed from the beginning of params
+        self._removed = 0 # events removed from the beginning
+        self._command_table = []
+        self._command_codes = {}
+        self._prefix_table = []
+        self._prefix_codes = {}
+
+    def __len__(self):
+        # param_ends is appended to last, so that an event counts only
+        # once all of its columns are there for readers in other threads
+        return len(self.param_ends)
+
+    def append(self, event):
+        code = self._command_codes.get(event.command)
+        if code is None:
+            code = self._command_codes[event.command] = len(self._command_table)
+            self._command_table.append(event.command)
+            if code == 256: # more than a byte can tell apart
+                self.commands = array('H', self.commands)
+        prefix = self._prefix_codes.get(event.prefix)
+        if prefix is None:
+            prefix = self._prefix_codes[event.prefix] = len(self._prefix_table)
+            self._prefix_table.append(event.prefix)
+
+        self.timestamps.append(event.timestamp)
+        self.commands.append(code)
+        self.prefixes.append(prefix)
+        self.flags.append((event.generated and 1) | (event.informational and 2))
+        self.params.extend(event.params)
+        if event._tags:
+            self.tags[self._removed + len(self.param_ends)] = event._tags
+        self.param_ends.append(self._base + len(self.params))
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.param_ends)
+        if not 0 <= i < len(self.param_ends):
+            raise IndexError("event index out of range")
+        end = self.param_ends[i] - self._base
+        start = i and self.param_ends[i-1] - self._base
+        flags = self.flags[i]
+        return Event(self._prefix_table[self.prefixes[i]],
+                     self._command_table[self.commands[i]],
+                     str(self.params[start:end]), generated=bool(flags & 1),
+                     informational=bool(flags & 2),
+                     tags=self.tags.get(self._removed + i),
+                     timestamp=self.timestamps[i])
+
+    def __delitem__(self, index):
+        if not isinstance(index, slice) or index.start or index.step:
+            raise TypeError("only the oldest events can be removed")
+        count = min(len(self.timestamps), index.stop is None and
+                    len(self.timestamps) or index.stop)
+        if count <= 0:
+            return
+        cut = self.param_ends[count-1] - self._base
+        del self.params[:cut]
+        self._base += cut
+        for column in (self.timestamps, self.commands, self.prefixes,
+                       self.flags, self.param_ends):
+            del column[:count]
+        self._removed += count
+        for i in [x for x in self.tags if x < self._removed]:
+            del self.tags[i]
+
+
+# the ways EventStores can keep their events, for Handler.store_backend
+BACKENDS = {'list': list, 'columnar': ColumnarEventList}
+
+
 class EventStore:
-    def __init__(self, id, handler=None, name="", maxsize=0):
+    def __init__(self, id, handler=None, name="", maxsize=0, backend=None):
         """Initializes the EventStore object
 
            @param id an unique id number for the store
            @param handler a reference to the handler, if needed
            @name a name for the store, _should_ be unique
+           @param maxsize how many of the newest events to keep in memory,
+                  older ones are rendered to a segment file on disk. If 0,
+                  the handler's store_maxsize is used (0 means no limit)
+           @param backend the class of the event list, list or
+                  ColumnarEventList, by default the handler's store_backend.
+                  Rendered lines are kept in memory only with a list, with
+                  the columnar one they are rendered again when read.
         """
         self.id = id
         self.handler = handler
         self.name = name
-        self._eventlist = []
-
-        self._maxsize = 0
-        self._cached_contents = []
+        if backend is None:
+            backend = getattr(handler, 'store_backend', list)
+        self._eventlist = backend()
+
+        if not maxsize:
+            maxsize = getattr(handler, 'store_maxsize', 0)
+        self._maxsize = maxsize
+        if backend is list:
+            self._cached_contents = []
+        else:
+            self._cached_contents = None
+        self._offsets = array('L')  # byte offset of each rendered line
+        # crc32 of the contents before each rendered line and of all of them,
+        # so that rewritten contents can be recognised without rendering
+        self._crcs = array('I')
+        self._cached_crc = 0
         self._lastlen = 0
         self._cached_size = 0
+        self._cache_lock = threading.Lock()
+        self._ctime = None
+
+        # events that didn't fit in memory live in the segment file, already
+        # rendered; they are always the first _spilled_size bytes of the file
+        self._segment = None
+        self._segment_map = None
+        self._spilled_size = 0
+        self._spilled_count = 0
+        self._spilled_crc = 0
 
         self.update_callbacks = []
         self.remove_callbacks = []
 
 
-    def _add(self, event):
+    def _append(self, event):
+        """appends an event to the event list without notifying anyone"""
+        if self._ctime is None:
+            self._ctime = event.timestamp
         self._eventlist.append(event)
+        if self._maxsize and len(self._eventlist) > self._maxsize:
+            self._spill(len(self._eventlist) - self._maxsize + self._maxsize / 4)
+
+    def _add(self, event):
+        self._append(event)
         [x(self) for x in self.update_callbacks]
 
     def get_ctime(self):
-        if self._eventlist:
-            return self._eventlist[0].timestamp
+        if self._ctime is not None:
+            return self._ctime
         else:
             return time.time()
 
-    def get_size(self):
+    def get_event_count(self):
+        return self._spilled_count + len(self._eventlist)
+
+    def _render_new(self):
+        """renders the events added since the last call and appends them to
+        the cached lines, the byte offset index and the running size. Must be
+        called with _cache_lock held."""
+        count = len(self._eventlist)
+        size = self._cached_size
+        crc = self._cached_crc
+        for i in xrange(self._lastlen, count):
+            line = self.msg_formatter(self._eventlist[i])
+            if self._cached_contents is not None:
+                self._cached_contents.append(line)
+            self._offsets.append(size)
+            self._crcs.append(crc)
+            size += len(line) + 1
+            crc = zlib.crc32('\n', zlib.crc32(line, crc)) & 0xffffffff
+        self._cached_size = size
+        self._cached_crc = crc
+        self._lastlen = count
+
+    def _lines(self, first, last):
+        """returns the rendered lines of the events first..last-1 in
+        memory. Must be called with _cache_lock held, after _render_new."""
+        if self._cached_contents is not None:
+            return self._cached_contents[first:last]
+        return [self.msg_formatter(self._eventlist[i])
+                for i in xrange(first, last)]
+
+    def _update_cache(self):
         if len(self._eventlist) == self._lastlen:
-            return self._cached_size
-        contents = [self.msg_formatter(event) for event in self._eventlist]
-        self._cached_size = sum([len(x)+1 for x in contents])
-        self._cached_contents = contents
+            return
+        with self._cache_lock:
+            self._render_new()
+
+    def _spill(self, count):
+        """moves the oldest count events out of memory, appending their
+        rendered lines to the segment file"""
+        with self._cache_lock:
+            self._render_new()
+            count = min(count, len(self._eventlist))
+            if count <= 0:
+                return
+            data = '\n'.join(self._lines(0, count)) + '\n'
+            if self._segment is None:
+                self._segment = tempfile.TemporaryFile(prefix='pyircfs-',
+                    dir=getattr(self.handler, 'spool_dir', None))
+            self._segment.seek(self._spilled_size)
+            self._segment.write(data)
+            self._segment.flush()
+            # offsets stay absolute, so nothing already read by anyone moves
+            del self._eventlist[:count]
+            if self._cached_contents is not None:
+                del self._cached_contents[:count]
+            if count < len(self._crcs):
+                self._spilled_crc = self._crcs[count]
+            else:
+                self._spilled_crc = self._cached_crc
+            del self._offsets[:count]
+            del self._crcs[:count]
+            self._lastlen -= count
+            self._spilled_count += count
+            self._spilled_size += len(data)
+
+    def _read_segment(self, offset, size):
+        """returns bytes from the spilled part of the contents"""
+        segment_map = self._segment_map
+        if segment_map is None or len(segment_map) < offset + size:
+            # the segment has grown since it was mapped, readers still
+            # holding the old map can keep on using it
+            segment_map = mmap.mmap(self._segment.fileno(), self._spilled_size,
+                                    access=mmap.ACCESS_READ)
+            self._segment_map = segment_map
+        return segment_map[offset:offset+size]
+
+    def get_size(self):
+        self._update_cache()
         return self._cached_size
 
 
@@ -193,18 +565,127 @@ class EventStore:
     def remove(self):
         """called when the store is removed"""
         [x(self) for x in self.remove_callbacks]
+        if self._segment is not None:
+            self._segment_map = None
+            self._segment.close()
 
     def get_contents(self, offset=0):
-        if len(self._eventlist) == self._lastlen:
-            return self._cached_contents[offset:]
-        contents = [self.msg_formatter(x) for x in self._eventlist]
-        self._lastlen = len(self._eventlist)
-        self._cached_contents = contents
-        self._cached_size = sum([len(x)+1 for x in contents])
+        with self._cache_lock:
+            self._render_new()
+            contents = self._lines(0, len(self._eventlist))
+            spilled = self._spilled_size
+        if spilled:
+            contents = self._read_segment(0, spilled).split('\n')[:-1] + \
+                       contents
         return contents[offset:]
 
+    def read_contents(self, offset, size):
+        """returns (at most) size bytes of the store contents as they appear
+        in a file, starting from byte offset. Only the lines overlapping the
+        requested range are joined together."""
+        with self._cache_lock:
+            self._render_new()
+            if size <= 0 or offset >= self._cached_size:
+                return ""
+            buf = ""
+            if offset < self._spilled_size:
+                buf = self._read_segment(offset,
+                                         min(size, self._spilled_size - offset))
+                offset += len(buf)
+                size -= len(buf)
+                if not size or not self._offsets:
+                    return buf
+            first = bisect_right(self._offsets, offset) - 1
+            last = bisect_left(self._offsets, offset + size, first)
+            start = offset - self._offsets[first]
+            chunk = '\n'.join(self._lines(first, last)) + '\n'
+        return buf + chunk[start:start+size]
+
+    def match_contents(self, buf, offset):
+        """returns how much of buf, up to the end of a line, is the same as
+        the contents starting from byte offset, i.e. what a rewrite of the
+        file at offset doesn't change. Whole lines in memory are compared by
+        the crc32 of the contents up to their end, so they aren't rendered
+        again; the spilled part and a line that started before offset are
+        compared as they are."""
+        with self._cache_lock:
+            self._render_new()
+            end = min(self._cached_size, offset + len(buf))
+            if offset >= end:
+                return 0
+            offsets = self._offsets
+            if offset < self._spilled_size:
+                first = 0
+                stop = min(end, self._spilled_size)
+                old = self._read_segment(offset, stop - offset)
+                crc = self._spilled_crc
+            else:
+                first = bisect_right(offsets, offset) - 1
+                if offsets[first] == offset:
+                    stop = offset
+                    old = ""
+                    crc = self._crcs[first]
+                else:
+                    start = offset - offsets[first]
+                    first += 1
+                    if first < len(offsets):
+                        stop, crc = offsets[first], self._crcs[first]
+                    else:
+                        stop, crc = self._cached_size, self._cached_crc
+                    old = self._lines(first - 1, first)[0][start:] + '\n'
+                    stop = min(stop, end)
+                    old = old[:stop - offset]
+            matched = matching_lines(buf, old)
+            if matched < len(old) or stop == end:
+                return matched
+            # buf is at the start of line first from here on. Usually all
+            # of it is unchanged, which is checked in one go against the
+            # last line boundary it covers, otherwise line by line
+            last = bisect_right(offsets, end, first) - 1
+            if end == self._cached_size:
+                boundary, boundary_crc = end, self._cached_crc
+            elif last > first:
+                boundary, boundary_crc = offsets[last], self._crcs[last]
+            else:
+                boundary = None
+            if boundary is not None and buf[boundary - offset - 1] == '\n' and \
+            zlib.crc32(buf[matched:boundary - offset], crc) & 0xffffffff == \
+            boundary_crc:
+                return boundary - offset
+            pos = matched
+            while first < len(offsets):
+                if first + 1 < len(offsets):
+                    boundary, boundary_crc = offsets[first + 1], self._crcs[first + 1]
+                else:
+                    boundary, boundary_crc = self._cached_size, self._cached_crc
+                line_end = buf.find('\n', pos) + 1
+                if not line_end or offset + line_end != boundary:
+                    break
+                crc = zlib.crc32(buf[pos:line_end], crc) & 0xffffffff
+                if crc != boundary_crc:
+                    break
+                matched = pos = line_end
+                first += 1
+            return matched
+
+    def find_contents(self, buf):
+        """returns where the contents start in buf when it ends with them,
+        otherwise len(buf). Only the lines of buf that are the same as the
+        first line of the contents are tried."""
+        first = self.read_contents(0, len(buf)).split('\n', 1)[0] + '\n'
+        if len(first) < 2:
+            return len(buf)
+        i = buf.find(first, 1)
+        while i != -1:
+            if buf[i-1] == '\n' and \
+            self.match_contents(buf[i:], 0) == len(buf) - i:
+                return i
+            i = buf.find(first, i + 1)
+        return len(buf)
+
     def __str__(self):
-        return "id: %s, name: %s, %d events" % (self.id, self.name, len(self._eventlist))
+        return "id: %s, name: %s, %d events" % (self.id, self.name,
+                                                 self.get_event_count())
 
 class PingES(EventStore):
     reply_handlers = ["PING"]
@@ -220,10 +701,10 @@ class PingES(EventStore):
             #reply = Event(prefix="", command="PONG", params=event.params[1:], generated=True)
             #self._eventlist.append(reply)
             #return [reply.irc_format()]
-            self.handler.send_command('PONG', event.params[1:])
+            self.handler.send_command('PONG', ' '.join(event.args))
     def generate_event(self, cmd, params):
         e = Event(prefix="", command=cmd, params=params, generated=True)
-        self._eventlist.append(e)
+        self._append(e)
         return [e.irc_format()]
 
 class QuitES(EventStore):
@@ -264,7 +745,7 @@ class JoinES(EventStore):
     def generate_event(self, cmd, params):
         params = params[:50] # TODO implement server CHANNELLEN support
         e = Event(prefix="", command=cmd, params=params, generated=True)
-        self._eventlist.append(e)
+        self._append(e)
         return [e.irc_format()]
 
 class UserES(EventStore):
@@ -295,14 +776,21 @@ class ErrorES(EventStore):
     # the RFC says messages from 400 to 599 are error messages
     # not everything is in use, but we just get all of them
 
-    reply_handlers = ['ERROR'] + [str(x) for x in range(400, 600)]
+    reply_handlers = ['ERROR', '263'] + [str(x) for x in range(400, 600)]
     command_handlers = []
 
+    # RPL_TRYAGAIN, ERR_TARGETTOOFAST: the server is throttling us
+    throttle_replies = ['263', '439']
+
     def __init__(self, id, handler, name='errors'):
         EventStore.__init__(self, id, handler, name)
 
     def add_event(self, event):
         self._add(event)
+        if event.command in self.throttle_replies or \
+        (event.command == 'ERROR' and 'flood' in event.params.lower()):
+            # e.g. "ERROR :Closing Link: ... (Excess Flood)"
+            self.handler.flood_control.backoff()
         if event.command == 'ERROR' and ":Closing Link:" in event.params:
             if self.handler.connection_status[0] in (1, 10):
                 self.handler.connection.close()
@@ -324,7 +812,7 @@ class WhoisES(EventStore):
         EventStore.__init__(self, id, handler, name)
 
     def msg_formatter(event):
-        p = event.params.split()
+        p = event.args
         ep = event.params_endpart
         ts = timeformat(event.timestamp)
         if event.command == "311":
@@ -370,18 +858,18 @@ class NickES(EventStore):
     def add_event(self, event):
         self._add(event)
         if event.command in ['433', '437']: # handle nick in use scenario
-            triednick = event.params.split()[1]
+            triednick = event.args[1]
             if not self.handler.nicknames.index(triednick) + 1 == len(self.handler.nicknames):
                 nextnick = self.handler.nicknames[self.handler.nicknames.index(triednick) + 1]
                 self.handler.send_command('NICK', nextnick)
             else:
                 self.handler.receive_status(104, 'all nicknames in use')
         elif event.command == '001':
-            self.handler.nickname = event.params.split()[0]
+            self.handler.nickname = event.args[0]
             self.handler.receive_status(10, 'connected normally')
         elif event.command == 'NICK':
-            if prefix2nick(event.prefix) == self.handler.nickname:
-                newnick = event.params[1:]
+            if event.nick == self.handler.nickname:
+                newnick = event.args[0]
                 self.handler.nickname = newnick
 
 class WhoES(EventStore):
@@ -391,6 +879,29 @@ class WhoES(EventStore):
     def __init__(self, id, handler, name='who'):
         EventStore.__init__(self, id, handler, name)
 
+class IsupportES(EventStore):
+    """Keeps the features the server announces in RPL_ISUPPORT in the
+    handler's isupport dict"""
+    reply_handlers = ['005'] # RPL_ISUPPORT
+    command_handlers = []
+
+    def __init__(self, id, handler, name='isupport'):
+        EventStore.__init__(self, id, handler, name)
+
+    def add_event(self, event):
+        self._add(event)
+        # the first parameter is our nick, the trailing one is "are supported
+        # by this server"
+        tokens = event.middle[1:]
+        for token in tokens:
+            if token.startswith('-'):
+                self.handler.isupport.pop(token[1:], None)
+                continue
+            key, sep, value = token.partition('=')
+            self.handler.isupport[key] = value
+            if key == 'CASEMAPPING':
+                self.handler.set_casemapping(value.lower())
+
 class RawES(EventStore):
     """A special class that sends parameters to the server as is"""
     reply_handlers = []
@@ -404,14 +915,17 @@ class RawES(EventStore):
         command = params[0]
         params = ' '.join(params[1:])
         e = Event(prefix="", command=command, params=params, generated=True)
-        self._eventlist.append(e)
+        self._append(e)
         return [e.irc_format()]
 
 
 class PrivmsgStore(EventStore):
     """A store for private messages. Target is specified when creating the object"""
-    reply_handlers = ["NICK"]
+    reply_handlers = []
     command_handlers = []
+    # replies about a nick that the handler sends only to the query with
+    # the nick and the channels it is on, see Handler.get_member_stores
+    member_handlers = ["NICK"]
 
     def __init__(self, id, handler, target, name=""):
         EventStore.__init__(self, id, handler, name)
@@ -419,7 +933,7 @@ class PrivmsgStore(EventStore):
 
     def __str__(self):
         return "target: %s, id: %s, name: %s, %d events" % (self.target, \
-                self.id, self.name, len(self._eventlist))
+                self.id, self.name, self.get_event_count())
 
 
     def _ctcphandler(self, event):
@@ -437,8 +951,9 @@ class PrivmsgStore(EventStore):
 
     def add_event(self, event):
         # only add messages that are targeted to us
+        casefold = self.handler.casefold
         if event.command in ['PRIVMSG', 'NOTICE'] and \
-        prefix2nick(event.prefix).lower() == self.target.lower():
+        casefold(event.nick) == casefold(self.target):
             self._add(event)
 
             if event.params_endpart and event.params_endpart[0] == '\001' \
@@ -449,26 +964,26 @@ class PrivmsgStore(EventStore):
                     self.handler.send_notice(self.target, msg)
 
 
-        elif event.command == 'NICK' and prefix2nick(event.prefix) == \
-        self.target:
-            self.target = event.params[1:]
+        elif event.command == 'NICK' and \
+        casefold(event.nick) == casefold(self.target):
+            self.handler.rename_privmsg_store(self, event.args[0])
             self._add(event)
 
     def msg_formatter(event):
         ts = timeformat(event.timestamp)
-        nick = prefix2nick(event.prefix)
-        hostmask = prefix2hostmask(event.prefix)
+        nick = event.nick
+        hostmask = event.hostmask
 
         if event.command == 'PRIVMSG':
-            if event.params_endpart and event.params_endpart[0] == '\001' \
-            and event.params_endpart[-1] == '\001':      # a CTCP query
-                query = event.params_endpart[1:-1]
+            text = event.params_endpart
+            if text and text[0] == '\001' and text[-1] == '\001': # a CTCP query
+                query = text[1:-1]
                 if query.startswith('ACTION'): # /me something
                     return '%s * %s %s' % (ts, nick, ' '.join(query.split(' ')[1:]))
                 return '%s CTCP %s query received from %s' % \
                            (ts, query, nick)
             else:
-                return '%s <%s> %s' % (ts, nick, event.params_endpart)
+                return '%s <%s> %s' % (ts, nick, text)
         elif event.command == 'JOIN':
             if event.generated:
                 return " -> JOIN"
@@ -477,10 +992,10 @@ class PrivmsgStore(EventStore):
                    (ts, nick, hostmask, event.params_endpart)
         elif event.command == 'PART':
             return "%s %s (%s) has left %s (%s)" % \
-                   (ts, nick, hostmask, event.params.split()[0], event.params_endpart)
+                   (ts, nick, hostmask, event.args[0], event.params_endpart)
         elif event.command == 'KICK':
             return "%s %s (%s) was kicked from %s (%s)" % \
-                   (ts, nick, hostmask, event.params.split()[0], event.params_endpart)
+                   (ts, nick, hostmask, event.args[0], event.params_endpart)
 
         elif event.command == 'QUIT':
             return "%s %s (%s) quit (%s)" % \
@@ -503,12 +1018,52 @@ class PrivmsgStore(EventStore):
         return ["%s %s :%s" % (type, self.target, message)]
 
 
+class Member(object):
+    """What is known of a nick on a channel, from JOIN, NAMES and WHO. The
+    modes of the member and whether it is away are bits in flags."""
+    __slots__ = ('flags', 'hostmask', 'username', 'realname', 'hostname',
+                 'server', 'hopcount')
+
+    def __init__(self, flags=0, hostmask=None):
+        self.flags = flags
+        self.hostmask = hostmask
+        self.username = None
+        self.realname = None
+        self.hostname = None
+        self.server = None
+        self.hopcount = None
+
+    def _get_op(self):
+        return bool(self.flags & OP)
+    op = property(_get_op)
+
+    def _get_voice(self):
+        return bool(self.flags & VOICE)
+    voice = property(_get_voice)
+
+    def _get_away(self):
+        return bool(self.flags & AWAY)
+    away = property(_get_away)
+
+    def items(self):
+        """returns (name, value) pairs of what is known"""
+        ret = [(x, getattr(self, x)) for x in self.__slots__[1:]
+               if getattr(self, x) is not None]
+        return ret + [('away', self.away), ('voice', self.voice),
+                      ('op', self.op)]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
 class ChannelStore(PrivmsgStore):
     """A store for messages in an IRC channel. Keeps list of people
     in channel, their flags, etc"""
-    reply_handlers = ["NICK", "JOIN", "PART", "QUIT", "KICK", "MODE",
-                      "353", "332","404", '352', '324', '332', '367',
-                      "471", "473", "474", "475"] # names
+    # the replies about a channel aren't offered to every channel store,
+    # the handler gives them to the store of the channel they are about, see
+    # channel_handlers
+    reply_handlers = []
+    member_handlers = ["NICK", "QUIT"]
 
     def __init__(self, id, handler, target, name="", joined=False):
         PrivmsgStore.__init__(self, id, handler, target, name)
@@ -526,139 +1081,204 @@ class ChannelStore(PrivmsgStore):
 
     def remove(self):
         self.handler.send_command('PART', self.target)
+        self._clear_members()
         EventStore.remove(self)
 
-    def add_event(self, event):
+    def _add_member(self, nick, member):
+        self.nicknames[nick] = member
+        self.handler.add_member(self, nick)
 
-        # where's the target channel in the message?
-        if event.command in ['JOIN', 'NICK', 'QUIT']:
-            target = event.params.split()[0][1:]
-        elif event.command in ['PRIVMSG', 'NOTICE', 'PART', 'MODE', 'KICK']:
-            target = event.params.split()[0]
-        elif event.command in ['353']:
-            target = event.params.split()[2]
-        elif event.command in ['366', '404', '475', '473', '474', '471', '352', '324',
-                               '332', '367']:
-            target = event.params.split()[1]
-        else:
-            target = ""
-        #print "we got the part msg! %s", event
-
-        clear_send_queue = False
-        add = True
-
-        if target.lower() == self.target.lower():
-
-            if event.command == 'JOIN':
-                if not self.joined: # and prefix2nick(event.prefix) == self.handler.nickname:
-                    # when joined, mark the send queue to be cleared
-                    self.joined = True
-                    self.join_sent = False
-                    clear_send_queue = True
-
-                # add the nick to the list
-                self.nicknames[prefix2nick(event.prefix)] = \
-                    {'hostmask': event.prefix[event.prefix.index('!')+1:]}
-
-
-            elif event.command in ['471', '473', '474', '475']: #
-                # in case of "Cannot join channel" errors,
-                # stop waiting for a JOIN, empty the send queue
-                self.join_sent = False
-                self.send_queue = []
-
-            elif event.command == '353': # RPL_NAMREPLY
-                add = False
-                for nick in event.params_endpart.split():
-                    if not nick.strip('+@') in self.nicknames:
-                        self.nicknames[nick.strip('+@')] = {}
-
-                    self.nicknames[nick.strip('+@')]['op'] = '@' in nick
-                    self.nicknames[nick.strip('+@')]['voice'] = '+' in nick
-
-            elif event.command == '352': # RPL_WHOREPLY
-                add = False
-                params = event.params.split()
-                nick = params[5]
-                if not nick in self.nicknames:
-                    self.nicknames[nick] = {}
-
-                self.nicknames[nick]['username'] = params[2]
-                self.nicknames[nick]['hostname'] = params[3]
-                self.nicknames[nick]['server'] = params[4]
-                self.nicknames[nick]['op'] = '@' in params[6]
-                self.nicknames[nick]['voice'] = '+' in params[6]
-                self.nicknames[nick]['away'] = 'G' in params[6]
-                self.nicknames[nick]['hopcount'] = params[7].strip(':')
-                self.nicknames[nick]['realname'] = ' '.join(params[9:])
-
-
-            elif event.command == "PART":
-                if prefix2nick(event.prefix) == self.handler.nickname:
-                    self.joined = False  # we parted
-                    self.nicknames = {}
-                else:
-                    self.nicknames.pop(prefix2nick(event.prefix))
-
-            elif event.command == "MODE":
-                modes = extract_modes(event.params)
-                for mode in modes:
-                    if len(mode) > 1: # has a parameter in addition to flag
-                        # sometimes (after netsplits) MODEs come before JOINs;
-                        if not mode[1] in self.nicknames:
-                            self.nicknames[mode[1]] = {}
-                        if mode[0][1] == 'o':
-                            self.nicknames[mode[1]]['op'] = '+' in mode[0]
-                        elif mode[0][1] == 'v':
-                            self.nicknames[mode[1]]['voice'] = '+' in mode[0]
-                        elif mode[0] == '+b':
-                            if not mode[1] in self.bans:
-                                self.bans.append(mode[1])
-                        elif mode[0] == '-b':
-                            if mode[1] in self.bans:
-                                self.bans.remove(mode[1])
-
-            elif event.command == "KICK":
-                if event.params.split()[1] == self.handler.nickname:
-                    self.joined = False
-                    self.nicknames = {}
-                else:
-                    self.nicknames.pop(event.params.split()[1])
-
-            elif event.command == "324": # RPL_CHANNELMODEIS
-                self.channelmode = extract_modes(' '.join(event.params.split()[1:]))
-                add = False
+    def _remove_member(self, nick):
+        """removes nick from the nick list, returns its Member or None"""
+        self.handler.remove_member(self, nick)
+        return self.nicknames.pop(nick, None)
 
-            elif event.command == "332": #RPL_TOPIC
-                self.topic = event.params_endpart
-                add = False
+    def _clear_members(self):
+        for nick in self.nicknames:
+            self.handler.remove_member(self, nick)
+        self.nicknames = {}
 
-            elif event.command == "367": #RPL_BANMASK
-                ban = event.params.split()[2]
-                if ban not in self.bans:
-                    self.bans.append(ban)
-                add = False
+    def _prefix(self):
+        """returns the member modes and nick prefixes of the server"""
+        return parse_prefix(self.handler.isupport.get('PREFIX',
+                                                      DEFAULT_PREFIX))
+
+    def _add_names(self, event):
+        """adds the nicks in a RPL_NAMREPLY to the nick list"""
+        modes, prefixes = self._prefix()
+        chars = ''.join(prefixes)
+        nicknames = self.nicknames
+        new = []
+        for name in event.params_endpart.split():
+            # one or more prefixes, and with userhost-in-names nick!user@host
+            nick = name.lstrip(chars)
+            flags = 0
+            if len(nick) != len(name):
+                for char in name[:len(name) - len(nick)]:
+                    flags |= prefixes[char]
+            hostmask = None
+            if '!' in nick:
+                nick, sep, hostmask = nick.partition('!')
+            member = nicknames.get(nick)
+            if member is None:
+                nicknames[nick] = Member(flags, hostmask)
+                new.append(nick)
+            else:
+                member.flags = member.flags & ~PREFIX_FLAGS | flags
+                if hostmask:
+                    member.hostmask = hostmask
+        self.handler.add_members(self, new)
+
+    def _add_who(self, event):
+        """updates a nick from a RPL_WHOREPLY"""
+        args = event.args
+        nick = args[5]
+        member = self.nicknames.get(nick)
+        if member is None:
+            member = Member()
+            self._add_member(nick, member)
+
+        # the status is H (here) or G (gone), maybe * for an IRC operator,
+        # and the nick prefixes
+        status = args[6]
+        modes, prefixes = self._prefix()
+        flags = status[:1] == 'G' and AWAY or 0
+        for char in status[1:]:
+            flags |= prefixes.get(char, 0)
+        member.flags = flags
+        # the trailing parameter is "<hopcount> <realname>"
+        hopcount, sep, realname = args[7].partition(' ')
+        member.username = args[2]
+        member.hostname = args[3]
+        member.server = intern(args[4])
+        member.hopcount = hopcount
+        member.realname = realname
 
-            if add:
+    def add_event(self, event):
+        args = event.args
+        try:
+            # where's the target channel in the message?
+            index, method = self.channel_handlers[event.command]
+            target = args[index]
+        except (KeyError, IndexError): # NICK and QUIT have no channel
+            target = None
+
+        if target is not None and (target == self.target or
+                                   self.handler.casefold(target) ==
+                                   self.handler.casefold(self.target)):
+            if method is None or getattr(self, method)(event):
                 self._add(event)
 
-        elif event.command == 'QUIT' and prefix2nick(event.prefix) in self.nicknames:
+        elif event.command == 'QUIT' and event.nick in self.nicknames:
             # update nicklist and add event to current queue if the nick is in channel
-            self.nicknames.pop(prefix2nick(event.prefix))
+            self._remove_member(event.nick)
             self._add(event)
 
+        elif event.command == 'NICK' and event.nick in self.nicknames and \
+        args:
+            self._add_member(args[0], self._remove_member(event.nick))
+
         elif event.informational:
             self._add(event)
 
-        if clear_send_queue:
-            [self.handler.send_message(self.target, msg) for msg in self.send_queue]
-            self.send_queue = []
-            # send a who query too to add some info to the channel list
-            # and channel mode query too
-            self.handler.send_command('WHO', self.target)
-            self.handler.send_command('MODE', self.target)
-            self.handler.send_command('MODE', self.target + ' b')
+    # The replies about the channel: the index of the channel in Event.args
+    # and the method handling the reply, if any. The methods return whether
+    # the event is added to the store. Handler._handle_server_message finds
+    # the store of the channel with the index too.
+    channel_handlers = {
+        'JOIN': (0, '_on_join'),
+        'PRIVMSG': (0, None),
+        'NOTICE': (0, None),
+        'PART': (0, '_on_part'),
+        'MODE': (0, '_on_mode'),
+        'KICK': (0, '_on_kick'),
+        '353': (2, '_add_names'), # RPL_NAMREPLY
+        '404': (1, None), # ERR_CANNOTSENDTOCHAN
+        '352': (1, '_add_who'), # RPL_WHOREPLY
+        '324': (1, '_on_channelmode'), # RPL_CHANNELMODEIS
+        '332': (1, '_on_topic'), # RPL_TOPIC
+        '367': (1, '_on_banmask'), # RPL_BANMASK
+        '471': (1, '_on_cannot_join'),
+        '473': (1, '_on_cannot_join'),
+        '474': (1, '_on_cannot_join'),
+        '475': (1, '_on_cannot_join'),
+    }
+
+    def _on_join(self, event):
+        # add the nick to the list
+        self._add_member(event.nick, Member(hostmask=event.hostmask))
+        if self.joined: # and event.nick == self.handler.nickname:
+            return True
+
+        # when joined, clear the send queue
+        self.joined = True
+        self.join_sent = False
+        self._add(event)
+        [self.handler.send_message(self.target, msg) for msg in self.send_queue]
+        self.send_queue = []
+        # send a who query too to add some info to the channel list
+        # and channel mode query too
+        self.handler.send_command('WHO', self.target)
+        self.handler.send_command('MODE', self.target)
+        self.handler.send_command('MODE', self.target + ' b')
+        return False
+
+    def _on_cannot_join(self, event):
+        # in case of "Cannot join channel" errors,
+        # stop waiting for a JOIN, empty the send queue
+        self.join_sent = False
+        self.send_queue = []
+        return True
 
+    def _on_part(self, event):
+        if event.nick == self.handler.nickname:
+            self.joined = False  # we parted
+            self._clear_members()
+        else:
+            self._remove_member(event.nick)
+        return True
+
+    def _on_kick(self, event):
+        nick = event.args[1]
+        if nick == self.handler.nickname:
+            self.joined = False
+            self._clear_members()
+        else:
+            self._remove_member(nick)
+        return True
+
+    def _on_mode(self, event):
+        member_modes, prefixes = self._prefix()
+        for mode in extract_modes(event.args):
+            if len(mode) > 1: # has a parameter in addition to flag
+                if mode[0][1] in member_modes:
+                    # sometimes (after netsplits) MODEs come before JOINs
+                    member = self.nicknames.get(mode[1])
+                    if member is None:
+                        member = Member()
+                        self._add_member(mode[1], member)
+                    if mode[0][0] == '+':
+                        member.flags |= member_modes[mode[0][1]]
+                    else:
+                        member.flags &= ~member_modes[mode[0][1]]
+                elif mode[0] == '+b':
+                    if not mode[1] in self.bans:
+                        self.bans.append(mode[1])
+                elif mode[0] == '-b':
+                    if mode[1] in self.bans:
+                        self.bans.remove(mode[1])
+        return True
+
+    def _on_channelmode(self, event):
+        self.channelmode = extract_modes(event.args[1:])
+
+    def _on_topic(self, event):
+        self.topic = event.params_endpart
+
+    def _on_banmask(self, event):
+        ban = event.args[2]
+        if ban not in self.bans:
+            self.bans.append(ban)
 
     def generate_event(self, type, message):
         ret = []
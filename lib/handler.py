@@ -5,8 +5,9 @@ Created on 24.2.2009
 @author: Jaakko Lintula <jaakko.lintula@iki.fi>
 '''
 
-import connection, events
+import connection, events, metrics
 import time, logging
+from collections import OrderedDict
 Event = events.Event
 
 LOG_FILENAME = "pyircfs.log"
@@ -16,6 +17,10 @@ LOG_FILENAME = "pyircfs.log"
 
 CHANCHARS = '*#+!&'
 
+# connection engines, see connection.py
+ENGINES = {'thread': connection.Connection,
+           'async': connection.AsyncConnection}
+
 
 def is_channel(target):
     return target[0] in CHANCHARS
@@ -28,115 +33,167 @@ class ConnectionError(Exception):
         return repr(self.value)
 
 
+class StoreIndex:
+    """Keeps track of which stores are interested in which commands or
+    replies. Stores are returned in the order they were added."""
+
+    def __init__(self):
+        self.commands = {}             # command -> OrderedDict of stores
+        self.wildcard = OrderedDict()  # stores that want everything ('*')
+        self.store_commands = {}       # store -> list of its commands
+
+    def add(self, command, store):
+        if command == '*':
+            stores = self.wildcard
+        else:
+            stores = self.commands.setdefault(command, OrderedDict())
+        stores[store] = None
+        commands = self.store_commands.setdefault(store, [])
+        if not command in commands:
+            commands.append(command)
+
+    def remove(self, store):
+        for command in self.store_commands.pop(store, []):
+            if command == '*':
+                self.wildcard.pop(store, None)
+            else:
+                stores = self.commands[command]
+                stores.pop(store, None)
+                if not stores:
+                    del self.commands[command]
+
+    def get(self, command):
+        """returns a list of stores registered for command, not including
+        the wildcard stores"""
+        try:
+            return self.commands[command].keys()
+        except KeyError:
+            return []
+
+    def get_wildcard(self):
+        return self.wildcard.keys()
+
+    def stores(self):
+        return self.store_commands.keys()
+
+    def __contains__(self, store):
+        return store in self.store_commands
+
+
 class Handler:
 
     def _find_handler_classes(self, key):
         """searches for a given key in classes in the events.py module
-        @return a list of (command, handler class) tuples"""
+        @return a dict of command -> list of handler classes"""
 
         # there has to be a better way :O
-        classes = []  # list of (command, handler class) tuples
+        classes = {}
         for i in events.__dict__.keys():
             if hasattr(events.__dict__[i], key):
                 for j in getattr(events.__dict__[i], key):
-                    classes.append((j, events.__dict__[i]))
+                    classes.setdefault(j, []).append(events.__dict__[i])
         return classes
 
-    def _get_handlers(self, htype, command):
+    def _get_handlers(self, htype, command, create=True):
         """returns a list of eventstore objects for given message, instantiates
         ones from the handler class if needed and adds all other commands the same
         class is able to receive to the object list
 
         @param htype either 'reply' or 'command'
         @param command the command/reply the store should be interested in
+        @param create whether to instantiate the classes if there are no
+               stores yet
         @return list of objects to send an event to"""
 
         if htype == 'reply':
-            hlist = self.reply_handler_classes
-            slist = self.reply_stores
+            hclasses = self.reply_handler_classes
+            index = self.reply_stores
         elif htype == 'command':
-            hlist = self.command_handler_classes
-            slist = self.command_stores
+            hclasses = self.command_handler_classes
+            index = self.command_stores
         else:
             return []
 
-        classes = []
-        objects = []
-
-        wildcard_added = False
-        # search if there are suitable objects already somewhere and use them if possible:
-        for i in slist:
-            if i[0] == command:
-                objects.append(i[1])
-            if i[0] == '*':
-                objects.append(i[1])
-                wildcard_added = True
-
-        if (len(objects) > 1 and wildcard_added) or (objects and not wildcard_added):
-            return objects
-
-        for i in hlist: # ok then, search for classes
-            if i[0] == command: # search for corresponding store objects
-                if not issubclass(i[1], events.PrivmsgStore):
+        # use the existing stores if there are any
+        objects = index.get(command)
+        if not objects and create:
+            # ok then, create stores from the classes for the command
+            for class_ in hclasses.get(command, []):
+                if not issubclass(class_, events.PrivmsgStore):
                     # Privmsg/channel stores are created only on
                     # PRIVMSG/NOTICE, not in _handle_server_message
-                    classes.append(i[1])
+                    objects.append(self._create_new_store(class_,
+                                       replies=class_.reply_handlers,
+                                       commands=class_.command_handlers))
 
-        # now, classes contains only those classes that don't have instantiated objects
-        for i in classes:
-            # print "we are here with ", i
-            obj = self._create_new_store(i) # create a new store instance from the class
-
-            # find out what other commands and replies the same class
-            # supports and add them too:
-            for j in self.reply_handler_classes:
-                if j[1] == i:
-                    self.reply_stores.append((j[0], obj))
-
-            for j in self.command_handler_classes:
-                if j[1] == i:
-                    self.command_stores.append((j[0], obj))
-
-            #slist.append((command, obj))
-            objects.append(obj)
-        return objects
+        return index.get_wildcard() + objects
 
     def _get_free_id(self):
         """returns a free unique id"""
         self._next_id += 1
         return self._next_id
 
-    def _create_new_store(self, class_, *args, **kwargs):
-        """creates a new eventstore object and assigns it an unique id.
+    def _create_new_store(self, class_, replies=(), commands=(), **kwargs):
+        """creates a new eventstore object, assigns it an unique id and
+           registers it for the given replies and commands.
 
            @param class_ the class to create an instance from
-           @param *args, **kwargs are passed to the class
+           @param replies replies to send to the store, '*' for everything
+           @param commands commands the store can send
+           @param **kwargs are passed to the class
            @return the created object"""
 
         id = self._get_free_id()
-        obj = class_(id=id, handler=self, *args, **kwargs)
+        obj = class_(id=id, handler=self, **kwargs)
         self.all_stores[id] = obj
+        if isinstance(obj, events.PrivmsgStore):
+            self.privmsg_stores[self.casefold(obj.target)] = obj
+        for r in replies:
+            self.reply_stores.add(r, obj)
+        for c in commands:
+            self.command_stores.add(c, obj)
         [x(obj) for x in self.new_store_callbacks]
         return obj
 
     def __init__(self):
         self.command_handler_classes = self._find_handler_classes('command_handlers')
         self.reply_handler_classes = self._find_handler_classes('reply_handlers')
-        self.command_stores = []
-        self.reply_stores = []
-        self.privmsg_stores = []
+        self.member_handler_classes = self._find_handler_classes('member_handlers')
+        # reply -> index of the channel in its args, for the replies that go
+        # to the store of that channel
+        self.channel_reply_args = dict([(x, y[0]) for x, y in
+                                   events.ChannelStore.channel_handlers.items()
+                                   if x not in ('PRIVMSG', 'NOTICE')])
+        self.command_stores = StoreIndex()
+        self.reply_stores = StoreIndex()
+        self.privmsg_stores = {} # casefolded target -> store
+        # casefolded nick -> the ChannelStore it is on, or a set of them if
+        # it is on more than one, see add_members
+        self.member_channels = {}
         self.all_stores = {}
         self.joined_when_disconnected = []
         self.new_store_callbacks = []
+        self.rename_callbacks = []
+        self.store_maxsize = 0  # events kept in memory per store, 0 = all
+        self.spool_dir = None   # where the stores put the rest
+        self.store_backend = list # or events.ColumnarEventList
+        self.send_buffer = connection.SendQueue.limit # lines per target
 
         self._next_id = 0
 
         self.connection = None
+        self.connection_class = connection.Connection
+        # kept over reconnects so that a backoff isn't forgotten
+        self.flood_control = connection.TokenBucket()
+        self.metrics = metrics.Metrics()
+        self.trace = None # a trace.TraceWriter for the lines received
         self.connection_status = (0, '')
         self.connection_status_timestamp = 0
         self.nicknames = []
         self.username = ""
         self.nickname = ""
+        self.isupport = {}
+        self.casemapping = 'rfc1459'
 
     def connect(self, server, nicknames, username, realname, port=6667, password=""):
         """Tries to connect to the IRC server."""
@@ -149,9 +206,13 @@ class Handler:
         self.port = port
 
         #self.connection = connection.connect(self, server, port)
-        self.connection = connection.Connection(server, port,
+        self.connection = self.connection_class(server, port,
                                                 self.receive_message,
-                                                self.receive_status)
+                                                self.receive_status,
+                                                self.flood_control,
+                                                self.receive_messages,
+                                                self.metrics)
+        self.connection.out_queue.limit = self.send_buffer
         self.connection.start()
         while not self.connection_status[0] == 1:
             time.sleep(0.2)
@@ -163,6 +224,94 @@ class Handler:
         self.send_command('NICK', nicknames[0])
         self.send_command('USER', '%s 0 * :%s' % (username, realname))
 
+    def casefold(self, name):
+        """returns name lowercased with the server's casemapping"""
+        return events.irc_lower(name, self.casemapping)
+
+    def set_casemapping(self, casemapping):
+        """changes the casemapping (from RPL_ISUPPORT) and reindexes the
+        privmsg stores accordingly"""
+        if not casemapping in events.CASEMAPS:
+            logging.debug("set_casemapping: unknown casemapping %s" % casemapping)
+            return
+        self.casemapping = casemapping
+        self.privmsg_stores = dict([(self.casefold(x.target), x) for x in
+                                    self.privmsg_stores.values()])
+        channels = set()
+        for x in self.member_channels.values():
+            if isinstance(x, set):
+                channels.update(x)
+            else:
+                channels.add(x)
+        self.member_channels = {}
+        for channel in channels:
+            self.add_members(channel, channel.nicknames)
+
+    def add_member(self, channel, nick):
+        """notes that nick is on channel, a ChannelStore"""
+        self.add_members(channel, (nick,))
+
+    def add_members(self, channel, nicks):
+        """notes that the nicks are on channel, e.g. from a NAMES reply"""
+        table = events.CASEMAPS.get(self.casemapping, events.CASEMAPS['rfc1459'])
+        member_channels = self.member_channels
+        for nick in nicks:
+            key = nick.translate(table)
+            channels = member_channels.get(key)
+            # most nicks are on one channel only, a set for them would take
+            # more memory than the member record
+            if channels is None:
+                member_channels[key] = channel
+            elif isinstance(channels, set):
+                channels.add(channel)
+            elif channels is not channel:
+                member_channels[key] = set((channels, channel))
+
+    def remove_member(self, channel, nick):
+        key = self.casefold(nick)
+        channels = self.member_channels.get(key)
+        if channels is channel:
+            del self.member_channels[key]
+        elif isinstance(channels, set):
+            channels.discard(channel)
+            if len(channels) == 1:
+                self.member_channels[key] = channels.pop()
+
+    def get_member_stores(self, nick, command):
+        """returns the stores a reply from nick goes to if it is one of their
+        member_handlers, e.g. a NICK or a QUIT: the channels nick is on and
+        the query with nick"""
+        key = self.casefold(nick)
+        channels = self.member_channels.get(key)
+        if channels is None:
+            channels = ()
+        elif not isinstance(channels, set):
+            channels = (channels,)
+        stores = [x for x in channels if command in x.member_handlers]
+        store = self.privmsg_stores.get(key)
+        if store is not None and command in store.member_handlers:
+            stores.append(store)
+        return stores
+
+    def rename_privmsg_store(self, store, target):
+        """changes the target of a privmsg store, e.g. on NICK, so that it
+        can be found with both names until the rename is complete. Returns
+        False and leaves the store as it is if another store has the target
+        already, e.g. a query with someone who had the nick before."""
+        old = self.casefold(store.target)
+        new = self.casefold(target)
+        existing = self.privmsg_stores.get(new)
+        if existing is not None and existing is not store:
+            logging.debug("rename_privmsg_store: %s exists, not renaming %s" %
+                          (target, store.target))
+            return False
+        self.privmsg_stores[new] = store
+        store.target = target
+        if old != new and self.privmsg_stores.get(old) is store:
+            del self.privmsg_stores[old]
+        [x(store) for x in self.rename_callbacks]
+        return True
+
     def __str__(self):
         ret = "i'm a handler"
         if self.connection:
@@ -178,52 +327,48 @@ class Handler:
 
         self.all_stores.pop(id)
 
-        while store in self.privmsg_stores:
-            self.privmsg_stores.remove(store)
+        if isinstance(store, events.PrivmsgStore):
+            key = self.casefold(store.target)
+            if self.privmsg_stores.get(key) is store:
+                del self.privmsg_stores[key]
 
-        for storelist in [self.reply_stores, self.command_stores]:
-            to_remove = []
-            for i in storelist:
-                if i[1] == store:
-                    to_remove.append(i)
-            for i in to_remove:
-                storelist.remove(i)
+        self.reply_stores.remove(store)
+        self.command_stores.remove(store)
 
         # and finally tell the store about it
         store.remove()
 
     def get_store_id(self, store):
-        for id in self.all_stores:
-            if self.all_stores[id] == store:
-                return id
+        if self.all_stores.get(store.id) is store:
+            return store.id
         return None
 
     def close(self):
         self.connection.close()
 
+    def receive_messages(self, messages):
+        """handles a batch of messages received at once"""
+        if self.trace is not None:
+            self.trace.record(messages)
+        receive = self.receive_message
+        for message in messages:
+            receive(message)
+
     def receive_message(self, message):
         """handles messages coming from the connection and hands them to
            _handle_privmsg or _handle_server_message depending on message type"""
         logging.debug("receive_message: received %s" % message)
-        tmp = message.split(' ')
-        # parses the received message to prefix/cmd/params:
-        if message[0] == ":":
-            prefix = tmp[0]
-            cmd = tmp[1]
-            params = ' '.join(tmp[2:])
-        else:
-            prefix = ""
-            cmd = tmp[0]
-            params = ' '.join(tmp[1:])
-        ev = Event(prefix=prefix, command=cmd, params=params)
-
-        #print "RECV: prefix %s cmd %s params %s " % (prefix, cmd, params)
+        timed = self.metrics.enabled
+        if timed:
+            start = time.time()
+        ev = events.parse_message(message)
+        cmd = ev.command
 
-        if cmd == 'JOIN':
+        if cmd == 'JOIN' and ev.args:
             # JOINs are a special case
             # - we need to create a privmsg store for them if one doesn't
             #   exist
-            self._get_privmsg_handlers(params[1:])
+            self._get_privmsg_handlers(ev.args[0])
             # now a store is created for the channel if one didn't exist
             # already - we don't need the actual instance anywhere in here,
             # but now _handle_server_message has somewhere to send the JOIN too
@@ -232,51 +377,79 @@ class Handler:
             self._handle_privmsg(ev)
         else:
             self._handle_server_message(ev)
+        if timed:
+            self.metrics.observe_dispatch(cmd, time.time() - start)
 
     def _handle_privmsg(self, event):
         logging.debug("_handle_privmsg: event %s" % event)
-        #if event.params[0] in '*#+!&':
-        if is_channel(event.params[0]):
-            target = event.params.split()[0]
-        else:
-            try:
-                target = event.prefix[1:event.prefix.index('!')]
-            except ValueError:  # no nickname could be found
-                logging.debug("hmm? couldn't extract nickname from event")
-                return
+        if not event.args:
+            return
+        if is_channel(event.args[0]):
+            target = event.args[0]
+        elif event.nick:
+            target = event.nick
+        else:  # no nickname could be found
+            logging.debug("hmm? couldn't extract nickname from event")
+            return
 
         stores = self._get_privmsg_handlers(target)
         [store.add_event(event) for store in stores]
 
     def _get_privmsg_handlers(self, target):
         logging.debug("ENTER _get_privmsg_handlers, target: %s" % target)
-        s = [x for x in self.privmsg_stores if x.target.lower() == target.lower()]
-        if not s:
+        store = self.privmsg_stores.get(self.casefold(target))
+        if store is None:
             logging.debug("_get_privmsg_handlers: no existing store found")
             if is_channel(target[0]):
-                s.append(self._create_new_store(events.ChannelStore, target=target, name="_"+target))
-                replies = events.ChannelStore.reply_handlers
+                class_ = events.ChannelStore
             else:
-                s.append(self._create_new_store(events.PrivmsgStore, target=target, name="_"+target))
-                replies = events.PrivmsgStore.reply_handlers
-            self.privmsg_stores.append(s[-1])
-            for r in replies:
-                self.reply_stores.append((r, s[-1])) # TODO ADD ID
-        for i in self.reply_stores:
-            if i[0] == '*':
-                s.append(i[1])
+                class_ = events.PrivmsgStore
+            store = self._create_new_store(class_, target=target,
+                                           name="_"+target,
+                                           replies=class_.reply_handlers)
+        s = [store]
+        s += self.reply_stores.get_wildcard()
         logging.debug("_get_privmsg_handlers: returning stores: %s" % [str(x) for x in s])
         return s
 
+    def _get_channel_store(self, event):
+        """returns the store of the channel a reply is about, or None"""
+        index = self.channel_reply_args.get(event.command)
+        if index is None:
+            return None
+        try:
+            target = event.args[index]
+        except IndexError:
+            return None
+        if not target or not is_channel(target):
+            return None
+        return self.privmsg_stores.get(self.casefold(target))
+
     def _handle_server_message(self, event):
-        handlers = self._get_handlers('reply', event.command)
+        # the replies that go to a channel or to the channels of a nick
+        # don't make stores of their own, e.g. a JoinES or a QuitES
+        # collecting every JOIN or QUIT seen, the command stores get them
+        # only once the command has been used (NickES is made by the NICK
+        # sent when registering)
+        create = event.command not in self.channel_reply_args and \
+                 event.command not in self.member_handler_classes
+        handlers = self._get_handlers('reply', event.command, create)
+        channel = self._get_channel_store(event)
+        if channel is not None:
+            handlers = handlers + [channel]
+        if event.command in self.member_handler_classes and event.nick:
+            handlers = handlers + self.get_member_stores(event.nick,
+                                                         event.command)
         for h in handlers:
             answer = h.add_event(event)
             if answer:
                 [self.connection.send(msg) for msg in answer]
 
 
-    def send_command(self, command, params):
+    def send_command(self, command, params, lane=None):
+        """sends a command through its command store
+
+        @param lane the send queue lane, see connection.SendQueue"""
         if self.connection_status[0] not in (1, 10) or  \
           (self.connection_status[0] == 1 and \
           command not in ['PASS', 'USER', 'NICK']):
@@ -289,9 +462,9 @@ class Handler:
             to_send = h.generate_event(command, params)
             if to_send:
                 for msg in to_send:
-                    self.connection.send(msg)
+                    self.connection.send(msg, lane)
 
-    def send_message(self, target, message, type="PRIVMSG"):
+    def send_message(self, target, message, type="PRIVMSG", lane=None):
         logging.debug("ENTER send_message: target %s message %s type %s" % (target, message, type))
         #if message.startswith('wait'):
         #    time.sleep(10)
@@ -303,7 +476,7 @@ class Handler:
         logging.debug("send_message: to_send: %s" % to_send)
         if to_send:
             for msg in to_send:
-                self.connection.send(msg)
+                self.connection.send(msg, lane)
 
     def send_notice(self, target, message):
         self.send_message(target, message, type="NOTICE")
@@ -341,7 +514,7 @@ class Handler:
         # when disconnected, save names of channels that were joined at the
         # time, and send an informational event to them
         if self.connection_status[0] in (100, 101, 102):
-            for i in self.privmsg_stores:
+            for i in self.privmsg_stores.values():
                 if isinstance(i, events.ChannelStore):
                     if i.joined:
                         self.joined_when_disconnected.append(i.target)
@@ -364,31 +537,23 @@ class Handler:
 
     def list_reply_stores(self):
         """returns list of unique reply stores"""
-        names = []
-        stores = []
-        for i in self.reply_stores:
-            if not i[1] in stores:
-                names.append(i[1].name)
-                stores.append(i[1])
-        return dict(zip(names, stores)) # I suppose names are unique
+        # I suppose names are unique
+        return dict([(x.name, x) for x in self.reply_stores.stores()])
 
     def list_command_stores(self):
         """returns list of unique command stores"""
-        names = []
-        stores = []
-        for i in self.command_stores:
-            if not i[1] in stores and not (hasattr(i[1], 'internal') and i[1].internal):
-                # do not list stores that are there already, and don't list those
-                # that are "internal" either (particularly PingES)
-                names.append(i[0])
-                stores.append(i[1])
-        return dict(zip([x.lower() for x in names], stores))
+        d = {}
+        for store, commands in self.command_stores.store_commands.items():
+            if not (hasattr(store, 'internal') and store.internal):
+                # don't list those that are "internal" (particularly PingES)
+                d[commands[0].lower()] = store
+        return d
 
     def list_privmsg_stores(self, filter=None):
         """returns list of unique privmsg stores
             @param filter return only privmsg or channels if 'privmsg' or 'channel'"""
         d = {}
-        for i in self.privmsg_stores:
+        for i in self.privmsg_stores.values():
             if filter == 'privmsg':
                 if isinstance(i, events.PrivmsgStore):
                     d[i.target] = i
@@ -403,17 +568,9 @@ class Handler:
     def list_info_stores(self):
         """returns list of reply stores that don't take any commands,
            aka "informational" stores (errors, etc?)"""
-        names = []
-        stores = []
-        for i in self.reply_stores:
-            found = False
-            for j in self.command_stores:
-                if j[1] == i[1]:
-                    found = True
-            for j in self.privmsg_stores:
-                if j == i[1]:
-                     found = True
-            if not found:
-                names.append(i[1].name)
-                stores.append(i[1])
-        return dict(zip(names, stores))
+        d = {}
+        for store in self.reply_stores.stores():
+            if not store in self.command_stores and \
+            not isinstance(store, events.PrivmsgStore):
+                d[store.name] = store
+        return d
@@ -0,0 +1,210 @@
+'''
+Created on 17.10.2026
+
+Counters and latency histograms for info/metrics. Counting is cheap and
+always on; latencies are timed only once metrics are enabled, which
+PyIrcFS does when info/metrics is opened, so that nobody pays for them
+until someone looks.
+'''
+
+import time
+from bisect import bisect_left
+
+# histogram bucket upper bounds in seconds, as in Prometheus
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+           0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Rate:
+    """counts things and how many there were per second over the last
+    window seconds"""
+
+    def __init__(self, window=10):
+        self.total = 0
+        self._counts = [0] * (window + 1) # one more for the current second
+        self._second = int(time.time())
+
+    def _advance(self, second):
+        if second - self._second >= len(self._counts):
+            self._counts = [0] * len(self._counts)
+        else:
+            for i in xrange(self._second + 1, second + 1):
+                self._counts[i % len(self._counts)] = 0
+        self._second = second
+
+    def add(self, count=1):
+        self.total += count
+        second = int(time.time())
+        if second != self._second:
+            self._advance(second)
+        self._counts[second % len(self._counts)] += count
+
+    def rate(self):
+        """per second over the last full seconds"""
+        second = int(time.time())
+        if second != self._second:
+            self._advance(second)
+        current = self._counts[second % len(self._counts)]
+        return (sum(self._counts) - current) / float(len(self._counts) - 1)
+
+
+class Histogram:
+    """a distribution of latencies in seconds"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """returns the upper bound of the bucket the q quantile is in, or
+        the largest value seen if it is past the last bucket"""
+        if not self.count:
+            return 0.0
+        wanted = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts[:-1]):
+            seen += count
+            if seen >= wanted:
+                return min(self.buckets[i], self.max)
+        return self.max
+
+    def cumulative(self):
+        """returns (upper bound, count of values up to it) pairs, the last
+        bound being '+Inf'"""
+        ret = []
+        seen = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            seen += count
+            ret.append((bound, seen))
+        return ret
+
+    def summary(self):
+        if not self.count:
+            return "0 calls"
+        return "%d calls, avg %s, p50 %s, p90 %s, p99 %s, max %s" % (
+            self.count, usec(self.sum / self.count), usec(self.quantile(0.5)),
+            usec(self.quantile(0.9)), usec(self.quantile(0.99)),
+            usec(self.max))
+
+
+def usec(seconds):
+    if seconds >= 0.001:
+        return "%.1f ms" % (seconds * 1000)
+    return "%.0f us" % (seconds * 1000000)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """What the connection, the handler and the filesystem count. The
+    owners of the things measured add to these directly."""
+
+    def __init__(self):
+        self.enabled = False # whether latencies are timed
+        self.received = Rate() # lines from the server
+        self.sent = Rate() # lines to the server
+        self.dispatch = {} # command -> Histogram of receive_message
+        self.flood_wait = 0.0 # seconds lines waited for flood control
+        self.flood_waits = 0
+        self.op_counts = {} # FUSE operation -> calls
+        self.ops = {} # FUSE operation -> Histogram, when enabled
+
+    def observe_dispatch(self, command, seconds):
+        try:
+            self.dispatch[command].observe(seconds)
+        except KeyError:
+            self.dispatch.setdefault(command, Histogram()).observe(seconds)
+
+    def observe_op(self, op, seconds):
+        try:
+            self.ops[op].observe(seconds)
+        except KeyError:
+            self.ops.setdefault(op, Histogram()).observe(seconds)
+
+    def add_flood_wait(self, seconds):
+        self.flood_wait += seconds
+        self.flood_waits += 1
+
+    def text(self, stores=(), queue_depth=0):
+        """returns a report for people to read. stores are (name, event
+        count, byte count) tuples"""
+        buf = []
+        buf.append("lines received: %d, %.1f/s\n" % (self.received.total,
+                                                     self.received.rate()))
+        buf.append("lines sent: %d, %.1f/s\n" % (self.sent.total,
+                                                 self.sent.rate()))
+        buf.append("send queue: %d lines\n" % queue_depth)
+        buf.append("flood control wait: %.1f s in %d waits\n" %
+                   (self.flood_wait, self.flood_waits))
+        if not self.enabled:
+            buf.append("latencies: timed from the next read on\n")
+        buf.append("\ndispatch latency per command:\n")
+        for command, histogram in sorted(self.dispatch.items()):
+            buf.append("  %-10s %s\n" % (command, histogram.summary()))
+        buf.append("\nfilesystem operations:\n")
+        for op, count in sorted(self.op_counts.items()):
+            histogram = self.ops.get(op)
+            buf.append("  %-10s %d calls%s\n" % (op, count, histogram and
+                       " (timed: %s)" % histogram.summary() or ""))
+        buf.append("\nstores (events, bytes):\n")
+        for name, events, size in sorted(stores):
+            buf.append("  %-24s %10d %12d\n" % (name, events, size))
+        return ''.join(buf)
+
+    def prometheus(self, stores=(), queue_depth=0):
+        """returns the same in the Prometheus text format"""
+        buf = []
+        def metric(name, type, help, samples):
+            buf.append("# HELP pyircfs_%s %s\n" % (name, help))
+            buf.append("# TYPE pyircfs_%s %s\n" % (name, type))
+            for labels, value in samples:
+                if labels:
+                    labels = '{%s}' % ','.join(['%s="%s"' % (x, _label(y))
+                                                for x, y in labels])
+                buf.append("pyircfs_%s%s %s\n" % (name, labels or '', value))
+        def histograms(name, help, label, histograms):
+            buf.append("# HELP pyircfs_%s %s\n" % (name, help))
+            buf.append("# TYPE pyircfs_%s histogram\n" % name)
+            for key, histogram in sorted(histograms.items()):
+                for bound, count in histogram.cumulative():
+                    buf.append('pyircfs_%s_bucket{%s="%s",le="%s"} %d\n' %
+                               (name, label, _label(key), bound, count))
+                buf.append('pyircfs_%s_sum{%s="%s"} %r\n' %
+                           (name, label, _label(key), histogram.sum))
+                buf.append('pyircfs_%s_count{%s="%s"} %d\n' %
+                           (name, label, _label(key), histogram.count))
+
+        metric('lines_received_total', 'counter',
+               'Lines received from the server.',
+               [((), self.received.total)])
+        metric('lines_sent_total', 'counter', 'Lines sent to the server.',
+               [((), self.sent.total)])
+        metric('send_queue_lines', 'gauge', 'Lines waiting to be sent.',
+               [((), queue_depth)])
+        metric('flood_wait_seconds_total', 'counter',
+               'Time lines waited for flood control.',
+               [((), repr(self.flood_wait))])
+        metric('fuse_operations_total', 'counter',
+               'Filesystem operations.',
+               [((('op', x),), y) for x, y in sorted(self.op_counts.items())])
+        metric('store_events', 'gauge', 'Events in a store.',
+               [((('store', x[0]),), x[1]) for x in sorted(stores)])
+        metric('store_bytes', 'gauge', 'Size of a store file.',
+               [((('store', x[0]),), x[2]) for x in sorted(stores)])
+        histograms('dispatch_seconds', 'Time receive_message took.',
+                   'command', self.dispatch)
+        histograms('fuse_operation_seconds', 'Time filesystem operations '
+                   'took.', 'op', self.ops)
+        return ''.join(buf)
@@ -0,0 +1,93 @@
+'''
+Created on 17.10.2026
+
+Traces of the lines received from a server, for replaying them to a
+Handler without a socket (see bench/replay.py). A trace is a gzip file of
+text lines: a header with the time the trace started and the nickname
+used, then each received line after the milliseconds since the previous
+one:
+
+# pyircfs trace 1 1792264617.539 mynick
+0 :irc.example.net 001 mynick :Welcome
+12 PING :irc.example.net
+'''
+
+import gzip, threading, time
+
+VERSION = 1
+FLUSH_INTERVAL = 1 # seconds between flushes to disk
+
+
+class TraceWriter:
+    """writes the lines given to record to a trace file"""
+
+    def __init__(self, path, nickname=''):
+        self.path = path
+        self._file = gzip.open(path, 'wb')
+        self._lock = threading.Lock()
+        self._last = time.time()
+        self._flushed = self._last
+        self._file.write("# pyircfs trace %d %.3f %s\n" % (VERSION,
+                                                           self._last,
+                                                           nickname))
+
+    def record(self, lines):
+        """writes lines received at once"""
+        with self._lock:
+            if self._file is None:
+                return
+            now = time.time()
+            delay = int((now - self._last) * 1000)
+            # the time is moved on by the milliseconds written only, so
+            # that rounding errors don't add up
+            self._last += delay / 1000.0
+            buf = ["%d %s\n" % (delay, lines[0])]
+            buf.extend(["0 %s\n" % x for x in lines[1:]])
+            self._file.write(''.join(buf))
+            if now - self._flushed >= FLUSH_INTERVAL:
+                # what is flushed can be read even if the trace is never
+                # closed properly
+                self._file.flush()
+                self._flushed = now
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_header(path):
+    """returns the time a trace started and the nickname it was recorded
+    with"""
+    f = gzip.open(path, 'rb')
+    try:
+        header = f.readline().split()
+    finally:
+        f.close()
+    if header[:3] != ['#', 'pyircfs', 'trace'] or int(header[3]) != VERSION:
+        raise ValueError("%s is not a pyircfs trace" % path)
+    return float(header[4]), len(header) > 5 and header[5] or ''
+
+
+def read_trace(path):
+    """yields (seconds since the trace started, line) for each line in the
+    trace. A trace that wasn't closed properly is read as far as it was
+    flushed."""
+    read_header(path)
+    f = gzip.open(path, 'rb')
+    f.readline()
+    elapsed = 0
+    try:
+        while True:
+            try:
+                record = f.readline()
+            except (IOError, EOFError):
+                return # cut short
+            if not record.endswith('\n'):
+                return
+            delay, line = record[:-1].split(' ', 1)
+            elapsed += int(delay)
+            yield elapsed / 1000.0, line
+    finally:
+        f.close()
@@ -6,12 +6,15 @@ Created on 24.2.2009
 @author: Jaakko Lintula <jaakko.lintula@iki.fi>
 '''
 
-import os, stat, errno, time, sys, re, logging
+import os, stat, errno, time, sys, logging, threading, select, itertools
 import fuse
 from fuse import Fuse
 
 import lib.handler as handler
 import lib.events as events
+import lib.connection as connection
+import lib.metrics as metrics
+import lib.trace as trace
 from lib.handler import ConnectionError
 
 if not hasattr(fuse, '__version__'):
@@ -24,10 +27,46 @@ fuse.fuse_python_api = (0, 2)
 VERSION = (0, 1, 0)
 
 LOG_FILENAME = "pyircfs.log"
+
+# how long the kernel may cache names and attributes, unless given as mount
+# options. Names change seldom, attributes every time a line arrives, so
+# those can be cached longer only if the kernel is told about the changes,
+# see PyIrcFS._invalidate
+ENTRY_TIMEOUT = 60
+ATTR_TIMEOUT = 1
+
+# inode numbers: the fixed files first, then four for each store (its file,
+# its info file and its names directory), then nick files numbered as they
+# are seen
+STORE_INODES = 16
+STORE_INODE_KINDS = {'privmsg': 0, 'command': 0, 'info': 0,
+                     'channelinfo': 1, 'nickdir': 2}
+NICK_INODES = 1 << 40
 #logging.basicConfig(filename=LOG_FILENAME,level=logging.DEBUG, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
 #                    datefmt='%m-%d %H:%M:%S',)
 
 
+def timed(op, func):
+    """wraps a FUSE operation to count its calls, and to time them once
+    metrics are enabled"""
+    def timed_op(self, *args, **kwargs):
+        m = self.metrics
+        m.op_counts[op] = m.op_counts.get(op, 0) + 1
+        if not m.enabled:
+            return func(self, *args, **kwargs)
+        start = time.time()
+        try:
+            ret = func(self, *args, **kwargs)
+            if op == 'readdir': # a generator, time the listing too
+                ret = list(ret)
+            return ret
+        finally:
+            m.observe_op(op, time.time() - start)
+    timed_op.__name__ = func.__name__
+    timed_op.__doc__ = func.__doc__
+    return timed_op
+
+
 def basename(path):
     try:
         return path[path.rindex('/')+1:]
@@ -51,6 +90,36 @@ class MyStat(fuse.Stat):
         self.st_mtime = MyStat.ctime
         self.st_ctime = MyStat.ctime
 
+class OpenFile:
+    """An open file. open() and create() give these to FUSE, which passes
+    them back to read(), write() etc. and looks at direct_io and
+    keep_cache. Written data that isn't sent yet, a partial line or a
+    rewrite of the file, is kept here until the file is flushed."""
+
+    def __init__(self, flags, direct_io=False, store=None):
+        self.flags = flags
+        self.nonblocking = bool(flags & os.O_NONBLOCK)
+        self.direct_io = direct_io
+        self.keep_cache = False
+        self.store = store # what _search found at open
+        self.pending = []
+        self.pending_size = 0
+        self.offset = None # of the pending data, None if not written to
+        self.appending = True
+        self.lane = None # the send queue lane of the lines written here
+        self.read_end = 0 # where the last read of this handle ended
+
+    def add_pending(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+
+    def take_pending(self):
+        data = ''.join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        return data
+
+
 class PyIrcFS(Fuse):
 
     def __init__(self, *args, **kwargs):
@@ -61,186 +130,339 @@ class PyIrcFS(Fuse):
         self.namesdir = '/names'
         self.privmsgdir = '/'
         self.statuspath = self.infodir + '/status'
+        self.queuepath = self.infodir + '/queue'
+        self.metricspath = self.infodir + '/metrics'
+        self.prometheuspath = self.infodir + '/metrics.prom'
+        self._fixed_inodes = {self.privmsgdir: 1, self.commanddir: 2,
+                              self.infodir: 3, self.namesdir: 4,
+                              self.statuspath: 5, self.queuepath: 6,
+                              self.metricspath: 7, self.prometheuspath: 8}
+        self.metrics = metrics.Metrics()
+        self._nick_inodes = {} # channel store -> {nick: inode}
+        self._next_nick_inode = itertools.count(NICK_INODES).next
+        # older python-fuse versions have no Invalidate at all
+        self._can_invalidate = hasattr(self, 'Invalidate')
+
+        # (path -> (objtype, object) table, directory listings) for
+        # _search, rebuilt when stores are added, removed or renamed. The
+        # two are replaced with one assignment, so that a lookup in another
+        # thread never sees one without the other
+        self._paths = None
+        self._store_paths = {} # store -> its paths in the table
+        self._store_files = {} # store -> the path of its own file
+        self._paths_generation = 0
+
+        # readers waiting for new lines, woken up by _store_updated: FUSE
+        # poll handles per store, and a condition per store for blocking
+        # reads at the end of a file
+        self._waiters_lock = threading.Lock()
+        self._pollhandles = {}
+        self._conditions = {}
+        self.eofwait = 0
+        self.trace = '' # file to record the lines received to
 
     def fsinit(self):
         h = handler.Handler()
-        h.reply_stores.append(('*', h._create_new_store(events.EventStore, name="all_recv")))
+        h.store_maxsize = int(self.maxevents)
+        h.spool_dir = self.spooldir
+        h.store_backend = events.BACKENDS[self.backend]
+        h.send_buffer = int(self.sendbuffer)
+        h.connection_class = handler.ENGINES[self.engine]
+        h.flood_control = connection.TokenBucket(
+            rate=float(self.floodrate), burst=int(self.floodburst),
+            byterate=int(self.floodbyterate),
+            byteburst=int(self.floodbyteburst))
+        h.metrics = self.metrics
+        if self.trace:
+            h.trace = trace.TraceWriter(self.trace, self.nickname)
+        h.new_store_callbacks.append(self._new_store)
+        h.rename_callbacks.append(self._store_renamed)
+        h._create_new_store(events.EventStore, replies=['*'], name="all_recv")
         if self.altnick:
             nicks = [self.nickname, self.altnick]
         else:
             nicks = [self.nickname]
 
-        h.connect(server=self.server, nicknames=nicks, username=self.username, realname=self.realname)
         self.handler = h
+        h.connect(server=self.server, nicknames=nicks, username=self.username,
+                  realname=self.realname, port=int(self.port))
+
+    def _new_store(self, store):
+        store.update_callbacks.append(self._store_updated)
+        store.remove_callbacks.append(self._invalidate_paths)
+        store.remove_callbacks.append(self._forget_store)
+        self._invalidate_paths()
+
+    def _store_updated(self, store):
+        """wakes up the readers waiting for new lines in store and tells
+        the kernel the cached attributes of its file are out of date.
+        Called for every line received, so only the file that grew is
+        invalidated, and the path table is never rebuilt here."""
+        path = self._store_files.get(store)
+        # a store not in the table yet hasn't been looked up by the kernel
+        # either
+        if path is not None:
+            self._invalidate_path(path)
+        self._wake_readers(store)
+
+    def _forget_store(self, store):
+        self._invalidate(store)
+        self._nick_inodes.pop(store, None)
+        self._wake_readers(store, forget=True)
+
+    def _wake_readers(self, store, forget=False):
+        with self._waiters_lock:
+            if forget:
+                condition = self._conditions.pop(store, None)
+            else:
+                condition = self._conditions.get(store)
+            handles = self._pollhandles.pop(store, [])
+        if condition is not None:
+            with condition:
+                condition.notify_all()
+        for pollhandle in handles:
+            self.NotifyPoll(pollhandle)
+
+    def _condition(self, store):
+        """returns the condition readers of store wait on"""
+        with self._waiters_lock:
+            try:
+                return self._conditions[store]
+            except KeyError:
+                return self._conditions.setdefault(store,
+                                                   threading.Condition())
+
+    def _store_renamed(self, store):
+        self._invalidate(store)
+        self._invalidate_paths()
+
+    def _invalidate_paths(self, store=None):
+        self._paths_generation += 1
+        self._paths = None
+
+    def _invalidate(self, store):
+        """drops what the kernel has cached of the files of store, if the
+        FUSE library can do that"""
+        # a removed or renamed store is still under its old paths here,
+        # and a store the table hasn't been built with yet has nothing
+        # cached
+        for path in self._store_paths.get(store, []):
+            if not self._can_invalidate:
+                return
+            self._invalidate_path(path)
+
+    def _invalidate_path(self, path):
+        if not self._can_invalidate:
+            return
+        if self.Invalidate(path) not in (0, -errno.ENOENT):
+            logging.debug("_invalidate: not supported, attributes are "
+                          "cached for attr_timeout")
+            self._can_invalidate = False
+
+    def _inode(self, path, objtype, obj):
+        if obj is None:
+            return self._fixed_inodes[path]
+        return STORE_INODES + obj.id * 4 + STORE_INODE_KINDS[objtype]
+
+    def _nick_inode(self, channel, nick):
+        inodes = self._nick_inodes.get(channel)
+        if inodes is None:
+            inodes = self._nick_inodes.setdefault(channel, {})
+        try:
+            return inodes[nick]
+        except KeyError:
+            pass
+        if len(inodes) >= 2 * len(channel.nicknames) + 16:
+            # forget the nicks that have left, a nick coming back gets a
+            # new inode
+            for x in inodes.keys():
+                if x not in channel.nicknames:
+                    inodes.pop(x, None)
+        return inodes.setdefault(nick, self._next_nick_inode())
+
+    def _build_paths(self):
+        """builds the path table and directory listings from the stores
+        the handler knows of"""
+        generation = self._paths_generation
+        paths = {}
+        dirs = {}
+        store_paths = {}
+        store_files = {}
+
+        privmsg = self.handler.list_privmsg_stores()
+        channels = [x for x in privmsg if x[0] in handler.CHANCHARS]
+        commands = self.handler.list_command_stores()
+        info = self.handler.list_info_stores()
+
+        for path in [self.privmsgdir, self.commanddir, self.infodir,
+                     self.namesdir]:
+            paths[path] = ('rootdir', None)
+        dirs[self.privmsgdir] = privmsg.keys() + [self.commanddir[1:],
+                                                  self.infodir[1:],
+                                                  self.namesdir[1:]]
+        dirs[self.commanddir] = commands.keys()
+        dirs[self.infodir] = info.keys() + [basename(self.statuspath),
+                                            basename(self.queuepath),
+                                            basename(self.metricspath),
+                                            basename(self.prometheuspath)] + \
+                             channels
+        dirs[self.namesdir] = channels
+
+        # in the order of precedence, lowest first
+        paths[self.statuspath] = ('status', None)
+        paths[self.queuepath] = ('queue', None)
+        paths[self.metricspath] = ('metrics', None)
+        paths[self.prometheuspath] = ('prometheus', None)
+        for target, store in privmsg.items():
+            if isinstance(store, events.ChannelStore):
+                paths[self.infodir + '/' + target] = ('channelinfo', store)
+        for name, store in info.items():
+            paths[self.infodir + '/' + name] = ('info', store)
+        for name, store in commands.items():
+            paths[self.commanddir + '/' + name] = ('command', store)
+        for target, store in privmsg.items():
+            paths[self.privmsgdir + target] = ('privmsg', store)
+            if isinstance(store, events.ChannelStore):
+                paths[self.namesdir + '/' + target] = ('nickdir', store)
+        for path, (objtype, obj) in paths.items():
+            if obj is not None:
+                store_paths.setdefault(obj, []).append(path)
+                if objtype in ['privmsg', 'command', 'info']:
+                    store_files[obj] = path
+
+        if generation == self._paths_generation:
+            # nothing changed while building
+            self._paths = (paths, dirs)
+            self._store_paths = store_paths
+            self._store_files = store_files
+        return paths, dirs, store_paths
 
     def _status(self):
         buf = ""
         buf += "Connection status: %d (%s)\n" % self.handler.connection_status
         buf += "(since %s)\n\n" % time.localtime(self.handler.connection_status_timestamp)
         buf += "server: %s:%d\n" % (self.handler.server, self.handler.port)
-        buf += "output queue size: %d\n" % (len(self.handler.connection.out_queue))
+        out_queue = self.handler.connection.out_queue
+        buf += "output queue size: %d\n" % (len(out_queue))
+        pending = {}
+        for lane, target, count in out_queue.pending():
+            pending[target] = pending.get(target, 0) + count
+        buf += "pending lines: %s\n" % (', '.join(["%s %d" % x for x in
+                                                   sorted(pending.items())])
+                                        or "none")
+        buf += "send buffer: %d lines per target\n" % out_queue.limit
+        buf += "flood control: %s\n" % self.handler.flood_control.status()
         buf += "nicklist: %s\n" % self.handler.nicknames
         buf += "nickname: %s\n" % self.handler.nickname
         buf += "username: %s\n" % self.handler.username
         buf += "realname: %s\n" % self.handler.realname
         return buf
 
+    def _queue(self):
+        pending = self.handler.connection.out_queue.pending()
+        buf = ["%-12s %-24s %d\n" % x for x in pending]
+        buf.append("total: %d\n" % sum([x[2] for x in pending]))
+        return ''.join(buf)
+
+    def _metrics(self, prometheus=False):
+        stores = [(x.name, x.get_event_count(), x.get_size())
+                  for x in self.handler.all_stores.values()]
+        queue_depth = len(self.handler.connection.out_queue)
+        if prometheus:
+            text = self.metrics.prometheus(stores, queue_depth)
+        else:
+            text = self.metrics.text(stores, queue_depth)
+        return text.rstrip('\n') # the newline is added when read
+
     def _nickinfo(self, nick):
-        buf = ["%s: %s\n" % (x, nick[x]) for x in nick]
+        buf = ["%s: %s\n" % x for x in nick.items()]
         return ''.join(buf)
 
     def _channelinfo(self, channel):
-        channel = self.handler.list_privmsg_stores()[channel]
         buf = ""
         buf += "topic: %s\n" % channel.topic
         buf += "channel modes: %s\n" % channel.channelmode
         buf += "bans (+b): %s\n" % channel.bans
         buf += "ban exceptions (+e): %s\n" % channel.exceptions
         buf += "invites (+I): %s\n" % channel.invites
-        buf += "nicknames: %d\n" % len(channel.nicknames.keys())
+        buf += "nicknames: %d\n" % len(channel.nicknames)
         return buf
 
     def _search(self, path):
         """Returns a filesystem object for the given path, if found"""
         logging.debug("ENTER _search: " + path)
+        table = self._paths
+        if table is None:
+            table = self._build_paths()[:2]
+        paths, dirs = table
+
         ret = {}
         st = MyStat()
-        if path in ['/', self.privmsgdir, self.commanddir, self.infodir, self.namesdir] :
-            logging.debug("search: this is known hardcoded dir")
-            st.st_mode = stat.S_IFDIR | 0755
-            st.st_nlink = 2
-            ret['obj'] = None
-            ret['objtype'] = 'rootdir'
+        try:
+            objtype, obj = paths[path]
+        except KeyError:
+            # the only files not in the table are the nick files under
+            # /names/#channel, look the nick up from the channel
+            node = paths.get(path[:path.rfind('/')])
+            if node is None or node[0] != 'nickdir' or \
+            not basename(path) in node[1].nicknames:
+                return None
+            logging.debug("search: this is a nick file under names/#channel")
+            ret['obj'] = self._nickinfo(node[1].nicknames[basename(path)])
+            ret['objtype'] = 'nick'
+            st.st_ino = self._nick_inode(node[1], basename(path))
+            st.st_mode = stat.S_IFREG | 0644
+            st.st_nlink = 1
+            st.st_size = len(ret['obj'])
             ret['attr'] = st
-            if path == self.privmsgdir:
-                ret['files'] = self.handler.list_privmsg_stores().keys()
-                ret['files'].append(self.commanddir[1:])
-                ret['files'].append(self.infodir[1:])
-                ret['files'].append(self.namesdir[1:])
-
-            elif path == self.commanddir:
-                ret['files'] = self.handler.list_command_stores().keys()
-            elif path == self.infodir:
-                ret['files'] = self.handler.list_info_stores().keys()
-                ret['files'].append(basename(self.statuspath))
-                ret['files'] += [x for x in self.handler.list_privmsg_stores().keys() \
-                                 if x[0] in handler.CHANCHARS]
-
-            elif path == self.namesdir:
-                ret['files'] = [x for x in \
-                             self.handler.list_privmsg_stores().keys() if \
-                             x[0] in handler.CHANCHARS]
-
             return ret
 
-
-        if path.startswith(self.namesdir + '/') and \
-        basename(path) in self.handler.list_privmsg_stores('channel').keys():
-            logging.debug("search: this is a dir under /channels")
-            # a channel dir under /channels
+        ret['objtype'] = objtype
+        ret['attr'] = st
+        st.st_ino = self._inode(path, objtype, obj)
+        if objtype in ['rootdir', 'nickdir']:
             st.st_mode = stat.S_IFDIR | 0755
             st.st_nlink = 2
             ret['obj'] = None
-            ret['attr'] = st
-            ret['files'] = self.handler.list_privmsg_stores()[basename(path)].nicknames.keys()
-            ret['objtype'] = 'nickdir'
-            return ret
-
-        if re.match("^%s/(\S+)/(\S+)$" % self.namesdir, path):
-            channel, nick = re.match("^%s/(\S+)/(\S+)$" %
-                                         self.namesdir, path).groups()
-            logging.debug("search: resolved channel %s and nick %s" % (channel, nick))
-            if channel in self.handler.list_privmsg_stores().keys() and \
-            nick in self.handler.list_privmsg_stores()[channel].nicknames.keys():
-                logging.debug("search: this is a nick file under channels/#channel")
-                # a nick file under /channels/#channel
-                ret['obj'] = self._nickinfo(self.handler.list_privmsg_stores()[channel].nicknames[nick])
-
-                ret['objtype'] = 'nick'
+            if objtype == 'nickdir':
+                ret['files'] = obj.nicknames.keys()
+            else:
+                ret['files'] = dirs[path][:]
 
+        elif objtype in ['privmsg', 'command', 'info']:
+            ret['obj'] = obj
+            if objtype == 'info':
+                st.st_mode = stat.S_IFREG | 0444
+            else:
                 st.st_mode = stat.S_IFREG | 0644
-                st.st_nlink = 1
-                st.st_size = len(ret['obj'])
-                ret['attr'] = st
-                #logging.debug("search: returning nickfile: %s" % ret)
-                return ret
-
-        if len(path) > 1 and path.count('/') == 1 and \
-        basename(path) in self.handler.list_privmsg_stores().keys():
-            logging.debug("search: this is a privmsg store")
-            ret['obj'] = self.handler.list_privmsg_stores()[basename(path)]
-            ret['objtype'] = 'privmsg'
-            st.st_mode = stat.S_IFREG | 0644
-            st.st_nlink = 1
-            st.st_size = ret['obj'].get_size()
-            st.st_ctime = ret['obj'].get_ctime()
-            try:
-                st.st_atime = ret['obj']._eventlist[-1].timestamp
-            except IndexError:
-                st.st_atime = st.st_ctime
-            st.st_mtime = st.st_atime
-            ret['attr'] = st
-            return ret
-
-        elif path.startswith(self.commanddir + '/') and \
-        basename(path) in self.handler.list_command_stores().keys():
-            logging.debug("search: this is a command store")
-            ret['obj'] = self.handler.list_command_stores()[basename(path)]
-            ret['objtype'] = 'command'
-            st.st_mode = stat.S_IFREG | 0644
             st.st_nlink = 1
-            st.st_size = ret['obj'].get_size()
-            st.st_ctime = ret['obj'].get_ctime()
+            st.st_size = obj.get_size()
+            st.st_ctime = obj.get_ctime()
             try:
-                st.st_atime = ret['obj']._eventlist[-1].timestamp
+                st.st_atime = obj._eventlist[-1].timestamp
             except IndexError:
                 st.st_atime = st.st_ctime
             st.st_mtime = st.st_atime
-            ret['attr'] = st
-            return ret
 
-        elif path.startswith(self.infodir + '/') and \
-        basename(path) in self.handler.list_info_stores().keys():
-            logging.debug("search: this is an info store")
-            ret['obj'] = self.handler.list_info_stores()[basename(path)]
-            ret['objtype'] = 'info'
-            st.st_mode = stat.S_IFREG | 0444
-            st.st_nlink = 1
-            st.st_size = ret['obj'].get_size()
-            st.st_ctime = ret['obj'].get_ctime()
-            try:
-                st.st_atime = ret['obj']._eventlist[-1].timestamp
-            except IndexError:
-                st.st_atime = st.st_ctime
-            st.st_mtime = st.st_atime
-            ret['attr'] = st
-            return ret
-
-        elif path.startswith(self.infodir + '/') and \
-        basename(path) in self.handler.list_privmsg_stores().keys():
-            ret['obj'] = self._channelinfo(basename(path))
-            ret['objtype'] = 'channelinfo'
-            st.st_mode = stat.S_IFREG | 0444
-            st.st_nlink = 1
-            st.st_size = len(ret['obj'])
-            st.st_mtime = self.handler.connection_status_timestamp
-            st.st_atime = st.st_mtime
-            ret['attr'] = st
-            return ret
-
-        elif path == self.statuspath:
-            ret['obj'] = self._status()
-            ret['objtype'] = 'status'
+        else:
+            if objtype == 'channelinfo':
+                ret['obj'] = self._channelinfo(obj)
+            elif objtype == 'status':
+                ret['obj'] = self._status()
+            elif objtype == 'queue':
+                ret['obj'] = self._queue()
+            elif objtype in ['metrics', 'prometheus']:
+                ret['obj'] = self._metrics(objtype == 'prometheus')
             st.st_mode = stat.S_IFREG | 0444
             st.st_nlink = 1
             st.st_size = len(ret['obj'])
             st.st_mtime = self.handler.connection_status_timestamp
             st.st_atime = st.st_mtime
-            ret['attr'] = st
-            return ret
+        return ret
 
     def _read_store_contents(self, store):
-        if store['objtype'] in ['nick', 'status', 'channelinfo']:
+        if store['objtype'] in ['nick', 'status', 'queue', 'channelinfo',
+                                'metrics', 'prometheus']:
             # return "special" file object contents
             return str(store['obj']) + '\n'
         else:
@@ -248,6 +470,14 @@ class PyIrcFS(Fuse):
             return '\n'.join(store['obj'].get_contents()) + '\n'
 
 
+    def _unchanged(self, store, buf, offset):
+        """returns how many bytes from the beginning of buf, written at
+        offset, are already in the file"""
+        if store['objtype'] in ['privmsg', 'command']:
+            return store['obj'].match_contents(buf, offset)
+        contents = self._read_store_contents(store)
+        return events.matching_lines(buf, contents[offset:offset+len(buf)])
+
     def fsdestroy(self):
         if self.handler.connection_status[0] in (1, 10):
             self.handler.send_command("QUIT", "pyircfs %s unmounted" %
@@ -257,11 +487,13 @@ class PyIrcFS(Fuse):
 
             while not self.handler.connection_status[0] == 100:
                 time.sleep(0.1)
+        if self.handler.trace is not None:
+            self.handler.trace.close()
 
 
     def truncate(self, path, size):
         return 0
-    def fsync(self, path, isfsyncfile):
+    def fsync(self, path, isfsyncfile, fh=None):
         return 0
     def utime(self, path, times):
         return 0
@@ -328,6 +560,7 @@ class PyIrcFS(Fuse):
             return s['attr']
         else:
             raise OSError(errno.ENOENT, "no such file or directory", path)
+    getattr = timed('getattr', getattr)
 
     def readdir(self, path, offset):
         stores = self._search(path)
@@ -338,6 +571,7 @@ class PyIrcFS(Fuse):
 
         for i in ['.', '..'] + sorted(stores):
             yield fuse.Direntry(i)
+    readdir = timed('readdir', readdir)
 
     def open(self, path, flags):
         logging.debug("ENTER open - path %s flags %s" % (path, flags))
@@ -348,18 +582,42 @@ class PyIrcFS(Fuse):
         if not store:
             raise OSError(errno.ENOENT, "no such file", path)
 
-        if (flags & os.O_RDONLY == os.O_RDONLY):
-            return 0   #reading is always supported
-
         if store['objtype'] == 'info' and (flags & accmode) != os.O_RDONLY:
             raise OSError(errno.EACCES, "permission denied", path)
 
-    def read(self, path, size, offset):
+        if store['objtype'] in ['metrics', 'prometheus']:
+            # someone is looking, time the latencies from now on
+            self.metrics.enabled = True
+
+        if store['objtype'] in ['nick', 'status', 'queue', 'channelinfo',
+                                'metrics', 'prometheus']:
+            # made up on every read, the kernel mustn't cache them
+            return OpenFile(flags, direct_io=True, store=store)
+
+        if self.eofwait and store['objtype'] in ['privmsg', 'command', 'info'] \
+        and not flags & os.O_NONBLOCK:
+            # reads past the size the kernel knows of must reach read() to
+            # be able to wait there for new lines
+            return OpenFile(flags, direct_io=True, store=store)
+
+        return OpenFile(flags, store=store)
+
+    def read(self, path, size, offset, fh=None):
 
         store = self._search(path)
         if not store:
             raise OSError(errno.ENOENT, 'no such file or directory', path)
 
+        if store['objtype'] in ['privmsg', 'command', 'info']:
+            obj = store['obj']
+            if self.eofwait and offset >= obj.get_size():
+                self._wait_for_lines(obj, offset)
+            # message stores can find the requested range by themselves
+            buf = obj.read_contents(offset, size)
+            if fh is not None:
+                fh.read_end = offset + len(buf)
+            return buf
+
         contents = self._read_store_contents(store)
 
         slen = len(contents)
@@ -370,76 +628,218 @@ class PyIrcFS(Fuse):
         else:
             buf = ''
         return buf
+    read = timed('read', read)
+
+    def _wait_for_lines(self, store, offset):
+        """blocks until store grows past offset, or for eofwait seconds"""
+        deadline = time.time() + float(self.eofwait)
+        condition = self._condition(store)
+        with condition:
+            while store.get_size() <= offset:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                condition.wait(remaining)
+
+    def poll(self, path, pollhandle, fh=None):
+        """message store files are readable when they have grown past where
+        the last read of fh ended, otherwise pollhandle is notified when
+        they do"""
+        store = self._search(path)
+        if not store:
+            raise OSError(errno.ENOENT, 'no such file or directory', path)
+        readable = select.POLLIN | select.POLLRDNORM
+        if store['objtype'] not in ['privmsg', 'command', 'info']:
+            return readable
+        obj = store['obj']
+        read_end = fh is not None and fh.read_end or 0
+        with self._waiters_lock:
+            if obj.get_size() > read_end:
+                return readable
+            if pollhandle is not None:
+                self._pollhandles.setdefault(obj, []).append(pollhandle)
+        return 0
 
-    def write(self, path, buf, offset):
+    def write(self, path, buf, offset, fh=None):
         logging.debug("ENTER write: path: %s offset: %s buf: %s" % (path, offset, buf) )
-        if path.startswith(self.privmsgdir):
-            stype = 'privmsg'
-        if path.startswith(self.commanddir):
-            stype = 'command'
-        elif path.startswith(self.infodir):
+        if path.startswith(self.infodir):
             raise OSError(errno.EACCES, "permission denied", path)
-        elif path.startswith(self.namesdir):
-            stype = 'nick'
-
-        file = path[path.rindex('/')+1:]
-
-        logging.debug("write: resolved stype: %s file: %s" % (stype, file))
+        if fh is None:
+            # no open file to keep the partial lines in, every write is
+            # sent as it is
+            fh = OpenFile(os.O_WRONLY, store=self._search(path))
+            self._write(path, buf, offset, fh)
+            self.flush(path, fh)
+            return len(buf)
+        return self._write(path, buf, offset, fh)
+    write = timed('write', write)
 
+    def _write(self, path, buf, offset, fh):
+        """adds buf written at offset to the lines written to fh"""
         try:
-            if stype in ['privmsg', 'nick']:
-                method = self.handler.send_message
-            elif stype == 'command':
-                method = self.handler.send_command
-
-            # Attempt to handle cases where the whole file is rewritten
-            # instead of being attempted to -- skip the part from beginning
-            # or end that matches the existing contents - necessary for
-            # at least osxfuse and text editor use
-
-            send_buf = buf # truncating the buf object used in write() iocall
-                           # causes an i/o error to client
-            try:
-                store = self._search(path)
-                if store:
-                    storecontents = self._read_store_contents(store)
-                    #logging.debug("storecontents: %s " % storecontents)
-                    buf_index = buf.find(storecontents)
-                    if len(storecontents) > 1 and buf_index == 0:
-                        # truncate what will be written to file because it
-                        # contains the beginning already
-                        logging.debug("write: TRUNCATING buf by %s bytes" % (len(storecontents)))
-                        send_buf = buf[len(storecontents):]
-
-                    elif len(storecontents) > 0 and buf_index == -1:
-                        # osxfuse (?) special case for "command > buffer"
-                        # redirections from cmdline, where buf starts with new
-                        # content and rest of it is the old store contents,
-                        # attempt to prevent spamming
-                        i = 0
-                        # walk through lines and look for position where rest
-                        # are contained in the store. line by line is enough
-                        logging.debug("write: looking for contents in the beginning")
-                        while i != -1:
-                            i = buf.find('\n', i) + 1 # get next newline in buf
-                            if buf[i:] in storecontents:
-                                logging.debug("write: TRUNCATING buf from position %s to: %s" % (i, buf[:i]))
-                                send_buf = buf[:i]
-                                break
-
-            except:
-                logging.debug("write: exception?")
-
-            for i in send_buf.split('\n'):
-                if i:
-                    method(file, i.rstrip('\r\n'))
-                    if len(self.handler.connection.out_queue) > 30: # why?
-                        time.sleep(2.3) #
-
+            if fh.offset is not None and \
+            offset != fh.offset + fh.pending_size:
+                # not a continuation of what was written before
+                self._flush_writes(path, fh)
+            if fh.offset is None:
+                fh.offset = offset
+                fh.appending = self._appends(fh.store, buf, offset)
+            elif not fh.appending and self._appends(fh.store, buf, offset):
+                # what looked like a rewrite goes on with new lines, the
+                # part written so far is cut to what isn't in the file
+                written = fh.take_pending()
+                new = self._new_part(fh.store, written, fh.offset)
+                fh.offset += len(written) - len(new)
+                if new:
+                    fh.add_pending(new)
+                fh.appending = True
+            rest = buf
+            if fh.appending:
+                # whole lines are sent right away, a line split between two
+                # writes waits for its end
+                end = buf.rfind('\n') + 1
+                if end:
+                    data = ''.join(fh.pending) + buf[:end]
+                    sent = self._send_lines(path, fh, data)
+                    fh.take_pending()
+                    fh.offset += sent
+                    if sent < len(data):
+                        # a short write, the rest is written again
+                        return sent - (len(data) - end)
+                    rest = buf[end:]
+            # a rewrite is compared to the file contents once it is all
+            # written
+            if rest:
+                fh.add_pending(rest)
         except ConnectionError:
             raise OSError(errno.ENOTCONN, "not connected to server", path)
+        return len(buf)
+
+    def flush(self, path, fh=None):
+        if fh is not None and fh.offset is not None:
+            try:
+                self._flush_writes(path, fh)
+            except ConnectionError:
+                raise OSError(errno.ENOTCONN, "not connected to server", path)
+        return 0
+
+    def release(self, path, flags, fh=None):
+        return self.flush(path, fh)
+
+    def _appends(self, store, buf, offset):
+        """tells whether buf written at offset is new lines rather than a
+        rewrite of the file. Decided for each write, as the file grows by
+        the lines sent and received."""
+        if offset >= self._store_size(store):
+            return True
+        # the size the kernel knows of may be behind the store when its
+        # attributes can't be invalidated, so bytes that don't match the
+        # file at offset are new too. At 0 they are left to _new_part, for
+        # "command > file"
+        return offset > 0 and not self._unchanged(store, buf, offset)
+
+    def _store_size(self, store):
+        if not store:
+            return 0
+        if store['objtype'] in ['privmsg', 'command']:
+            return store['obj'].get_size()
+        return len(self._read_store_contents(store))
+
+    def _flush_writes(self, path, fh):
+        """sends what is left of the lines written to fh, which ends the
+        write"""
+        offset = fh.offset
+        data = fh.take_pending()
+        fh.offset = None
+        if not fh.appending:
+            data = self._new_part(fh.store, data, offset)
+        self._send_lines(path, fh, data, block=True)
+
+    def _new_part(self, store, buf, offset):
+        """returns the part of buf written at offset that isn't in the file
+        already"""
+        # Attempt to handle cases where the whole file is rewritten
+        # instead of being appended to -- skip the part that matches the
+        # existing contents at the offset written to - necessary for
+        # at least osxfuse and text editor use. Only the bytes written
+        # are looked at.
+        if not store:
+            return buf
+        unchanged = self._unchanged(store, buf, offset)
+        if unchanged:
+            logging.debug("write: TRUNCATING buf by %s bytes" % unchanged)
+            return buf[unchanged:]
+        elif offset == 0 and store['objtype'] in ['privmsg', 'command']:
+            # osxfuse (?) special case for "command > buffer"
+            # redirections from cmdline, where buf starts with new
+            # content and rest of it is the old store contents,
+            # attempt to prevent spamming
+            return buf[:store['obj'].find_contents(buf)]
+        return buf
+
+    def _send_lines(self, path, fh, buf, block=False):
+        """sends the lines in buf to the channel, nick or command written to,
+        returns the number of bytes of buf sent. Waits for room in the send
+        buffer unless fh is non-blocking: then as many lines are sent as
+        there is room for, or if none, EAGAIN is raised. With block set a
+        non-blocking fh sends all its lines without waiting."""
+        if path.startswith(self.commanddir):
+            stype = 'command'
+            method = self.handler.send_command
         else:
-            return len(buf)
+            stype = 'privmsg'
+            method = self.handler.send_message
+        file = basename(path)
+
+        lines = []
+        ends = [] # where each line ends in buf
+        pos = 0
+        for x in buf.split('\n'):
+            pos += len(x) + 1
+            if x:
+                lines.append(x.rstrip('\r\n'))
+                ends.append(min(pos, len(buf)))
+        if len(lines) > 1:
+            # a paste gets in line after what is typed in by hand
+            fh.lane = connection.BULK
+        elif fh.lane is None:
+            fh.lane = connection.INTERACTIVE
+        # the lane of a file only changes from interactive to bulk, so that
+        # its lines go out in the order they were written even when a paste
+        # comes in chunks, or ends with a line sent on flush
+        lane = fh.lane
+        queue = self.handler.connection.out_queue
+        targets = [self._send_target(stype, file, x) for x in lines]
+        count = len(lines)
+        if fh.nonblocking and not block:
+            # raw lines may go to several targets, each must have room
+            rooms = {}
+            for i, target in enumerate(targets):
+                if target not in rooms:
+                    rooms[target] = queue.room(target)
+                if not rooms[target]:
+                    count = i
+                    break
+                rooms[target] -= 1
+            if lines and not count:
+                raise OSError(errno.EAGAIN, "send buffer full", path)
+        for line, target in zip(lines, targets)[:count]:
+            while not fh.nonblocking and not queue.wait_for_room(target, 1):
+                if not self.handler.connection.running:
+                    raise ConnectionError("connection lost")
+            method(file, line, lane=lane)
+        if count < len(lines):
+            return ends[count - 1]
+        return len(buf)
+
+    def _send_target(self, stype, file, line):
+        """returns the send queue target a line written to file goes to,
+        asked from the queue with the line the command store makes of it"""
+        if stype == 'command':
+            if file.upper() != 'RAW': # raw lines are sent as they are
+                line = "%s %s" % (file.upper(), line)
+            return connection.SendQueue.target(line)
+        return file
 
     def create(self, path, flags, mode):
         if path.startswith(self.privmsgdir):
@@ -465,6 +865,7 @@ class PyIrcFS(Fuse):
                 raise OSError(errno.ENOENT, "unknown command", path)
         else:
             raise OSError(errno.EACCES)
+        return OpenFile(flags, store=self._search(path))
 
     def unlink(self, path):
         store = self._search(path)
@@ -488,20 +889,88 @@ def main():
     server.username = os.getenv('LOGNAME')
     server.realname = os.getenv('LOGNAME')
     server.server = ''
+    server.port = 6667
+    server.maxevents = 0
+    server.spooldir = None
+    server.backend = 'list'
+    server.eofwait = 0
+    server.trace = ''
+    server.sendbuffer = connection.SendQueue.limit
+    server.engine = 'thread'
+    server.floodrate = 0.5
+    server.floodburst = 4
+    server.floodbyterate = 120
+    server.floodbyteburst = 1024
     server.multithreaded = 1
     server.parser.add_option(mountopt="server",
                              help="IRC server address")
+    server.parser.add_option(mountopt="port",
+                             help="IRC server port (default: %s)" % server.port)
     server.parser.add_option(mountopt="nickname",
                              help="nickname (default: %s)" % server.nickname)
     server.parser.add_option(mountopt="altnick",
                              help="alternative nickname (default: none)")
     server.parser.add_option(mountopt="username",
                              help="username (default: %s)" %server.username)
+    server.parser.add_option(mountopt="maxevents",
+                             help="events kept in memory per file, older ones "
+                                  "are moved to disk (default: no limit)")
+    server.parser.add_option(mountopt="spooldir",
+                             help="directory for the events moved to disk "
+                                  "(default: system temp directory)")
+    server.parser.add_option(mountopt="backend",
+                             help="how events are kept in memory, 'list' "
+                                  "keeps them as objects and their lines "
+                                  "rendered, 'columnar' packs them to "
+                                  "arrays and renders lines when read "
+                                  "(default: %s)" % server.backend)
+    server.parser.add_option(mountopt="eofwait",
+                             help="seconds a read at the end of a channel, "
+                                  "query, command or info file waits for new "
+                                  "lines, so that e.g. cat follows the file "
+                                  "(default: %s, don't wait)" % server.eofwait)
+    server.parser.add_option(mountopt="trace",
+                             help="file to record the lines received to, "
+                                  "for bench/replay.py (default: none)")
+    server.parser.add_option(mountopt="sendbuffer",
+                             help="lines that may wait to be sent per "
+                                  "channel or nick, writes wait for room or "
+                                  "fail with EAGAIN if opened non-blocking "
+                                  "(default: %s)" % server.sendbuffer)
+    server.parser.add_option(mountopt="engine",
+                             help="connection engine, 'thread' sends with "
+                                  "blocking writes, 'async' waits for the "
+                                  "socket to be writable "
+                                  "(default: %s)" % server.engine)
+    server.parser.add_option(mountopt="floodrate",
+                             help="lines per second sent in the long run, 0 "
+                                  "is no limit (default: %s)" %
+                                  server.floodrate)
+    server.parser.add_option(mountopt="floodburst",
+                             help="lines that may be sent at once "
+                                  "(default: %s)" % server.floodburst)
+    server.parser.add_option(mountopt="floodbyterate",
+                             help="bytes per second sent in the long run, 0 "
+                                  "is no limit (default: %s)" %
+                                  server.floodbyterate)
+    server.parser.add_option(mountopt="floodbyteburst",
+                             help="bytes that may be sent at once "
+                                  "(default: %s)" % server.floodbyteburst)
     server.parser.add_option(mountopt="realname",
                              help="username (default: %s)" %server.username)
 
     server.parse(values=server, errex=1)
 
+    # the kernel may cache the contents of store files as long as their
+    # modification time stays the same; as stores only grow, old contents
+    # never change
+    server.fuse_args.add('use_ino')
+    server.fuse_args.add('auto_cache')
+    for option, default in (('entry_timeout', ENTRY_TIMEOUT),
+                            ('attr_timeout', ATTR_TIMEOUT)):
+        if not option in server.fuse_args.optdict:
+            server.fuse_args.add(option, str(default))
+
     if not server.server:
         if server.parser.fuse_args.modifiers['showversion'] or \
            server.parser.fuse_args.modifiers['showhelp']:
@@ -509,6 +978,14 @@ def main():
         print "Please specify mount point and (at least) IRC server!"
         server.parser.print_help()
         sys.exit(-1)
+    if not server.backend in events.BACKENDS:
+        print "Unknown store backend %s, use one of: %s" % \
+              (server.backend, ', '.join(sorted(events.BACKENDS)))
+        sys.exit(-1)
+    if not server.engine in handler.ENGINES:
+        print "Unknown connection engine %s, use one of: %s" % \
+              (server.engine, ', '.join(sorted(handler.ENGINES)))
+        sys.exit(-1)
 
     # start running the server loop
     server.main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+
+Helpers shared by the tests. Run the tests from the top level directory
+with python -m unittest discover tests
+'''
+
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import lib.connection as connection
+import lib.events as events
+import lib.handler as handler
+
+
+class FakeConnection:
+    """stands in for lib.connection.Connection without a socket, keeps the
+    lines sent in a SendQueue like the real one"""
+
+    def __init__(self):
+        self.out_queue = connection.SendQueue()
+
+    def send(self, line, lane=None, target=None):
+        self.out_queue.push(line, lane, target)
+
+    def sent(self):
+        """returns the lines sent so far, in the order they go out"""
+        lines = []
+        while True:
+            try:
+                lines.append(self.out_queue.pop().rstrip('\r\n'))
+            except IndexError:
+                return lines
+
+    def close(self):
+        pass
+
+
+def make_handler(nickname='me'):
+    """returns a Handler that believes it is connected and registered"""
+    h = handler.Handler()
+    h.connection = FakeConnection()
+    h.nickname = nickname
+    h.nicknames = [nickname]
+    h.username = nickname
+    h.realname = nickname
+    h.connection_status = (10, 'test')
+    return h
+
+
+def make_fs():
+    """returns a PyIrcFS on a handler from make_handler, joined to #c"""
+    import pyircfs # needs fuse, unlike the rest
+    fs = pyircfs.PyIrcFS()
+    h = make_handler()
+    h.new_store_callbacks.append(fs._new_store)
+    h.rename_callbacks.append(fs._store_renamed)
+    h._create_new_store(events.EventStore, replies=['*'], name="all_recv")
+    fs.handler = h
+    h.receive_message(":me!u@h JOIN :#c")
+    h.connection.sent() # the WHO and MODE queries after joining
+    return fs
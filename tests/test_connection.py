@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+'''
+
+import os, socket, threading, time, unittest
+
+import common # puts the top level directory to sys.path
+import lib.connection as connection
+
+
+def unused_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class AsyncConnectionTest(unittest.TestCase):
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), "needs /proc")
+    def test_failed_connect_leaks_nothing(self):
+        port = unused_port()
+        statuses = []
+        before = len(os.listdir('/proc/self/fd'))
+        for i in range(5):
+            conn = connection.AsyncConnection('127.0.0.1', port, None,
+                                              lambda *x: statuses.append(x))
+            conn.send("PRIVMSG someone :queued before connecting")
+            conn.run()
+        self.assertEqual(len(os.listdir('/proc/self/fd')), before)
+        self.assertEqual([x[0] for x in statuses], [103] * 5)
+
+
+
+class LineFramerTest(unittest.TestCase):
+
+    def test_overlapping_tail_is_kept(self):
+        framer = connection.LineFramer(16)
+        framer.feed("ab\n0123456789")
+        self.assertEqual(framer.lines(), ['ab'])
+        # the 10 byte tail at 3..13 is moved to 0..10 to make room
+        framer.feed("abcd\n")
+        self.assertEqual(len(framer.buffer), 16)
+        self.assertEqual(framer.lines(), ['0123456789abcd'])
+        self.assertEqual(len(framer), 0)
+
+    def test_growing(self):
+        framer = connection.LineFramer(16)
+        framer.feed("x\n" + "y" * 20)
+        framer.lines()
+        framer.feed("z" * 20 + "\r\n")
+        self.assertEqual(framer.lines(), ["y" * 20 + "z" * 20])
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_zero_rate_is_no_limit(self):
+        bucket = connection.TokenBucket(rate=0, burst=1, byterate=0,
+                                        byteburst=10)
+        for i in range(100):
+            self.assertEqual(bucket.delay(500), 0)
+            bucket.consume(500)
+
+    def test_rate(self):
+        bucket = connection.TokenBucket(rate=2, burst=1, byterate=0)
+        self.assertEqual(bucket.delay(10), 0)
+        bucket.consume(10)
+        self.assertAlmostEqual(bucket.delay(10), 0.5, places=1)
+
+    def test_status_from_another_thread(self):
+        started = time.time()
+        bucket = connection.TokenBucket(rate=1000, burst=1000, byterate=0)
+        def read_status():
+            for i in range(5000):
+                bucket.status()
+        reader = threading.Thread(target=read_status)
+        reader.start()
+        for i in range(5000):
+            bucket.consume(10)
+        reader.join()
+        # a refill counted twice would leave more lines than the time
+        # since the start refills
+        refilled = (time.time() - started) * bucket.rate
+        self.assertTrue(bucket._lines <= 1000 - 5000 + refilled)
+
+
+class ThreadConnectionTest(unittest.TestCase):
+
+    def test_lines_go_out_without_polling(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        statuses = []
+        conn = connection.Connection('127.0.0.1', listener.getsockname()[1],
+                                     lambda line: None,
+                                     lambda *x: statuses.append(x),
+                                     flood=connection.TokenBucket(rate=0,
+                                                                  byterate=0))
+        conn.daemon = True
+        conn.start()
+        server = listener.accept()[0]
+        listener.close()
+        server.settimeout(5)
+        try:
+            # well below the time one line per 0.2 second tick would take
+            started = time.time()
+            received = ''
+            for i in range(50):
+                conn.send("PRIVMSG #c :line %d" % i)
+                while not received.endswith('line %d\r\n' % i):
+                    received += server.recv(4096)
+            self.assertTrue(time.time() - started < 2)
+            conn.close()
+            conn.join(5)
+            self.assertFalse(conn.isAlive())
+            self.assertEqual(statuses[-1][0], 100)
+        finally:
+            server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
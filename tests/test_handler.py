@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+'''
+
+import unittest
+
+from common import make_handler
+
+
+class RenameTest(unittest.TestCase):
+
+    def setUp(self):
+        self.h = make_handler()
+        for line in [":bob!b@h PRIVMSG me :hi", ":alice!a@h PRIVMSG me :hello"]:
+            self.h.receive_message(line)
+        self.bob = self.h.privmsg_stores['bob']
+        self.alice = self.h.privmsg_stores['alice']
+
+    def test_rename(self):
+        self.h.receive_message(":bob!b@h NICK :robert")
+        self.assertTrue(self.h.privmsg_stores['robert'] is self.bob)
+        self.assertFalse('bob' in self.h.privmsg_stores)
+        self.assertEqual(self.bob.target, 'robert')
+
+    def test_rename_onto_existing_query(self):
+        # alice takes the nick bob had, the query with bob is kept
+        self.h.receive_message(":bob!b@h NICK :robert")
+        self.h.receive_message(":robert!b@h PRIVMSG me :bye")
+        self.h.receive_message(":alice!a@h NICK :Robert")
+        stores = self.h.privmsg_stores
+        self.assertTrue(stores['robert'] is self.bob)
+        self.assertTrue(stores['alice'] is self.alice)
+        self.assertEqual(self.alice.target, 'alice')
+        self.assertEqual(sorted(self.h.list_privmsg_stores()),
+                         ['alice', 'robert'])
+        # both are still reachable and get what is theirs
+        self.h.receive_message(":Robert!a@h PRIVMSG me :it's alice")
+        self.assertTrue(self.bob.get_contents()[-1].endswith("it's alice"))
+        self.assertTrue(self.alice.get_contents()[-1].endswith(
+                        ":alice!a@h NICK :Robert"))
+
+
+class MemberChannelsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.h = make_handler()
+        for line in [":me!u@h JOIN :#c", ":me!u@h JOIN :#d",
+                     ":x!u@h JOIN :#c", ":x!u@h JOIN :#d"]:
+            self.h.receive_message(line)
+        self.c = self.h.privmsg_stores['#c']
+        self.d = self.h.privmsg_stores['#d']
+
+    def test_one_channel_and_more(self):
+        self.assertEqual(self.h.member_channels['x'], set([self.c, self.d]))
+        self.h.receive_message(":X!u@h PART #d")
+        self.assertTrue(self.h.member_channels['x'] is self.c)
+        self.h.receive_message(":x!u@h PART #c")
+        self.assertFalse('x' in self.h.member_channels)
+
+    def test_quit_goes_to_the_channels_of_the_nick(self):
+        self.h.receive_message(":y!u@h JOIN :#d")
+        self.h.receive_message(":x!u@h QUIT :gone")
+        self.h.receive_message(":y!u@h QUIT :gone too")
+        self.assertTrue("gone" in self.c.get_contents()[-1])
+        self.assertTrue("gone too" in self.d.get_contents()[-1])
+        self.assertFalse("gone too" in ''.join(self.c.get_contents()))
+
+
+class CommandStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.h = make_handler()
+        self.h.receive_message(":me!u@h JOIN :#c")
+        # the WHO and MODE sent after joining make their stores
+        self.commands = sorted(self.h.list_command_stores())
+
+    def test_channel_replies_make_no_stores(self):
+        for line in [":x!u@h JOIN :#c", ":x!u@h PART #c :bye",
+                     ":y!u@h JOIN :#c", ":me!u@h KICK #c y :out",
+                     ":x!u@h JOIN :#d", ":x!u@h QUIT :gone",
+                     ":z!u@h QUIT :not seen"]:
+            self.h.receive_message(line)
+        self.assertEqual(sorted(self.h.list_command_stores()), self.commands)
+
+    def test_used_command_gets_its_replies(self):
+        self.h.send_command('PART', '#c :leaving')
+        self.h.receive_message(":x!u@h PART #c :bye")
+        part = self.h.list_command_stores()['part']
+        self.assertTrue(part.get_contents()[-1].endswith("PART #c :bye"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+'''
+
+import os, select, threading, time, unittest
+
+from common import make_fs
+
+READABLE = select.POLLIN | select.POLLRDNORM
+
+
+class PollTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fs = make_fs()
+        self.notified = []
+        self.fs.NotifyPoll = self.notified.append
+
+    def read_all(self, fh):
+        return self.fs.read('/#c', 65536, fh.read_end, fh)
+
+    def test_handles_are_apart(self):
+        a = self.fs.open('/#c', os.O_RDONLY)
+        b = self.fs.open('/#c', os.O_RDONLY)
+        self.fs.handler.receive_message(":x!u@h PRIVMSG #c :hello")
+        self.assertTrue(self.read_all(a))
+        self.assertEqual(self.fs.poll('/#c', 'a', a), 0)
+        # a didn't read for b
+        self.assertEqual(self.fs.poll('/#c', 'b', b), READABLE)
+        self.assertTrue(self.read_all(b))
+        self.assertEqual(self.fs.poll('/#c', 'b', b), 0)
+
+        self.fs.handler.receive_message(":x!u@h PRIVMSG #c :again")
+        self.assertEqual(sorted(self.notified), ['a', 'b'])
+        self.assertEqual(self.fs.poll('/#c', 'a', a), READABLE)
+
+    def test_other_store_doesnt_notify(self):
+        a = self.fs.open('/#c', os.O_RDONLY)
+        self.read_all(a)
+        self.assertEqual(self.fs.poll('/#c', 'a', a), 0)
+        self.fs.handler.receive_message(":x!u@h PRIVMSG me :private")
+        self.assertEqual(self.notified, [])
+
+
+class InvalidateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fs = make_fs()
+        self.invalidated = []
+        self.fs.Invalidate = lambda path: self.invalidated.append(path) or 0
+        self.fs._search('/')
+
+    def test_only_the_file_that_grew(self):
+        builds = []
+        build_paths = self.fs._build_paths
+        self.fs._build_paths = lambda: builds.append(1) or build_paths()
+        self.fs._invalidate_paths() # as a new store does
+        self.fs.handler.receive_message(":x!u@h PRIVMSG #c :hello")
+        self.assertEqual(sorted(self.invalidated), ['/#c', '/info/all_recv'])
+        self.assertEqual(builds, [])
+
+    def test_without_invalidate(self):
+        import pyircfs
+        # as with a python-fuse without Invalidate
+        Invalidate = pyircfs.Fuse.__dict__.get('Invalidate')
+        if Invalidate is not None:
+            del pyircfs.Fuse.Invalidate
+        try:
+            fs = make_fs()
+        finally:
+            if Invalidate is not None:
+                pyircfs.Fuse.Invalidate = Invalidate
+        self.assertFalse(fs._can_invalidate)
+        fs._search('/')
+        fs.handler.receive_message(":x!u@h PRIVMSG #c :hello")
+        fs.unlink('/#c')
+
+    def test_nick_inodes_are_forgotten(self):
+        h = self.fs.handler
+        for i in range(200):
+            h.receive_message(":n%d!u@h JOIN :#c" % i)
+            self.assertTrue(self.fs.getattr('/names/#c/n%d' % i).st_ino)
+            h.receive_message(":n%d!u@h PART #c" % i)
+        self.assertTrue(len(self.fs._nick_inodes.values()[0]) <= 20)
+        self.fs.unlink('/#c')
+        self.assertEqual(self.fs._nick_inodes, {})
+
+
+class EofWaitTest(unittest.TestCase):
+
+    def test_read_waits_for_its_store(self):
+        fs = make_fs()
+        fs.eofwait = 5
+        fh = fs.open('/#c', os.O_RDONLY)
+        end = fs.getattr('/#c').st_size
+        result = []
+        reader = threading.Thread(target=lambda:
+                                  result.append(fs.read('/#c', 100, end, fh)))
+        reader.start()
+        time.sleep(0.1)
+        fs.handler.receive_message(":x!u@h PRIVMSG me :not for #c")
+        time.sleep(0.1)
+        self.assertTrue(reader.isAlive())
+        started = time.time()
+        fs.handler.receive_message(":x!u@h PRIVMSG #c :hello")
+        reader.join(5)
+        self.assertTrue(time.time() - started < 1)
+        self.assertTrue(result[0].endswith("<x> hello\n"))
+        self.assertEqual(fh.read_end, end + len(result[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 17.10.2026
+'''
+
+import os, errno, unittest
+
+from common import make_fs
+
+
+class PasteOrderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fs = make_fs()
+        self.paste = ''.join(["line%d\n" % i for i in range(9)]) + "line9"
+        self.expected = ["PRIVMSG #c :line%d" % i for i in range(10)]
+
+    def write(self, chunks):
+        fh = self.fs.open('/#c', os.O_WRONLY)
+        offset = self.fs.getattr('/#c').st_size
+        for chunk in chunks:
+            self.fs.write('/#c', chunk, offset, fh)
+            offset += len(chunk)
+        self.fs.release('/#c', os.O_WRONLY, fh)
+        return self.fs.handler.connection.sent()
+
+    def test_paste_without_newline(self):
+        self.assertEqual(self.write([self.paste]), self.expected)
+
+    def test_paste_in_chunks(self):
+        for size in (1, 3, 6, 7, 13, 40):
+            chunks = [self.paste[i:i+size]
+                      for i in range(0, len(self.paste), size)]
+            self.assertEqual(self.write(chunks), self.expected,
+                             "chunks of %d bytes" % size)
+
+    def test_typed_line_goes_before_paste(self):
+        fs = self.fs
+        fh = fs.open('/#c', os.O_WRONLY)
+        offset = fs.getattr('/#c').st_size
+        fs.write('/#c', self.paste + "\n", offset, fh)
+        # someone types into another channel while the paste waits
+        fs.handler.receive_message(":me!u@h JOIN :#d")
+        other = fs.open('/#d', os.O_WRONLY)
+        fs.write('/#d', "hello\n", fs.getattr('/#d').st_size, other)
+        fs.release('/#d', os.O_WRONLY, other)
+        fs.release('/#c', os.O_WRONLY, fh)
+        sent = [x for x in fs.handler.connection.sent()
+                if x.startswith('PRIVMSG')]
+        self.assertEqual(sent, ["PRIVMSG #d :hello"] + self.expected)
+
+
+class AppendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fs = make_fs()
+        for i in range(3):
+            self.fs.handler.receive_message(":x!u@h PRIVMSG #c :hi %d" % i)
+
+    def test_append_behind_the_store(self):
+        # the kernel's size from before the last line arrived
+        offset = self.fs.getattr('/#c').st_size - 10
+        fh = self.fs.open('/#c', os.O_WRONLY | os.O_APPEND)
+        self.fs.write('/#c', "hello\n", offset, fh)
+        self.assertEqual(self.fs.handler.connection.sent(),
+                         ["PRIVMSG #c :hello"])
+        self.fs.write('/#c', "second\n", offset + 6, fh)
+        self.assertEqual(self.fs.handler.connection.sent(),
+                         ["PRIVMSG #c :second"])
+
+    def test_rewrite_with_new_lines(self):
+        contents = self.fs.read('/#c', 65536, 0)
+        fh = self.fs.open('/#c', os.O_WRONLY)
+        self.fs.write('/#c', contents[:20], 0, fh)
+        self.fs.write('/#c', contents[20:], 20, fh)
+        self.assertEqual(self.fs.handler.connection.sent(), [])
+        self.fs.write('/#c', "new\n", len(contents), fh)
+        self.assertEqual(self.fs.handler.connection.sent(),
+                         ["PRIVMSG #c :new"])
+        self.fs.release('/#c', os.O_WRONLY, fh)
+        self.assertEqual(self.fs.handler.connection.sent(), [])
+
+
+class SendBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fs = make_fs()
+        self.queue = self.fs.handler.connection.out_queue
+        self.queue.limit = 2
+        for i in range(2):
+            self.queue.push("PRIVMSG #x :queued %d\r\n" % i)
+
+    def write(self, path, line):
+        """writes line to path opened non-blocking, returns the errno"""
+        flags = os.O_WRONLY | os.O_NONBLOCK
+        fh = self.fs.create(path, flags, 0644)
+        try:
+            self.fs.write(path, line, self.fs.getattr(path).st_size, fh)
+        except OSError, e:
+            return e.errno
+        return 0
+
+    def test_raw_lines_wait_for_their_target(self):
+        self.assertEqual(self.write('/commands/raw', "PRIVMSG #x :full\n"),
+                         errno.EAGAIN)
+        self.assertEqual(self.write('/commands/raw', "PRIVMSG #y :room\n"), 0)
+
+    def test_commands_wait_for_their_target(self):
+        self.assertEqual(self.write('/commands/mode', "#x +m\n"),
+                         errno.EAGAIN)
+        self.assertEqual(self.write('/commands/mode', "#y +m\n"), 0)
+
+    def test_short_write_of_what_fits(self):
+        fh = self.fs.open('/#c', os.O_WRONLY | os.O_NONBLOCK)
+        offset = self.fs.getattr('/#c').st_size
+        paste = ''.join(["line%d\n" % i for i in range(5)])
+        self.assertEqual(self.fs.write('/#c', paste, offset, fh), 12)
+        self.assertRaises(OSError, self.fs.write, '/#c', paste[12:],
+                          offset + 12, fh)
+        self.assertEqual(self.queue.room('#c'), 0)
+
+    def test_short_write_to_several_targets(self):
+        fh = self.fs.create('/commands/raw', os.O_WRONLY | os.O_NONBLOCK, 0644)
+        lines = "PRIVMSG #y :one\nPRIVMSG #x :two\nPRIVMSG #y :three\n"
+        self.assertEqual(self.fs.write('/commands/raw', lines, 0, fh), 16)
+        self.assertEqual(self.queue.room('#y'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
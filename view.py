@@ -48,9 +48,9 @@ class Cmdview:
         error = None
         h = handler.Handler()
 
-        h.reply_stores.append(('*', h._create_new_store(events.EventStore, name="all_recv")))
-        replystore = h._create_new_store(events.EventStore, name="all_replies")
-        [h.reply_stores.append((str(x), replystore)) for x in range(0,400)]
+        h._create_new_store(events.EventStore, replies=['*'], name="all_recv")
+        h._create_new_store(events.EventStore, name="all_replies",
+                            replies=[str(x) for x in range(0,400)])
 
         h.new_store_callbacks.append(self.new_store_event)
 